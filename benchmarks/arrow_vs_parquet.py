@@ -0,0 +1,88 @@
+"""
+Compare query latency on a cube stored as parquet with the same cube stored as
+(uncompressed, LZ4 or ZSTD compressed) memory-mapped Arrow IPC files.
+
+Usage:
+
+    python benchmarks/arrow_vs_parquet.py [ZIP_OR_CSV] [REPEATS]
+
+Defaults to the 23100309 fixture. Pass a large cube (e.g., a ZIP downloaded by
+`statcandb full download`) to see a meaningful difference.
+"""
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Callable
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+
+from statcandb.arrow_files import read_cube
+from statcandb.cubes import process_cube
+
+DEFAULT_CUBE = Path(__file__).parent.parent / "tests" / "fixtures" / "23100309.csv"
+
+
+def time_query(query: Callable[[], pa.Table], repeats: int) -> float:
+    """Returns the median latency of the query in milliseconds"""
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        query()
+        timings.append(time.perf_counter() - start)
+    return 1_000 * statistics.median(timings)
+
+
+def main(cube_path: Path, repeats: int):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        tmpdir = Path(tmpdir)
+        parquet_path = tmpdir / "cube.parquet"
+        process_cube(cube_path, parquet_path)
+
+        arrow_paths = {}
+        for compression in [None, "lz4", "zstd"]:
+            arrow_paths[compression] = tmpdir / f"cube-{compression}.arrow"
+            process_cube(
+                cube_path,
+                arrow_paths[compression],
+                format="arrow",
+                compression=compression,
+            )
+
+        geo = ds.dataset(parquet_path).to_table(columns=["GEO"])["GEO"][0].as_py()
+        queries = {
+            "full scan": {"columns": None, "filter": None},
+            "one column": {"columns": ["VALUE"], "filter": None},
+            "one GEO": {"columns": None, "filter": pc.field("GEO") == geo},
+        }
+
+        print(f"{'query':<12}{'layout':<16}{'size (KiB)':>12}{'median (ms)':>14}")
+        for name, kwargs in queries.items():
+            layouts = {
+                "parquet": (
+                    parquet_path,
+                    lambda: ds.dataset(parquet_path, partitioning="hive").to_table(
+                        **kwargs
+                    ),
+                )
+            }
+            for compression, path in arrow_paths.items():
+                layouts[f"arrow ({compression or 'none'})"] = (
+                    path,
+                    lambda path=path: read_cube(path, **kwargs),
+                )
+
+            for layout, (path, query) in layouts.items():
+                size = sum(f.stat().st_size for f in path.rglob("*") if f.is_file())
+                latency = time_query(query, repeats)
+                print(f"{name:<12}{layout:<16}{size / 1_024:>12.0f}{latency:>14.2f}")
+
+
+if __name__ == "__main__":
+    main(
+        Path(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_CUBE,
+        int(sys.argv[2]) if len(sys.argv) > 2 else 50,
+    )
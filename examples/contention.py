@@ -0,0 +1,64 @@
+"""
+How much a resource budget helps when several cubes are processed at once.
+
+Processes the same cube in several processes at once, first letting every
+process use every core (as pyarrow and DuckDB do by default) and then giving
+each process an equal share of the cores through `ResourceGovernor`. Run with a
+large cube ZIP file for meaningful numbers, e.g.,
+
+    python examples/contention.py 14100287-eng.zip --workers 8
+"""
+import argparse
+import multiprocessing
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+from statcandb.config import ResourceGovernor, ResourceShare, run_with_share
+from statcandb.cubes import process_cube
+from statcandb.latest import latest_path_for
+
+
+def run(zip_path: Path, workers: int, share: ResourceShare) -> float:
+    with tempfile.TemporaryDirectory() as tmpdir, ProcessPoolExecutor(
+        workers, mp_context=multiprocessing.get_context("spawn")
+    ) as pool:
+        # Start the processes before timing
+        list(pool.map(time.sleep, [0] * workers))
+        start_time = time.monotonic()
+        futures = []
+        for i in range(workers):
+            outfile = Path(tmpdir) / f"{i}.parquet"
+            futures.append(
+                pool.submit(
+                    run_with_share,
+                    share,
+                    process_cube,
+                    zip_path,
+                    outfile,
+                    latest_outfile=latest_path_for(outfile),
+                )
+            )
+        for future in futures:
+            future.result()
+        return time.monotonic() - start_time
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("zip_path", type=Path)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--cpus", type=int, default=None, help="The core budget")
+    args = parser.parse_args()
+
+    governor = ResourceGovernor(cpus=args.cpus)
+    unlimited = run(args.zip_path, args.workers, governor.share(workers=1))
+    print(f"Every process uses {governor.cpus} threads: {unlimited:.1f}s")
+    share = governor.share(workers=args.workers)
+    governed = run(args.zip_path, args.workers, share)
+    print(f"Every process uses {share.threads} threads: {governed:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,203 @@
+"""
+An archive of the raw ZIP files pulled from StatCan.
+
+Without it, rebuilding the bucket after a change to `process_cube` means
+downloading every cube from StatCan again. The archive keeps the ZIP files
+themselves, keyed by product and the SHA-256 of their contents:
+
+    raw/<product id>/<sha256>.zip
+
+so a re-release with identical bytes is stored once. The archive lives either
+in a local directory (`LocalArchive`) or under the raw/ prefix of the bucket
+(`BucketArchive`); both implement `Archive`. Old versions are removed with
+`prune`, which keeps the newest few of each product.
+"""
+import abc
+import hashlib
+import shutil
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Optional, Union
+
+from statcandb.s3 import list_objects
+
+ARCHIVE_PREFIX = "raw"
+DEFAULT_ARCHIVE_KEEP = 3
+
+
+@dataclass(frozen=True)
+class ArchivedZip:
+    product_id: int
+    digest: str
+    modified: datetime
+
+    @property
+    def key(self) -> str:
+        return archive_key(self.product_id, self.digest)
+
+
+def archive_key(product_id: int, digest: str) -> str:
+    return f"{ARCHIVE_PREFIX}/{product_id}/{digest}.zip"
+
+
+def file_digest(path: Union[str, Path]) -> str:
+    """The SHA-256 of a file's contents"""
+    with open(path, "rb") as infile:
+        return hashlib.file_digest(infile, "sha256").hexdigest()
+
+
+def _parse_key(key: str) -> Optional[tuple[int, str]]:
+    parts = key.split("/")
+    if (
+        len(parts) != 3
+        or parts[0] != ARCHIVE_PREFIX
+        or not parts[1].isdigit()
+        or not parts[2].endswith(".zip")
+    ):
+        return None
+    return int(parts[1]), parts[2].removesuffix(".zip")
+
+
+class Archive(abc.ABC):
+    """Where raw ZIP files are archived. See the module docstring"""
+
+    @abc.abstractmethod
+    def versions(self, product_id: int) -> list[ArchivedZip]:
+        """
+        Returns:
+            The archived ZIP files of a product, newest first
+        """
+
+    @abc.abstractmethod
+    def products(self) -> list[int]:
+        """Every product with at least one archived ZIP file"""
+
+    @abc.abstractmethod
+    def put(self, product_id: int, zip_path: Union[str, Path]) -> ArchivedZip:
+        """
+        Archive a ZIP file, unless a file with the same contents already is.
+        Either way, it becomes the product's newest version
+        """
+
+    @abc.abstractmethod
+    def fetch(self, version: ArchivedZip, outfile: Union[str, Path]) -> Path:
+        """Copy an archived ZIP file to outfile"""
+
+    @abc.abstractmethod
+    def delete(self, version: ArchivedZip):
+        """Remove an archived ZIP file"""
+
+    def prune(self, product_id: int, keep: int = DEFAULT_ARCHIVE_KEEP) -> int:
+        """
+        Delete all but the newest keep versions of a product
+
+        Returns:
+            How many versions were deleted
+        """
+        old = self.versions(product_id)[keep:]
+        for version in old:
+            self.delete(version)
+        return len(old)
+
+
+class LocalArchive(Archive):
+    """An archive in a local directory"""
+
+    def __init__(self, root: Union[str, Path]):
+        self.root = Path(root)
+
+    def versions(self, product_id: int) -> list[ArchivedZip]:
+        versions = []
+        for path in (self.root / ARCHIVE_PREFIX / str(product_id)).glob("*.zip"):
+            modified = datetime.fromtimestamp(path.stat().st_mtime, timezone.utc)
+            versions.append(ArchivedZip(product_id, path.stem, modified))
+        return sorted(versions, key=lambda v: v.modified, reverse=True)
+
+    def products(self) -> list[int]:
+        return sorted(
+            int(path.name)
+            for path in (self.root / ARCHIVE_PREFIX).glob("*")
+            if path.name.isdigit() and any(path.glob("*.zip"))
+        )
+
+    def put(self, product_id: int, zip_path: Union[str, Path]) -> ArchivedZip:
+        digest = file_digest(zip_path)
+        path = self.root / archive_key(product_id, digest)
+        if path.exists():
+            path.touch()
+        else:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = path.with_name(f"_{path.name}")
+            shutil.copyfile(zip_path, tmp_path)
+            tmp_path.rename(path)
+        return self.versions(product_id)[0]
+
+    def fetch(self, version: ArchivedZip, outfile: Union[str, Path]) -> Path:
+        shutil.copyfile(self.root / version.key, outfile)
+        return Path(outfile)
+
+    def delete(self, version: ArchivedZip):
+        (self.root / version.key).unlink(missing_ok=True)
+
+
+class BucketArchive(Archive):
+    """An archive under the raw/ prefix of a bucket"""
+
+    def __init__(self, s3, bucket_name: str):
+        self.s3 = s3
+        self.bucket_name = bucket_name
+
+    def _objects(self, prefix: str) -> list[dict]:
+        return list_objects(self.s3, self.bucket_name, prefix)
+
+    def versions(self, product_id: int) -> list[ArchivedZip]:
+        versions = []
+        for obj in self._objects(f"{ARCHIVE_PREFIX}/{product_id}/"):
+            parsed = _parse_key(obj["Key"])
+            if parsed is not None:
+                versions.append(ArchivedZip(*parsed, obj["LastModified"]))
+        return sorted(versions, key=lambda v: v.modified, reverse=True)
+
+    def products(self) -> list[int]:
+        return sorted(
+            {
+                parsed[0]
+                for obj in self._objects(f"{ARCHIVE_PREFIX}/")
+                if (parsed := _parse_key(obj["Key"])) is not None
+            }
+        )
+
+    def put(self, product_id: int, zip_path: Union[str, Path]) -> ArchivedZip:
+        digest = file_digest(zip_path)
+        key = archive_key(product_id, digest)
+        if key in {v.key for v in self.versions(product_id)}:
+            # Copying the object onto itself makes it the newest version
+            self.s3.copy_object(
+                Bucket=self.bucket_name,
+                Key=key,
+                CopySource={"Bucket": self.bucket_name, "Key": key},
+                MetadataDirective="REPLACE",
+            )
+        else:
+            self.s3.upload_file(str(zip_path), self.bucket_name, key)
+        return self.versions(product_id)[0]
+
+    def fetch(self, version: ArchivedZip, outfile: Union[str, Path]) -> Path:
+        self.s3.download_file(self.bucket_name, version.key, str(outfile))
+        return Path(outfile)
+
+    def delete(self, version: ArchivedZip):
+        self.s3.delete_object(Bucket=self.bucket_name, Key=version.key)
+
+
+def open_archive(spec: str, s3=None, bucket_name: Optional[str] = None) -> Archive:
+    """
+    Args:
+        spec: "bucket" for the archive in the bucket, or else a local directory
+        s3: With "bucket", a boto3 S3 client (see `statcandb.s3.get_s3`)
+        bucket_name: With "bucket", the bucket
+    """
+    if spec == "bucket":
+        return BucketArchive(s3, bucket_name)
+    return LocalArchive(spec)
@@ -0,0 +1,81 @@
+"""
+Reading cubes stored as Arrow IPC (a.k.a. Feather v2) files.
+
+For cubes we serve from local disk, decompressing and decoding parquet on
+every query is wasted work. Arrow IPC files can instead be memory mapped: if
+they are uncompressed, the arrays a query returns point directly into the
+page cache, so nothing is copied or decoded, and every process reading the
+same cube shares a single copy in memory.
+
+LZ4 or ZSTD compressed IPC files are smaller on disk but must be decompressed
+when read, so only uncompressed files are truly zero-copy.
+"""
+from pathlib import Path
+from typing import Optional, Union
+
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.fs as pafs
+
+IPC_COMPRESSIONS = (None, "lz4", "zstd")
+
+
+def arrow_path_for(cube_path: Union[str, Path]) -> Path:
+    """
+    Where the Arrow IPC copy of a cube lives, e.g., 14100287.parquet -> 14100287.arrow
+    """
+    cube_path = Path(cube_path)
+    return cube_path.with_name(f"{cube_path.stem}.arrow")
+
+
+def ipc_file_format(
+    compression: Optional[str] = None,
+) -> tuple[ds.IpcFileFormat, ds.FileWriteOptions]:
+    """
+    Args:
+        compression: One of None (uncompressed), "lz4", or "zstd"
+
+    Returns:
+        The format and write options to pass to `pyarrow.dataset.write_dataset`
+    """
+    if compression not in IPC_COMPRESSIONS:
+        raise ValueError(f"compression must be one of {IPC_COMPRESSIONS}")
+    file_format = ds.IpcFileFormat()
+    return file_format, file_format.make_write_options(compression=compression)
+
+
+def open_cube(path: Union[str, Path]) -> ds.Dataset:
+    """
+    Open a cube written in Arrow IPC format with memory mapping.
+
+    Args:
+        path: The directory the cube was written to
+
+    Returns:
+        A dataset whose reads are served from the page cache
+    """
+    return ds.dataset(
+        str(path),
+        format="arrow",
+        partitioning="hive",
+        filesystem=pafs.LocalFileSystem(use_mmap=True),
+    )
+
+
+def read_cube(
+    path: Union[str, Path],
+    columns: Optional[list[str]] = None,
+    filter: Optional[ds.Expression] = None,
+) -> pa.Table:
+    """
+    Read (part of) a cube written in Arrow IPC format.
+
+    Args:
+        path: The directory the cube was written to
+        columns: Optionally, the columns to read
+        filter: Optionally, a filter on the rows, e.g., `ds.field("year") == "2013"`
+
+    Returns:
+        The requested rows and columns
+    """
+    return open_cube(path).to_table(columns=columns, filter=filter)
@@ -0,0 +1,219 @@
+"""
+Checking that the bucket matches what we think we uploaded.
+
+When a cube is uploaded, we record a manifest of its prefix: how many parquet
+files it has, how many rows they hold, and a hash of their schema. An audit
+lists each product's prefix and reads only the footer of each parquet file
+(with ranged GETs of its last few KiB) to compare against the manifest, so
+that no data pages are downloaded.
+"""
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import Any, Optional, Union
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+from botocore.exceptions import BotoCoreError, ClientError
+from sqlalchemy import func, select
+
+from statcandb.models import Product, UploadManifest
+from statcandb.pbar_utils import tqdm_if_verbose
+from statcandb.s3 import S3RangeFile, list_objects
+
+# Enough for the footer of almost any cube file in a single request
+FOOTER_BYTES = 64 * 1_024
+DEFAULT_AUDIT_WORKERS = 32
+
+
+@dataclass(frozen=True)
+class Manifest:
+    file_count: int
+    row_count: int
+    schema_hash: str
+
+
+@dataclass(frozen=True)
+class Discrepancy:
+    """
+    Something wrong with a product in the bucket. problem is one of "missing",
+    "unreadable", "inconsistent_schema", "file_count", "row_count", "schema",
+    or "untracked"
+    """
+
+    product_id: int
+    problem: str
+    expected: Optional[Any] = None
+    actual: Optional[Any] = None
+    key: Optional[str] = None
+
+    def to_dict(self) -> dict[str, Any]:
+        return asdict(self)
+
+
+def schema_hash(schema: pa.Schema) -> str:
+    """A short hash of the names and types of a schema's fields"""
+    description = ";".join(f"{field.name}:{field.type}" for field in schema)
+    return hashlib.sha256(description.encode("utf8")).hexdigest()[:16]
+
+
+def _summarize(files: list[pq.ParquetFile]) -> tuple[Manifest, set[str]]:
+    hashes = {schema_hash(f.schema_arrow) for f in files}
+    manifest = Manifest(
+        file_count=len(files),
+        row_count=sum(f.metadata.num_rows for f in files),
+        schema_hash=min(hashes) if hashes else "",
+    )
+    return manifest, hashes
+
+
+def local_manifest(cube_path: Union[str, Path]) -> Manifest:
+    """The manifest of a cube written by `process_cube`"""
+    files = [pq.ParquetFile(p) for p in sorted(Path(cube_path).rglob("*.parquet"))]
+    return _summarize(files)[0]
+
+
+def record_manifest(session, product_id: int, manifest: Manifest):
+    """Add a manifest to the session. The caller commits"""
+    session.add(UploadManifest(product_id, **asdict(manifest)))
+
+
+def expected_manifests(session) -> dict[int, Optional[Manifest]]:
+    """
+    Returns:
+        Every product we believe is uploaded, with its latest manifest if it has
+        one (products uploaded before manifests were recorded don't)
+    """
+    latest_product = (
+        select(Product.number, func.max(Product.id).label("id"))
+        .group_by(Product.number)
+        .subquery()
+    )
+    uploaded = session.scalars(
+        select(Product.number)
+        .join(latest_product, Product.id == latest_product.c.id)
+        .where(Product.is_uploaded)
+    ).all()
+
+    latest_manifest = (
+        select(func.max(UploadManifest.id)).group_by(UploadManifest.number).subquery()
+    )
+    manifests = {
+        m.number: Manifest(m.file_count, m.row_count, m.schema_hash)
+        for m in session.scalars(
+            select(UploadManifest).where(UploadManifest.id.in_(select(latest_manifest)))
+        )
+    }
+    return {number: manifests.get(number) for number in uploaded}
+
+
+def remote_manifest(
+    s3, bucket_name: str, product_id: int
+) -> tuple[Optional[Manifest], list[Discrepancy]]:
+    """
+    Read the footers of a product's parquet files in the bucket.
+
+    Returns:
+        The manifest of what's in the bucket (None if nothing is), and any
+        problems found along the way
+    """
+    objects = [
+        obj
+        for obj in list_objects(s3, bucket_name, f"{product_id}.parquet/")
+        if obj["Key"].endswith(".parquet")
+    ]
+    if not objects:
+        return None, [Discrepancy(product_id, "missing")]
+
+    problems = []
+    files = []
+    for obj in sorted(objects, key=lambda obj: obj["Key"]):
+        try:
+            range_file = S3RangeFile(
+                s3, bucket_name, obj["Key"], obj["Size"], FOOTER_BYTES
+            )
+            files.append(pq.ParquetFile(range_file))
+        except (pa.ArrowInvalid, OSError, BotoCoreError, ClientError) as e:
+            problems.append(
+                Discrepancy(product_id, "unreadable", actual=str(e), key=obj["Key"])
+            )
+
+    manifest, hashes = _summarize(files)
+    if len(hashes) > 1:
+        problems.append(
+            Discrepancy(product_id, "inconsistent_schema", actual=sorted(hashes))
+        )
+    # Unreadable files still count towards what's in the bucket
+    return Manifest(len(objects), manifest.row_count, manifest.schema_hash), problems
+
+
+def audit_product(
+    s3, bucket_name: str, product_id: int, expected: Optional[Manifest]
+) -> list[Discrepancy]:
+    """
+    Compare a product's prefix in the bucket against its manifest. Without a
+    manifest, only check that the prefix exists and its files are readable
+    """
+    actual, problems = remote_manifest(s3, bucket_name, product_id)
+    if actual is None or expected is None:
+        return problems
+
+    for name in ["file_count", "row_count", "schema_hash"]:
+        if name == "schema_hash" and not actual.schema_hash:
+            # None of the files could be read, which is already reported
+            continue
+        if getattr(actual, name) != getattr(expected, name):
+            problems.append(
+                Discrepancy(
+                    product_id,
+                    name.removesuffix("_hash"),
+                    expected=getattr(expected, name),
+                    actual=getattr(actual, name),
+                )
+            )
+    return problems
+
+
+def untracked_products(s3, bucket_name: str, tracked: set[int]) -> list[Discrepancy]:
+    """Cubes in the bucket which the database doesn't know are uploaded"""
+    problems = []
+    paginator = s3.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=bucket_name, Delimiter="/"):
+        for prefix in page.get("CommonPrefixes", []):
+            name = prefix["Prefix"].rstrip("/")
+            product_id = name.removesuffix(".parquet")
+            if (
+                name.endswith(".parquet")
+                and product_id.isdigit()
+                and int(product_id) not in tracked
+            ):
+                problems.append(Discrepancy(int(product_id), "untracked"))
+    return problems
+
+
+def audit_bucket(
+    s3,
+    bucket_name: str,
+    expected: dict[int, Optional[Manifest]],
+    workers: int = DEFAULT_AUDIT_WORKERS,
+    verbose: bool = False,
+) -> list[Discrepancy]:
+    """
+    Audit every product in expected (see `expected_manifests`) in parallel
+
+    Returns:
+        Every discrepancy found, ordered by product
+    """
+    problems = untracked_products(s3, bucket_name, set(expected))
+    with ThreadPoolExecutor(workers) as pool, tqdm_if_verbose(
+        desc="Auditing", total=len(expected), verbose=verbose
+    ) as pbar:
+        futures = [
+            pool.submit(audit_product, s3, bucket_name, product_id, manifest)
+            for product_id, manifest in expected.items()
+        ]
+        for future in futures:
+            problems.extend(future.result())
+            pbar.update(1)
+    return sorted(problems, key=lambda problem: problem.product_id)
@@ -0,0 +1,199 @@
+"""
+Downloading (and splitting) delta files for a whole range of dates.
+
+Downloads run on a bounded thread pool. As each one finishes, it can be handed
+to a second pool which splits it with `split_delta_file`, so that splitting
+overlaps with the remaining downloads.
+
+StatCan doesn't publish delta files on weekends and holidays; the server
+answers those dates with a 404, which we record rather than treat as an error.
+"""
+import shutil
+import zipfile
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from dataclasses import dataclass, field
+from datetime import date, datetime, timedelta
+from pathlib import Path
+from typing import Optional, Union
+
+import requests
+
+from statcandb.delta_files import (
+    BASE_URL,
+    open_delta_file,
+    pull_delta_file,
+    split_delta_file,
+)
+from statcandb.pbar_utils import tqdm_if_verbose
+
+DEFAULT_DOWNLOAD_WORKERS = 4
+DEFAULT_SPLIT_WORKERS = 2
+
+
+@dataclass
+class BackfillResult:
+    """The dates (as YYYYMMDD) of a backfill, by what happened to them"""
+
+    downloaded: list[str] = field(default_factory=list)
+    skipped: list[str] = field(default_factory=list)
+    not_published: list[str] = field(default_factory=list)
+    failed: list[str] = field(default_factory=list)
+    split: list[str] = field(default_factory=list)
+    # Downloaded (or already present), but failed to split
+    split_failed: list[str] = field(default_factory=list)
+
+    def __str__(self) -> str:
+        return (
+            f"{len(self.downloaded)} downloaded, {len(self.skipped)} already "
+            f"present, {len(self.not_published)} not published, "
+            f"{len(self.failed)} failed, {len(self.split)} split, "
+            f"{len(self.split_failed)} failed to split"
+        )
+
+
+def date_range(
+    start: Union[str, datetime, date], end: Union[str, datetime, date]
+) -> list[str]:
+    """
+    Returns:
+        Every date from start to end (inclusive) as YYYYMMDD
+    """
+    if isinstance(start, str):
+        start = datetime.strptime(start, "%Y%m%d")
+    if isinstance(end, str):
+        end = datetime.strptime(end, "%Y%m%d")
+
+    dates = []
+    while start <= end:
+        dates.append(start.strftime("%Y%m%d"))
+        start += timedelta(days=1)
+    return dates
+
+
+def is_valid_delta_file(path: Union[str, Path]) -> bool:
+    """Whether path is a complete delta file ZIP, i.e., not a partial download"""
+    path = Path(path)
+    if not zipfile.is_zipfile(path):
+        return False
+    with zipfile.ZipFile(path) as zf:
+        return path.with_suffix(".csv").name in zf.namelist()
+
+
+def _download(
+    download_date: str, download_dir: Path, base_url: str
+) -> tuple[str, Optional[Path]]:
+    """
+    Returns:
+        What happened ("downloaded", "skipped", "not_published", or "failed")
+        and the path of the delta file, if there is one
+    """
+    path = download_dir / f"{download_date}.zip"
+    if path.exists() and is_valid_delta_file(path):
+        return "skipped", path
+
+    try:
+        path = pull_delta_file(download_date, download_dir, base_url=base_url)
+    except requests.exceptions.HTTPError as e:
+        path.unlink(missing_ok=True)
+        if e.response is not None and e.response.status_code == 404:
+            return "not_published", None
+        return "failed", None
+    except (requests.exceptions.RequestException, OSError):
+        # E.g., a dropped connection, or a full disk
+        path.unlink(missing_ok=True)
+        return "failed", None
+
+    if not is_valid_delta_file(path):
+        path.unlink()
+        return "failed", None
+    return "downloaded", path
+
+
+def _split(delta_file_path: Path, split_path: Path, format: str):
+    # Split under another name first, so a failed split isn't mistaken for a
+    # finished one next time
+    tmp_path = split_path.with_name(f"_{split_path.name}")
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    with open_delta_file(delta_file_path) as delta_file:
+        split_delta_file(delta_file, tmp_path, format=format)
+    tmp_path.rename(split_path)
+
+
+def backfill_delta_files(
+    start: Union[str, datetime, date],
+    end: Union[str, datetime, date],
+    download_dir: Union[str, Path],
+    split_dir: Optional[Union[str, Path]] = None,
+    format: str = "parquet",
+    download_workers: int = DEFAULT_DOWNLOAD_WORKERS,
+    split_workers: int = DEFAULT_SPLIT_WORKERS,
+    base_url: str = BASE_URL,
+    verbose: bool = False,
+) -> BackfillResult:
+    """
+    Download every delta file from start to end, skipping those already present.
+
+    Args:
+        start: The first date to download. If a str, formatted as YYYYMMDD
+        end: The last date to download (inclusive)
+        download_dir: The directory to download the delta files to
+        split_dir: If given, split each delta file into split_dir/YYYYMMDD.
+            Dates which have already been split are not split again
+        format: The format to split delta files into
+        download_workers: How many files to download at once
+        split_workers: How many files to split at once
+        base_url: The format string to use when constructing delta file URLs
+        verbose: If true, print a progressbar
+
+    Returns:
+        What happened to each date
+    """
+    download_dir = Path(download_dir)
+    download_dir.mkdir(parents=True, exist_ok=True)
+    split_dir = Path(split_dir) if split_dir is not None else None
+    if split_dir is not None:
+        split_dir.mkdir(parents=True, exist_ok=True)
+
+    dates = date_range(start, end)
+    result = BackfillResult()
+    split_futures: dict[Future, str] = {}
+    with ThreadPoolExecutor(download_workers) as download_pool, ThreadPoolExecutor(
+        split_workers
+    ) as split_pool:
+        download_futures = {
+            download_pool.submit(_download, the_date, download_dir, base_url): the_date
+            for the_date in dates
+        }
+        with tqdm_if_verbose(
+            desc="Downloading", total=len(dates), verbose=verbose
+        ) as pbar:
+            for future in as_completed(download_futures):
+                the_date = download_futures[future]
+                outcome, path = future.result()
+                getattr(result, outcome).append(the_date)
+                pbar.update(1)
+
+                if path is None or split_dir is None:
+                    continue
+                split_path = split_dir / the_date
+                if not split_path.exists():
+                    split_futures[
+                        split_pool.submit(_split, path, split_path, format)
+                    ] = the_date
+
+        for future in as_completed(split_futures):
+            if future.exception() is None:
+                result.split.append(split_futures[future])
+            else:
+                result.split_failed.append(split_futures[future])
+
+    for dates_list in [
+        result.downloaded,
+        result.skipped,
+        result.not_published,
+        result.failed,
+        result.split,
+        result.split_failed,
+    ]:
+        dates_list.sort()
+    return result
@@ -0,0 +1,185 @@
+"""
+Change-data-capture (CDC) output for each cube refresh.
+
+When a cube is replaced, downstream systems would otherwise have to re-read the
+whole cube to find the few rows that were revised. So before the old version is
+deleted from the bucket, we diff it against the new one and publish the
+difference as a small parquet file under
+
+    changes/<product id>/<sequence>.parquet
+
+where sequence counts up from 1 for each cube (zero-padded, so keys sort in
+order). Each row is keyed by COORDINATE and REF_DATE and has an OP column:
+
+    insert  the key is new. The other columns hold the new row
+    update  one of the compared columns changed. They hold the new row
+    delete  the key is gone. The other columns are null
+
+Subscribers remember the last sequence they applied for each cube and apply
+every later file in order. Refreshes which change nothing publish no file.
+"""
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Union
+
+import duckdb
+import pyarrow.dataset as ds
+from sqlalchemy import func, select
+
+from statcandb.config import duckdb_config
+from statcandb.models import CubeChange
+
+CHANGES_PREFIX = "changes"
+KEY_COLUMNS = ["COORDINATE", "REF_DATE"]
+# The per-observation columns compared between versions and published with
+# each change. Label columns are left out: they follow from the COORDINATE
+CHANGE_COLUMNS = [
+    "VECTOR",
+    "VALUE",
+    "SCALED_VALUE",
+    "STATUS",
+    "SYMBOL",
+    "TERMINATED",
+    "DECIMALS",
+]
+
+
+@dataclass(frozen=True)
+class ChangeCounts:
+    inserted: int = 0
+    updated: int = 0
+    deleted: int = 0
+
+    @property
+    def total(self) -> int:
+        return self.inserted + self.updated + self.deleted
+
+    def __str__(self) -> str:
+        return (
+            f"{self.inserted} inserted, {self.updated} updated, "
+            f"{self.deleted} deleted"
+        )
+
+
+def _quote(name: str) -> str:
+    return '"' + name.replace('"', '""') + '"'
+
+
+def change_key(product_id: int, sequence: int) -> str:
+    """The key of a cube's change file in the bucket"""
+    return f"{CHANGES_PREFIX}/{product_id}/{sequence:010d}.parquet"
+
+
+def diff_cubes(
+    old_path: Union[str, Path],
+    new_path: Union[str, Path],
+    outfile: Union[str, Path],
+    format: str = "parquet",
+) -> ChangeCounts:
+    """
+    Write the rows which differ between two versions of a cube.
+
+    Args:
+        old_path: The directory the previous version of the cube was written to
+        new_path: The directory the new version of the cube was written to
+        outfile: Where to write the changes. Nothing is written if there are none
+        format: The format both cubes were written in ("parquet" or "arrow")
+
+    Returns:
+        How many rows were inserted, updated, and deleted
+    """
+    old = ds.dataset(old_path, format=format, partitioning="hive")
+    new = ds.dataset(new_path, format=format, partitioning="hive")
+    # Columns added since the old version (e.g., SCALED_VALUE) aren't compared,
+    # since every row would count as updated
+    compared = [
+        name
+        for name in CHANGE_COLUMNS
+        if name in old.schema.names and name in new.schema.names
+    ]
+
+    # REF_DATE is read as a number or a date depending on the cube, so keys are
+    # compared (and published) as strings
+    key = " AND ".join(
+        f"CAST(o.{name} AS VARCHAR) = CAST(n.{name} AS VARCHAR)" for name in KEY_COLUMNS
+    )
+    changed = " OR ".join(
+        f"o.{_quote(name)} IS DISTINCT FROM n.{_quote(name)}" for name in compared
+    )
+    columns = ", ".join(
+        [
+            f"coalesce(CAST(n.{name} AS VARCHAR), CAST(o.{name} AS VARCHAR)) AS {name}"
+            for name in KEY_COLUMNS
+        ]
+        + [f"n.{_quote(name)}" for name in compared]
+    )
+    with duckdb.connect(":memory:", read_only=False, config=duckdb_config()) as con:
+        con.register("old_cube", old)
+        con.register("new_cube", new)
+        con.execute(
+            f"""
+            CREATE TABLE changes AS
+            SELECT
+                CASE
+                    WHEN o.COORDINATE IS NULL THEN 'insert'
+                    WHEN n.COORDINATE IS NULL THEN 'delete'
+                    ELSE 'update'
+                END AS OP,
+                {columns}
+            FROM old_cube o
+            FULL OUTER JOIN new_cube n ON {key}
+            WHERE o.COORDINATE IS NULL OR n.COORDINATE IS NULL
+                {f"OR {changed}" if changed else ""}
+            """
+        )
+        counts = dict(
+            con.execute("SELECT OP, count(*) FROM changes GROUP BY OP").fetchall()
+        )
+        if counts:
+            con.execute(
+                f"""
+                COPY (
+                    SELECT * FROM changes ORDER BY {", ".join(KEY_COLUMNS)}
+                ) TO '{outfile}' (FORMAT 'parquet')
+                """
+            )
+    return ChangeCounts(
+        counts.get("insert", 0), counts.get("update", 0), counts.get("delete", 0)
+    )
+
+
+def next_sequence(session, product_id: int) -> int:
+    """The sequence number of the next change file of a cube"""
+    last = session.scalar(
+        select(func.max(CubeChange.sequence)).where(CubeChange.number == product_id)
+    )
+    return (last or 0) + 1
+
+
+def publish_changes(
+    s3,
+    bucket_name: str,
+    session,
+    product_id: int,
+    changes_path: Union[str, Path],
+    counts: ChangeCounts,
+) -> int:
+    """
+    Upload a cube's change file under its next sequence number, and add a record
+    of it to the session. The caller commits
+
+    Returns:
+        The sequence number of the change file
+    """
+    sequence = next_sequence(session, product_id)
+    s3.upload_file(str(changes_path), bucket_name, change_key(product_id, sequence))
+    session.add(
+        CubeChange(
+            product_id,
+            sequence,
+            inserted=counts.inserted,
+            updated=counts.updated,
+            deleted=counts.deleted,
+        )
+    )
+    return sequence
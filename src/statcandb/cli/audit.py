@@ -0,0 +1,51 @@
+import json
+from typing import TextIO
+
+import click
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from statcandb.audit import DEFAULT_AUDIT_WORKERS, audit_bucket, expected_manifests
+from statcandb.config import get_config
+from statcandb.s3 import get_s3
+
+
+@click.command("audit")
+@click.option(
+    "--outfile",
+    "-o",
+    type=click.File("wt"),
+    default="-",
+    help="Where to write the discrepancies, one JSON object per line",
+)
+@click.option(
+    "--workers",
+    "-w",
+    type=int,
+    default=DEFAULT_AUDIT_WORKERS,
+    help="How many products to check at once",
+)
+def audit_command(outfile: TextIO, workers: int):
+    """
+    Check every uploaded product in the bucket against the database
+
+    Only the footers of the parquet files are read. Exits with an error if
+    anything is missing, unreadable, or differs from what was uploaded.
+    """
+    config = get_config()
+    engine = create_engine(config.sqlite_db_url)
+    Session = sessionmaker(engine)
+    with Session() as session:
+        expected = expected_manifests(session)
+
+    problems = audit_bucket(
+        get_s3(config), config.r2_bucket, expected, workers=workers, verbose=True
+    )
+    for problem in problems:
+        outfile.write(json.dumps(problem.to_dict()) + "\n")
+
+    click.echo(
+        f"Audited {len(expected)} products: {len(problems)} discrepancies", err=True
+    )
+    if problems:
+        raise SystemExit(1)
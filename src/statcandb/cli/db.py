@@ -1,5 +1,9 @@
+from pathlib import Path
+from typing import Optional
+
 import click
 from sqlalchemy import create_engine
+from sqlalchemy.orm import Session
 
 from ..config import get_config
 
@@ -20,3 +24,73 @@ def db_create_command() -> None:
 
     engine = create_engine(config.sqlite_db_url)
     Base.metadata.create_all(engine)
+
+
+@db_group.command("materialize")
+@click.option(
+    "--products",
+    "-p",
+    type=int,
+    multiple=True,
+    default=[],
+    help="The products to load. Defaults to those already in the output",
+)
+@click.option(
+    "--out",
+    "-o",
+    type=click.Path(dir_okay=False, path_type=Path),
+    default=Path("stats.duckdb"),
+    help="The DuckDB file to load the cubes into",
+)
+@click.option(
+    "--source",
+    type=click.Path(exists=True, file_okay=False, path_type=Path),
+    default=None,
+    help="Read cubes from this directory rather than the bucket",
+)
+@click.option(
+    "--force", is_flag=True, help="Reload products even if they haven't changed"
+)
+def db_materialize_command(
+    products: tuple[int, ...], out: Path, source: Optional[Path], force: bool
+) -> None:
+    """
+    Load cubes into native DuckDB tables
+
+    Only products released since they were last loaded are reloaded, so run
+    this again to refresh the file.
+    """
+    from ..materialize import (  # pylint: disable=import-outside-toplevel
+        bucket_cube_source,
+        latest_release_times,
+        local_cube_source,
+        materialize,
+        materialized_products,
+    )
+    from ..s3 import get_s3  # pylint: disable=import-outside-toplevel
+
+    config = get_config()
+    product_ids = list(products)
+    if not product_ids:
+        if not out.exists():
+            raise click.UsageError("Pass --products to create a new database")
+        import duckdb  # pylint: disable=import-outside-toplevel
+
+        with duckdb.connect(str(out)) as con:
+            product_ids = sorted(materialized_products(con))
+
+    engine = create_engine(config.sqlite_db_url)
+    with Session(engine) as session:
+        release_times = latest_release_times(session, product_ids)
+
+    if source is not None:
+        get_cube = local_cube_source(source)
+    else:
+        get_cube = bucket_cube_source(get_s3(config), config.r2_bucket)
+
+    result = materialize(
+        out, product_ids, get_cube, release_times, force=force, verbose=True
+    )
+    click.echo(result)
+    if result.missing:
+        click.echo(f"Missing: {', '.join(str(p) for p in result.missing)}")
@@ -1,10 +1,31 @@
-import zipfile
 from pathlib import Path
 from typing import Optional
 
 import click
+import pyarrow.parquet as pq
 
-from statcandb.delta_files import pull_delta_file, split_delta_file
+from statcandb.backfill import (
+    DEFAULT_DOWNLOAD_WORKERS,
+    DEFAULT_SPLIT_WORKERS,
+    backfill_delta_files,
+)
+from statcandb.delta_files import open_delta_file, pull_delta_file, split_delta_file
+from statcandb.delta_history import (
+    DEFAULT_TARGET_BYTES,
+    as_of,
+    compact_delta_history,
+    ingest_delta_file,
+    pull_and_ingest_delta_file,
+)
+from statcandb.delta_index import (
+    DEFAULT_PRODUCT_SPLIT_WORKERS,
+    split_delta_products,
+    write_delta_index,
+)
+from statcandb.latest import update_latest
+from statcandb.profiling import profile_stage
+from statcandb.rollups import update_rollup
+from statcandb.vector_index import add_to_vector_index, index_delta_split
 
 
 @click.group("delta")
@@ -12,8 +33,12 @@ def delta_group():
     """Dealing with delta files"""
 
 
+def _is_yyyymmdd(the_date: str) -> bool:
+    return len(the_date) == 8 and the_date.isdigit()
+
+
 @delta_group.command("download")
-@click.argument("download_date")
+@click.argument("download_date", required=False)
 @click.option(
     "--download-dir",
     "-d",
@@ -21,13 +46,78 @@ def delta_group():
     help="The directory to download delta files to. Defaults to cwd",
     default=None,
 )
-def download_command(download_date: str, download_dir: Optional[str] = None):
-    """Download a delta file"""
-    if not len(download_date) == 8 and download_date.isdigit():
-        raise click.BadArgumentUsage("download_date must be in the format YYYYMMDD")
+@click.option("--start", "-s", default=None, help="Download every day from YYYYMMDD")
+@click.option("--end", "-e", default=None, help="... up to YYYYMMDD (inclusive)")
+@click.option(
+    "--workers",
+    "-w",
+    type=int,
+    default=DEFAULT_DOWNLOAD_WORKERS,
+    help="With --start/--end, how many files to download at once",
+)
+@click.option(
+    "--split-dir",
+    default=None,
+    help="With --start/--end, also split each delta file into SPLIT_DIR/YYYYMMDD",
+)
+@click.option(
+    "--split-workers",
+    type=int,
+    default=DEFAULT_SPLIT_WORKERS,
+    help="How many delta files to split at once",
+)
+@click.option("--format", "-f", default="parquet", help="The format of the split files")
+def download_command(
+    download_date: Optional[str],
+    download_dir: Optional[str],
+    start: Optional[str],
+    end: Optional[str],
+    workers: int,
+    split_dir: Optional[str],
+    split_workers: int,
+    format: str,
+):
+    """
+    Download a delta file, or with --start and --end, every delta file in a
+    range of dates
 
+    Files already in the download directory are skipped, as are days on which
+    no delta file was published.
+    """
     download_dir = download_dir or Path.cwd()
-    pull_delta_file(download_date, download_dir)
+    if download_date is not None:
+        if start or end:
+            raise click.BadArgumentUsage(
+                "Pass either DOWNLOAD_DATE or --start and --end, not both"
+            )
+        if not _is_yyyymmdd(download_date):
+            raise click.BadArgumentUsage("download_date must be in the format YYYYMMDD")
+        pull_delta_file(download_date, download_dir)
+        return
+
+    if not (start and end):
+        raise click.BadArgumentUsage("Pass either DOWNLOAD_DATE or --start and --end")
+    if not (_is_yyyymmdd(start) and _is_yyyymmdd(end)):
+        raise click.BadArgumentUsage("--start and --end must be in the format YYYYMMDD")
+
+    result = backfill_delta_files(
+        start,
+        end,
+        download_dir,
+        split_dir=split_dir,
+        format=format,
+        download_workers=workers,
+        split_workers=split_workers,
+        verbose=True,
+    )
+    click.echo(str(result))
+    problems = []
+    if result.failed:
+        problems.append(f"Failed: {', '.join(result.failed)}")
+    if result.split_failed:
+        problems.append(f"Failed to split: {', '.join(result.split_failed)}")
+    if problems:
+        raise click.ClickException(". ".join(problems))
 
 
 @delta_group.command("split")
@@ -36,13 +126,208 @@ def download_command(download_date: str, download_dir: Optional[str] = None):
 @click.option(
     "--format", "-f", default="parquet", help="The format of the partitioned file"
 )
-def split_command(infile: str, outfile: str, format: str):
+@click.option(
+    "--vector-index-dir",
+    envvar="STATCANDB_VECTOR_INDEX_DIR",
+    default=None,
+    help="If given, add the split file to the vectorId index in this directory",
+)
+@click.option(
+    "--product-id",
+    "-p",
+    type=int,
+    multiple=True,
+    help=(
+        "Only split these products, reading just their rows with the delta "
+        "file's byte-offset index (built if it doesn't exist)"
+    ),
+)
+@click.option(
+    "--workers",
+    "-w",
+    type=int,
+    default=DEFAULT_PRODUCT_SPLIT_WORKERS,
+    help="With --product-id, how many products to split at once",
+)
+def split_command(
+    infile: str,
+    outfile: str,
+    format: str,
+    vector_index_dir: Optional[str] = None,
+    product_id: tuple[int, ...] = (),
+    workers: int = DEFAULT_PRODUCT_SPLIT_WORKERS,
+):
     """Download a delta file"""
-    if infile.lower().endswith(".zip"):
-        pinfile = Path(infile)
-        csv_filename = pinfile.with_suffix(".csv").name
-        with zipfile.ZipFile(infile) as zf:
-            with zf.open(csv_filename) as zf_csv:
-                split_delta_file(zf_csv, outfile, format=format)
+    if vector_index_dir and format != "parquet":
+        raise click.BadOptionUsage(
+            "--vector-index-dir", "Only parquet delta files can be indexed"
+        )
+
+    # Profiles are stored under the delta file's date
+    key = Path(infile).stem
+    with profile_stage("split", key):
+        if product_id:
+            written = split_delta_products(
+                infile, outfile, product_id, format=format, workers=workers
+            )
+            missing = sorted(set(product_id) - set(written))
+            if missing:
+                click.echo(f"Not in {infile}: {', '.join(str(p) for p in missing)}")
+        else:
+            with open_delta_file(infile) as delta_file:
+                split_delta_file(delta_file, outfile, format=format)
+
+    if vector_index_dir:
+        with profile_stage("vector-index", key):
+            add_to_vector_index(
+                vector_index_dir, index_delta_split(outfile), replace_product=None
+            )
+
+
+@delta_group.command("index")
+@click.argument("infile")
+@click.option(
+    "--outfile",
+    "-o",
+    default=None,
+    help="Where to write the index. Defaults to, e.g., 20230803.index.parquet",
+)
+def index_command(infile: str, outfile: Optional[str]):
+    """
+    Record the byte range of each product's rows in a delta file (ZIP or CSV),
+    so that `statcandb delta split --product-id` can read just those rows
+    """
+    index = write_delta_index(infile, outfile)
+    rows = sum(index["rowCount"].to_pylist())
+    products = len(set(index["productId"].to_pylist()))
+    click.echo(f"Indexed {rows:,} rows of {products:,} products")
+
+
+@delta_group.command("latest")
+@click.argument("latest_path")
+@click.argument("delta_path")
+@click.argument("outfile")
+@click.option(
+    "--format", "-f", default="parquet", help="The format of the split delta file"
+)
+def latest_command(latest_path: str, delta_path: str, outfile: str, format: str):
+    """
+    Apply a split delta file (e.g., the productId=... directory written by
+    `statcandb delta split`) to a cube's latest value table
+    """
+    update_latest(latest_path, delta_path, outfile, format=format)
+
+
+@delta_group.command("rollup")
+@click.argument("rollup_path")
+@click.argument("cube_path")
+@click.argument("delta_path")
+@click.argument("outfile")
+@click.option(
+    "--frequency",
+    type=click.Choice(["annual", "quarterly"]),
+    default="annual",
+    help="The frequency of the rollup",
+)
+@click.option(
+    "--format", "-f", default="parquet", help="The format of the split delta file"
+)
+def rollup_command(
+    rollup_path: str,
+    cube_path: str,
+    delta_path: str,
+    outfile: str,
+    frequency: str,
+    format: str,
+):
+    """
+    Apply a split delta file to a rollup of a cube, recomputing only the
+    periods it touches
+    """
+    update_rollup(rollup_path, cube_path, delta_path, outfile, frequency, format=format)
+
+
+store_option = click.option(
+    "--store",
+    "-s",
+    envvar="STATCANDB_DELTA_STORE",
+    required=True,
+    help="The directory of the delta history store",
+)
+
+
+@delta_group.command("ingest")
+@store_option
+@click.argument("download_date")
+@click.option(
+    "--file",
+    "delta_file",
+    default=None,
+    help="Ingest this already downloaded delta file (ZIP or CSV) instead",
+)
+def ingest_command(store: str, download_date: str, delta_file: Optional[str]):
+    """Add the delta file for DOWNLOAD_DATE (YYYYMMDD) to the delta history store"""
+    if not (len(download_date) == 8 and download_date.isdigit()):
+        raise click.BadArgumentUsage("download_date must be in the format YYYYMMDD")
+
+    if delta_file:
+        ingested = ingest_delta_file(store, delta_file, download_date)
+    else:
+        ingested = pull_and_ingest_delta_file(store, download_date)
+
+    if not ingested:
+        click.echo(f"{download_date} is already in the store")
+
+
+@delta_group.command("compact")
+@store_option
+@click.option(
+    "--target-mb",
+    type=int,
+    default=DEFAULT_TARGET_BYTES // (1_024 * 1_024),
+    help="Merge small files into files of about this many MiB",
+)
+@click.option(
+    "--product-id", "-p", type=int, multiple=True, help="Only compact these products"
+)
+def compact_command(store: str, target_mb: int, product_id: list[int]):
+    """Merge the small daily files in the delta history store"""
+    before, after = compact_delta_history(
+        store, target_mb * 1_024 * 1_024, product_ids=product_id or None
+    )
+    click.echo(f"Compacted {before} files into {after}")
+
+
+@delta_group.command("as-of")
+@store_option
+@click.argument("as_of_date")
+@click.option("--product-id", "-p", type=int, default=None)
+@click.option("--vector-id", "-v", type=str, default=None)
+@click.option("--outfile", "-o", default=None, help="Write parquet here")
+def as_of_command(
+    store: str,
+    as_of_date: str,
+    product_id: Optional[int],
+    vector_id: Optional[str],
+    outfile: Optional[str],
+):
+    """
+    Show the value of each vector and reference period as of AS_OF_DATE (YYYYMMDD)
+    """
+    if product_id is None and vector_id is None:
+        raise click.UsageError("One of --product-id or --vector-id is required")
+
+    tab = as_of(
+        store,
+        as_of_date,
+        product_id=product_id,
+        vector_id=int(vector_id.lstrip("vV")) if vector_id else None,
+    )
+    if outfile:
+        pq.write_table(tab, outfile)
     else:
-        split_delta_file(infile, outfile, format=format)
+        for row in tab.to_pylist():
+            click.echo(
+                f"{row['vectorId']}\t{row['refPer']}\t{row['value']}\t"
+                f"{row['releaseTime']}"
+            )
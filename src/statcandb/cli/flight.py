@@ -0,0 +1,101 @@
+from pathlib import Path
+from typing import Optional
+
+import click
+
+from statcandb.config import get_config
+from statcandb.flight import (
+    DEFAULT_CACHE_BYTES,
+    DEFAULT_FLIGHT_PORT,
+    DEFAULT_REVALIDATE_SECONDS,
+    CubeCache,
+    CubeFlightServer,
+    cube_version_from_release_times,
+    disk_cached_cube_source,
+    local_cube_version,
+)
+from statcandb.materialize import (
+    bucket_cube_source,
+    latest_release_times,
+    local_cube_source,
+)
+from statcandb.s3 import get_s3
+
+from .full import get_session
+
+
+@click.command("serve-flight")
+@click.option("--host", default="0.0.0.0", help="The address to listen on")
+@click.option("--port", type=int, default=DEFAULT_FLIGHT_PORT)
+@click.option(
+    "--source",
+    default="bucket",
+    help=(
+        "Serve the cubes in this directory, as written by `statcandb full "
+        "prepare`, or those in the bucket if 'bucket'"
+    ),
+)
+@click.option(
+    "--cache-mb",
+    type=int,
+    default=DEFAULT_CACHE_BYTES // (1_024 * 1_024),
+    help="How much memory to keep hot cubes in",
+)
+@click.option(
+    "--cache-dir",
+    type=click.Path(file_okay=False, path_type=Path),
+    default=None,
+    help=(
+        "Where to keep cubes downloaded from the bucket. Defaults to a temporary "
+        "directory"
+    ),
+)
+@click.option(
+    "--revalidate-seconds",
+    type=float,
+    default=DEFAULT_REVALIDATE_SECONDS,
+    help="How often to check whether a cached cube has been republished",
+)
+def serve_flight_command(
+    host: str,
+    port: int,
+    source: str,
+    cache_mb: int,
+    cache_dir: Optional[Path],
+    revalidate_seconds: float,
+):
+    """
+    Serve processed cubes over Arrow Flight
+
+    Tickets are JSON, e.g., {"product_id": 14100287, "columns": ["REF_DATE",
+    "VALUE"], "years": ["2023"]}. Columns and years are optional. Cached
+    cubes are reloaded when their release time in the database changes (or,
+    with --source DIR, when their files do).
+    """
+    if source == "bucket":
+        config = get_config()
+
+        def get_release_times(product_ids: list[int]):
+            with get_session(None) as session:
+                return latest_release_times(session, product_ids)
+
+        get_version = cube_version_from_release_times(get_release_times)
+        get_cube = disk_cached_cube_source(
+            bucket_cube_source(get_s3(config), config.r2_bucket), get_version
+        )
+    else:
+        get_version = local_cube_version(source)
+        get_cube = local_cube_source(source)
+    if cache_dir is not None:
+        cache_dir.mkdir(parents=True, exist_ok=True)
+
+    server = CubeFlightServer(
+        f"grpc://{host}:{port}",
+        get_cube,
+        cache=CubeCache(cache_mb * 1_024 * 1_024),
+        cache_dir=cache_dir,
+        get_version=get_version,
+        revalidate_seconds=revalidate_seconds,
+    )
+    click.echo(f"Serving cubes from {source} at grpc://{host}:{server.port}")
+    server.serve()
@@ -1,24 +1,245 @@
 import itertools as its
+import multiprocessing
+import os
+import shutil
 import tempfile
+import time
 import zipfile
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, wait
 from contextlib import contextmanager
+from dataclasses import dataclass
 from datetime import datetime, timedelta
+from functools import partial
 from pathlib import Path
 from typing import Any, List, Optional
 
 import click
 import pyarrow as pa
 import requests
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, func, select
 from sqlalchemy.orm import sessionmaker
 from tqdm.cli import tqdm
 
-from statcandb.config import get_config
-from statcandb.models import Product
-from statcandb.s3 import get_s3
+from statcandb.archive import DEFAULT_ARCHIVE_KEEP, Archive, open_archive
+from statcandb.audit import local_manifest, record_manifest, remote_manifest
+from statcandb.changes import diff_cubes, publish_changes
+from statcandb.compaction import (
+    DEFAULT_COMPACT_TARGET_BYTES,
+    compact_cube,
+    compact_uploaded_cube,
+)
+from statcandb.config import get_config, get_governor, run_with_share
+from statcandb.dimensions import DIMENSION_MODES, dimensions_path_for
+from statcandb.file_utils import download_file
+from statcandb.fingerprints import (
+    get_local_fingerprint,
+    get_remote_fingerprint,
+    get_stored_fingerprint,
+)
+from statcandb.isolation import CubeWorker, LimitExceeded, WorkerLimits
+from statcandb.latest import latest_path_for
+from statcandb.models import CubeDeferral, CubeFingerprint, CubeStat, Product
+from statcandb.observations import (
+    observations_key,
+    upload_observations,
+    write_observations,
+)
+from statcandb.profiling import profile_stage, profiled
+from statcandb.rollups import FREQUENCIES, rollup_path_for, rollup_paths, write_rollups
+from statcandb.s3 import download_prefix, get_s3
+from statcandb.scheduling import DEFAULT_SMALL_LANE_EVERY, estimate_costs, schedule
+from statcandb.series_index import series_index_path_for, write_series_index
+from statcandb.sharding import (
+    DEFAULT_LEASE_SECONDS,
+    LeaseHeartbeat,
+    claim_lease,
+    default_worker_id,
+    filter_shard,
+    finish_lease,
+    parse_shard,
+    release_lease,
+    unfinished_products,
+)
+from statcandb.vector_index import add_to_vector_index, index_cube
+
+from ..cubes import (
+    ProductMetadata,
+    get_changed_pid_list,
+    get_cube_size,
+    get_cube_url,
+    get_pid_list,
+    process_cube,
+    pull_cube,
+)
+
+vector_index_dir_option = click.option(
+    "--vector-index-dir",
+    envvar="STATCANDB_VECTOR_INDEX_DIR",
+    type=click.Path(path_type=Path),
+    default=None,
+    help="If given, add each uploaded cube to the vectorId index in this directory",
+)
+
+compact_target_mb_option = click.option(
+    "--compact-target-mb",
+    type=int,
+    default=DEFAULT_COMPACT_TARGET_BYTES // (1_024 * 1_024),
+    help="Merge small year partitions into files of about this many MiB. 0 disables",
+)
+
+skip_unchanged_option = click.option(
+    "--skip-unchanged/--no-skip-unchanged",
+    default=True,
+    help=(
+        "Check the CSV's CRC32 in the ZIP's central directory first, and only "
+        "bump the release time of cubes whose data didn't change"
+    ),
+)
+
+
+def worker_limit_options(func):
+    """The limits each cube conversion runs under (see `_worker_limits`)"""
+    options = [
+        click.option(
+            "--cube-timeout-minutes",
+            type=float,
+            default=60,
+            help="Defer cubes whose conversion takes longer than this. 0 disables",
+        ),
+        click.option(
+            "--cube-max-rss-mb",
+            type=int,
+            default=0,
+            help="Defer cubes whose conversion uses more memory than this. 0 disables",
+        ),
+        click.option(
+            "--worker-max-cubes",
+            type=int,
+            default=100,
+            help="Replace the conversion worker process after this many cubes",
+        ),
+        click.option(
+            "--large-cube-timeout-minutes",
+            type=float,
+            default=0,
+            help="The time limit for deferred cubes, retried at the end. 0 disables",
+        ),
+    ]
+    for option in reversed(options):
+        func = option(func)
+    return func
+
+
+def _worker_limits(
+    cube_timeout_minutes: float,
+    cube_max_rss_mb: int,
+    worker_max_cubes: int,
+    large_cube_timeout_minutes: float,
+) -> dict[str, Any]:
+    """
+    The PipelineOptions for the worker limit options. Without a time or
+    memory limit, cubes are converted in this process
+    """
+    cube_limits = None
+    if cube_timeout_minutes > 0 or cube_max_rss_mb > 0:
+        cube_limits = WorkerLimits(
+            seconds=cube_timeout_minutes * 60,
+            max_rss_bytes=cube_max_rss_mb * 1_024 * 1_024,
+            max_tasks=worker_max_cubes,
+        )
+    return {
+        "cube_limits": cube_limits,
+        "large_cube_limits": WorkerLimits(
+            seconds=large_cube_timeout_minutes * 60, max_tasks=1
+        ),
+    }
+
+
+archive_option = click.option(
+    "--archive",
+    envvar="STATCANDB_ARCHIVE",
+    default=None,
+    help=(
+        "Archive raw ZIP files in this directory, or under raw/ in the bucket "
+        "if 'bucket'"
+    ),
+)
+
+archive_keep_option = click.option(
+    "--archive-keep",
+    type=int,
+    default=DEFAULT_ARCHIVE_KEEP,
+    help="Keep this many archived versions of each product. 0 keeps them all",
+)
+
+
+def _open_archive(spec: Optional[str]) -> Optional[Archive]:
+    if spec is None:
+        return None
+    config = get_config()
+    s3 = get_s3(config) if spec == "bucket" else None
+    return open_archive(spec, s3, config.r2_bucket)
+
+
+observations_option = click.option(
+    "--observations/--no-observations",
+    default=False,
+    help="Also rewrite each cube's partition of the catalog-wide observations table",
+)
+
+rollups_option = click.option(
+    "--rollups/--no-rollups",
+    default=False,
+    help="Also write annual and quarterly rollups of monthly and quarterly cubes",
+)
+
+series_index_option = click.option(
+    "--series-index/--no-series-index",
+    default=False,
+    help=(
+        "Also write bloom filters and an index of the row groups holding each "
+        "COORDINATE and GEO, for reading single series"
+    ),
+)
 
-from ..cubes import (ProductMetadata, get_changed_pid_list, get_pid_list,
-                     process_cube, pull_cube)
+changes_option = click.option(
+    "--changes/--no-changes",
+    default=False,
+    help=(
+        "Diff each cube against its previous version in the bucket and publish "
+        "the inserted, updated, and deleted rows under changes/. Downloads the "
+        "previous version of every cube"
+    ),
+)
+
+
+@dataclass(frozen=True)
+class PipelineOptions:
+    """How `_pull_process_upload_cube` handles each cube"""
+
+    # If given, add each cube to the vectorId index in this directory
+    vector_index_dir: Optional[Path] = None
+    # If positive, compact each cube toward files of this size before upload
+    compact_target_bytes: int = 0
+    # Skip the download of cubes whose fingerprint matches the last pull
+    skip_unchanged: bool = False
+    # Publish the difference from the previous version of each cube
+    publish_changes: bool = False
+    # Rewrite each cube's partition of the observations dataset
+    update_observations: bool = False
+    # Write and upload the rollups of sub-annual cubes (see `statcandb.rollups`)
+    write_rollups: bool = False
+    # Write bloom filters and the series index (see `statcandb.series_index`)
+    series_index: bool = False
+    # If given, convert cubes in a worker process under these limits, and
+    # defer those which breach them to the large-cube lane
+    cube_limits: Optional[WorkerLimits] = None
+    # The limits of the large-cube lane. Each cube gets a fresh worker
+    large_cube_limits: WorkerLimits = WorkerLimits(max_tasks=1)
+    # If given, archive each raw ZIP file here (see `statcandb.archive`)
+    archive: Optional[Archive] = None
+    # How many versions of each product the archive keeps. 0 keeps them all
+    archive_keep: int = DEFAULT_ARCHIVE_KEEP
 
 
 @click.group("full")
@@ -49,15 +270,335 @@ def download_command(product_id: str, download_dir: str | None = None):
     default=None,
     help="Where to write the output",
 )
-def prepare_command(filename: str, outfile: str | None):
+@click.option(
+    "--latest/--no-latest",
+    default=True,
+    help="Also write the latest value of each series next to the output",
+)
+@click.option(
+    "--format",
+    "-f",
+    type=click.Choice(["parquet", "arrow", "both"]),
+    default="parquet",
+    help="Write parquet, memory-mappable Arrow IPC files, or both side by side",
+)
+@click.option(
+    "--compression",
+    type=click.Choice(["none", "lz4", "zstd"]),
+    default="none",
+    help="The compression of Arrow IPC files. Uncompressed files are zero-copy",
+)
+@click.option(
+    "--dimensions",
+    type=click.Choice(DIMENSION_MODES),
+    default="dictionary",
+    help=(
+        "Store label columns as plain strings, dictionary-encoded, or as integer "
+        "codes with the labels in a separate dimension table"
+    ),
+)
+@compact_target_mb_option
+@rollups_option
+@series_index_option
+def prepare_command(
+    filename: str,
+    outfile: str | None,
+    latest: bool,
+    format: str,
+    compression: str,
+    dimensions: str,
+    compact_target_mb: int,
+    rollups: bool,
+    series_index: bool,
+):
     """Prepare a cube from its ZIP file state to its parquet state"""
     filename = Path(filename)
 
     if outfile is None:
         outfile = Path.cwd() / "".join(x for x in Path(filename).name if x.isdigit())
-        outfile = outfile.with_suffix(".parquet")
+        outfile = outfile.with_suffix(".arrow" if format == "arrow" else ".parquet")
+
+    # Profiles of the stages are stored under the product id
+    key = Path(outfile).stem
+    with profile_stage("process", key):
+        process_cube(
+            filename,
+            outfile,
+            latest_outfile=latest_path_for(outfile) if latest else None,
+            format=format,
+            compression=None if compression == "none" else compression,
+            dimensions=dimensions,
+            bloom_filters=series_index,
+        )
+    if compact_target_mb > 0 and format != "arrow":
+        with profile_stage("compact", key):
+            report = compact_cube(outfile, compact_target_mb * 1_024 * 1_024)
+        click.echo(report)
+    if series_index and format != "arrow":
+        with profile_stage("series-index", key):
+            write_series_index(outfile)
+    if rollups:
+        with profile_stage("rollups", key):
+            paths = write_rollups(
+                outfile, format="arrow" if format == "arrow" else "parquet"
+            )
+        for frequency, path in paths.items():
+            click.echo(f"Wrote the {frequency} rollup to {path}")
+
+
+@full_group.command("compact")
+@click.argument("product_id", type=int)
+@click.option(
+    "--path",
+    type=click.Path(exists=True, file_okay=False, path_type=Path),
+    default=None,
+    help="Compact a cube on local disk rather than the uploaded one",
+)
+@click.option(
+    "--target-mb",
+    type=int,
+    default=DEFAULT_COMPACT_TARGET_BYTES // (1_024 * 1_024),
+    help="The size in MiB to aim for when merging year partitions",
+)
+@vector_index_dir_option
+def compact_command(
+    product_id: int,
+    path: Optional[Path],
+    target_mb: int,
+    vector_index_dir: Optional[Path],
+):
+    """
+    Merge the small year partitions of a cube into fewer, larger files
+
+    By default, compacts the cube already uploaded to the bucket. Pass --path
+    to compact a cube written by `statcandb full prepare` instead. Either way,
+    the cube's series index is rewritten, and with --vector-index-dir, its
+    vectors are re-indexed.
+    """
+    target_bytes = target_mb * 1_024 * 1_024
+    if path is not None:
+        report = compact_cube(path, target_bytes)
+        if vector_index_dir is not None and report.files_after != report.files_before:
+            add_to_vector_index(
+                vector_index_dir, index_cube(product_id, path), product_id
+            )
+    else:
+        config = get_config()
+        s3 = get_s3(config)
+        report = compact_uploaded_cube(
+            s3, config.r2_bucket, product_id, target_bytes, vector_index_dir
+        )
+        if report.files_after != report.files_before:
+            # Keep the manifest `statcandb audit` checks against up to date
+            manifest, _ = remote_manifest(s3, config.r2_bucket, product_id)
+            if manifest is not None:
+                with get_session(None) as session:
+                    record_manifest(session, product_id, manifest)
+                    session.commit()
+    click.echo(f"{product_id}: {report}")
+
+
+@full_group.command("observations")
+@click.argument("product_ids", type=int, nargs=-1, required=True)
+@click.option(
+    "--path",
+    type=click.Path(exists=True, file_okay=False, path_type=Path),
+    default=None,
+    help="Normalize a cube on local disk (with a single PRODUCT_ID)",
+)
+@click.option(
+    "--outdir",
+    type=click.Path(file_okay=False, path_type=Path),
+    default=None,
+    help="With --path, the root of the local observations dataset. Defaults to cwd",
+)
+def observations_command(
+    product_ids: tuple[int, ...], path: Optional[Path], outdir: Optional[Path]
+):
+    """
+    Build the partitions of the observations table for some products
+
+    By default, reads each cube from the bucket and uploads its partition.
+    Cubes refreshed by `delta` or `delta-by-diff` with --observations are kept
+    up to date without this.
+    """
+    if path is not None:
+        if len(product_ids) != 1:
+            raise click.UsageError("--path takes a single PRODUCT_ID")
+        outfile = (outdir or Path.cwd()) / observations_key(product_ids[0])
+        if not write_observations(path, outfile):
+            raise click.ClickException(f"{path} has no vectors")
+        click.echo(f"Wrote {outfile}")
+        return
+
+    config = get_config()
+    s3 = get_s3(config)
+    for product_id in tqdm(product_ids):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            tmpdir = Path(tmpdir)
+            cube_path = tmpdir / f"{product_id}.parquet"
+            if not download_prefix(
+                s3, config.r2_bucket, f"{product_id}.parquet/", cube_path
+            ):
+                click.echo(f"{product_id} isn't in the bucket. Continuing")
+                continue
+            observations_path = tmpdir / "observations.parquet"
+            if write_observations(cube_path, observations_path):
+                upload_observations(s3, config.r2_bucket, product_id, observations_path)
+
+
+def _finish_reprocess(
+    future: Future,
+    product_id: int,
+    path: Path,
+    s3,
+    bucket_name: str,
+    session,
+    compact_target_bytes: int,
+) -> bool:
+    try:
+        future.result()
+    except zipfile.BadZipFile:
+        click.echo(f"Bad zip file for {product_id}. Continuing")
+        return False
+    except pa.lib.ArrowInvalid:
+        click.echo(
+            f"The CSV appears to be badly constructed for {product_id}. Continuing"
+        )
+        return False
+
+    if compact_target_bytes > 0:
+        compact_cube(path, compact_target_bytes)
+    _upload_cube(s3, bucket_name, path)
+    record_manifest(session, product_id, local_manifest(path))
+    session.commit()
+    shutil.rmtree(path.parent)
+    return True
+
+
+def _reprocess_cubes(
+    product_ids: list[int],
+    archive: Archive,
+    s3,
+    bucket_name: str,
+    session,
+    workers: int,
+    compact_target_bytes: int = 0,
+) -> int:
+    """
+    Rebuild cubes from the newest version of their archived ZIP files. Cubes
+    are converted on a pool of processes while this process fetches ZIP files
+    and uploads finished cubes
+
+    Returns:
+        How many cubes were uploaded
+    """
+    release_times = dict(
+        session.execute(
+            select(Product.number, func.max(Product.release_time)).group_by(
+                Product.number
+            )
+        ).all()
+    )
+
+    success_count = 0
+    pending: dict[Future, tuple[int, Path]] = {}
+
+    def finish(futures):
+        nonlocal success_count
+        for future in futures:
+            product_id, path = pending.pop(future)
+            success_count += _finish_reprocess(
+                future, product_id, path, s3, bucket_name, session, compact_target_bytes
+            )
+
+    with tempfile.TemporaryDirectory() as tmpdir, ProcessPoolExecutor(
+        workers, mp_context=multiprocessing.get_context("spawn")
+    ) as pool:
+        tmpdir = Path(tmpdir)
+        for product_id in tqdm(product_ids):
+            versions = archive.versions(product_id)
+            if not versions:
+                click.echo(f"{product_id} isn't archived. Continuing")
+                continue
+
+            product_dir = tmpdir / str(product_id)
+            product_dir.mkdir()
+            zip_path = archive.fetch(versions[0], product_dir / f"{product_id}-eng.zip")
+            path = product_dir / f"{product_id}.parquet"
+            # Divide the budget evenly among the pool's processes
+            share = get_governor().share(workers=workers)
+            future = pool.submit(
+                run_with_share,
+                share,
+                process_cube,
+                zip_path,
+                path,
+                latest_outfile=latest_path_for(path),
+                release_time=release_times.get(product_id),
+            )
+            pending[future] = (product_id, path)
+
+            # Don't fetch ZIP files much faster than they can be converted
+            if len(pending) >= 2 * workers:
+                finish(wait(pending, return_when=FIRST_COMPLETED).done)
+        finish(list(pending))
+    return success_count
+
+
+@full_group.command("reprocess")
+@click.argument("product_ids", type=int, nargs=-1)
+@click.option(
+    "--all", "all_products", is_flag=True, help="Reprocess every archived product"
+)
+@click.option(
+    "--archive",
+    envvar="STATCANDB_ARCHIVE",
+    required=True,
+    help="The archive's directory, or 'bucket' for the archive in the bucket",
+)
+@click.option(
+    "--workers",
+    "-w",
+    type=int,
+    default=os.cpu_count(),
+    help="How many cubes to convert at once",
+)
+@compact_target_mb_option
+def reprocess_command(
+    product_ids: tuple[int, ...],
+    all_products: bool,
+    archive: str,
+    workers: int,
+    compact_target_mb: int,
+):
+    """
+    Rebuild cubes in the bucket from archived ZIP files, without downloading
+    anything from StatCan
+
+    Use after changing how cubes are processed. Products are added to the
+    archive by `delta` and `delta-by-diff` with --archive.
+    """
+    if not product_ids and not all_products:
+        raise click.UsageError("Pass some PRODUCT_IDS or --all")
+
+    config = get_config()
+    s3 = get_s3(config)
+    the_archive = open_archive(archive, s3, config.r2_bucket)
+    if all_products:
+        product_ids = the_archive.products()
 
-    process_cube(filename, outfile)
+    with get_session(None) as session:
+        success_count = _reprocess_cubes(
+            list(product_ids),
+            the_archive,
+            s3,
+            config.r2_bucket,
+            session,
+            workers,
+            compact_target_mb * 1_024 * 1_024,
+        )
+    click.echo(f"Reprocessed {success_count} out of {len(product_ids)} products")
 
 
 @full_group.command("push")
@@ -93,22 +634,158 @@ def push_command(path: str):
                     Callback=lambda b: inner_pbar.update(b),
                 )
 
+    for sidecar_path in [
+        latest_path_for(path),
+        dimensions_path_for(path),
+        series_index_path_for(path),
+        *rollup_paths(path),
+    ]:
+        if sidecar_path.exists():
+            s3.upload_file(str(sidecar_path), config.r2_bucket, sidecar_path.name)
+
+
+def _sidecar_paths(path: Path) -> list[Path]:
+    """
+    Where the files `_upload_cube` uploads next to a cube would be, whether
+    or not they were built
+    """
+    return [
+        latest_path_for(path),
+        series_index_path_for(path),
+        *(rollup_path_for(path, frequency) for frequency in FREQUENCIES),
+    ]
+
+
+def _upload_cube(s3, bucket_name: str, path: Path):
+    """
+    Replace a cube in the bucket with the one processed into path, along with
+    its sidecars. Sidecars of the old version which weren't rebuilt are
+    deleted, since they'd describe files which no longer exist
+    """
+    product_id_path = path.name
+
+    objects = s3.list_objects_v2(Bucket=bucket_name, Prefix=f"{product_id_path}/")
+    keys = [{"Key": obj["Key"]} for obj in objects.get("Contents", [])]
+    stale = {p.name for p in _sidecar_paths(path) if not p.exists()}
+    objects = s3.list_objects_v2(Bucket=bucket_name, Prefix=f"{path.stem}.")
+    keys += [
+        {"Key": obj["Key"]}
+        for obj in objects.get("Contents", [])
+        if obj["Key"] in stale
+    ]
+    if keys:
+        s3.delete_objects(Bucket=bucket_name, Delete={"Objects": keys})
+
+    for filepath in tqdm(
+        list(path.rglob("*.parquet")), desc="Uploading files", leave=False
+    ):
+        if filepath.is_file():
+            with tqdm(
+                desc=filepath.name,
+                total=filepath.stat().st_size,
+                unit="iB",
+                unit_scale=True,
+                unit_divisor=1_024,
+                leave=False,
+            ) as inner_pbar:
+                s3.upload_file(
+                    str(filepath),
+                    bucket_name,
+                    f"{product_id_path}/{filepath.relative_to(path)}",
+                    Callback=lambda b: inner_pbar.update(b),
+                )
+
+    # The latest value table sits next to the cube, e.g., 14100287.latest.parquet,
+    # as do its series index and rollups, e.g., 14100287.rollup-annual.parquet
+    for sidecar_path in _sidecar_paths(path):
+        if sidecar_path.exists():
+            s3.upload_file(str(sidecar_path), bucket_name, sidecar_path.name)
+
 
 def _pull_process_upload_cube(
-    product: ProductMetadata, s3, bucket_name: str, session
+    product: ProductMetadata,
+    s3,
+    bucket_name: str,
+    session,
+    options: PipelineOptions = PipelineOptions(),
+    worker: Optional[CubeWorker] = None,
+    heartbeat: Optional[LeaseHeartbeat] = None,
 ) -> bool:
+    """
+    Pull, process, and upload a single cube
+
+    Args:
+        worker: If given, run the conversion in this worker process
+        heartbeat: If given, the heartbeat of this worker's lease on the
+            product. The cube isn't uploaded if the lease has been lost
+
+    Returns:
+        Whether the cube was uploaded (or was unchanged)
+
+    Raises:
+        LimitExceeded: If the conversion breached the worker's limits
+    """
     product_id = product.product_id
-    with tempfile.TemporaryDirectory() as tmpdir:
+    start_time = time.monotonic()
+    # Counted as a worker, so cubes processed at once split the budget
+    with get_governor().worker() as share, tempfile.TemporaryDirectory() as tmpdir:
         tmpdir = Path(tmpdir)
         try:
-            pull_cube(product_id, download_dir=tmpdir, verbose=True)
-        except requests.exceptions.HTTPError:
+            url = get_cube_url(product_id)
+            if options.skip_unchanged:
+                fingerprint = get_remote_fingerprint(url, product_id)
+                if fingerprint is not None and fingerprint == get_stored_fingerprint(
+                    session, product_id
+                ):
+                    click.echo(f"{product_id} is unchanged. Updating its release time")
+                    session.add(
+                        Product(product_id, product.release_time, is_uploaded=True)
+                    )
+                    session.commit()
+                    return True
+            with profile_stage("download", product_id):
+                download_file(url, download_dir=tmpdir, verbose=True)
+        except requests.exceptions.RequestException:
             click.echo(f"Problem downloading {product_id}. Continuing")
             return False
 
         path = tmpdir / f"{product_id}.parquet"
+        zip_path = tmpdir / f"{product_id}-eng.zip"
+        latest_path = latest_path_for(path)
+        if options.archive is not None:
+            # Best-effort: a failure to archive doesn't stop the cube being
+            # processed
+            try:
+                options.archive.put(product_id, zip_path)
+                if options.archive_keep > 0:
+                    options.archive.prune(product_id, options.archive_keep)
+            except Exception as e:
+                click.echo(f"Problem archiving {product_id}: {e!r}. Continuing")
+
         try:
-            process_cube(tmpdir / f"{product_id}-eng.zip", path)
+            if worker is not None:
+                # Give the worker process this cube's share of the budget
+                convert = partial(worker.run, run_with_share, share)
+            else:
+                convert = _call
+            # Profiled in the worker process, if there is one
+            convert(
+                profiled,
+                "process",
+                product_id,
+                process_cube,
+                zip_path,
+                path,
+                latest_outfile=latest_path,
+                release_time=product.release_time,
+                bloom_filters=options.series_index,
+            )
+            if options.write_rollups:
+                try:
+                    convert(profiled, "rollups", product_id, write_rollups, path)
+                except LimitExceeded as e:
+                    # The cube itself converted, so don't defer all of it
+                    click.echo(f"Skipping the rollups of {product_id}: {e}")
         except zipfile.BadZipFile:
             click.echo(f"Bad zip file for {product_id}. Continuing")
             return False
@@ -118,33 +795,73 @@ def _pull_process_upload_cube(
             )
             return False
 
-        product_id_path = path.name
-
-        objects = s3.list_objects_v2(Bucket=bucket_name, Prefix=f"{product_id_path}/")
-        keys = [{"Key": obj["Key"]} for obj in objects.get("Contents", [])]
-        if keys:
-            s3.delete_objects(Bucket=bucket_name, Delete={"Objects": keys})
-
-        for filepath in tqdm(
-            list(path.rglob("*.parquet")), desc="Uploading files", leave=False
-        ):
-            if filepath.is_file():
-                with tqdm(
-                    desc=filepath.name,
-                    total=filepath.stat().st_size,
-                    unit="iB",
-                    unit_scale=True,
-                    unit_divisor=1_024,
-                    leave=False,
-                ) as inner_pbar:
-                    s3.upload_file(
-                        str(filepath),
-                        bucket_name,
-                        f"{product_id_path}/{filepath.relative_to(path)}",
-                        Callback=lambda b: inner_pbar.update(b),
-                    )
+        # A failure here leaves the cube unrecorded, so it's pulled again next
+        # time, rather than ending the run
+        try:
+            if options.compact_target_bytes > 0:
+                with profile_stage("compact", product_id):
+                    compact_cube(path, options.compact_target_bytes)
+            if options.series_index:
+                with profile_stage("series-index", product_id):
+                    write_series_index(path)
+
+            if heartbeat is not None and heartbeat.lost.is_set():
+                click.echo(f"Lost the lease on {product_id} to another worker")
+                return False
+
+            product_id_path = path.name
+
+            changes_path = tmpdir / f"{product_id}.changes.parquet"
+            changes = None
+            if options.publish_changes:
+                # The previous version has to be read before it's deleted below
+                previous_path = tmpdir / "previous" / product_id_path
+                if download_prefix(
+                    s3, bucket_name, f"{product_id_path}/", previous_path
+                ):
+                    with profile_stage("changes", product_id):
+                        changes = diff_cubes(previous_path, path, changes_path)
+                    click.echo(f"{product_id}: {changes}")
+
+            with profile_stage("upload", product_id):
+                _upload_cube(s3, bucket_name, path)
+
+            # Published and committed before anything else can fail, since once
+            # the cube is uploaded, pulling it again would find nothing changed
+            if changes is not None and changes.total > 0:
+                publish_changes(
+                    s3, bucket_name, session, product_id, changes_path, changes
+                )
+                session.commit()
+
+            if options.vector_index_dir is not None:
+                add_to_vector_index(
+                    options.vector_index_dir, index_cube(product_id, path), product_id
+                )
+
+            if options.update_observations:
+                observations_path = tmpdir / f"{product_id}.observations.parquet"
+                if write_observations(path, observations_path):
+                    upload_observations(s3, bucket_name, product_id, observations_path)
+        except Exception as e:
+            session.rollback()
+            click.echo(f"Problem post-processing {product_id}: {e!r}. Continuing")
+            return False
 
         session.add(Product(product_id, product.release_time, is_uploaded=True))
+        fingerprint = get_local_fingerprint(zip_path, product_id)
+        if fingerprint is not None:
+            session.add(CubeFingerprint(product_id, fingerprint))
+        manifest = local_manifest(path)
+        record_manifest(session, product_id, manifest)
+        session.add(
+            CubeStat(
+                product_id,
+                zip_bytes=zip_path.stat().st_size,
+                row_count=manifest.row_count,
+                seconds=time.monotonic() - start_time,
+            )
+        )
         session.commit()
         return True
 
@@ -161,24 +878,188 @@ def get_session(session: Optional[Any]):
             yield session
 
 
+def _call(func, *args, **kwargs):
+    return func(*args, **kwargs)
+
+
+@contextmanager
+def _cube_worker(limits: Optional[WorkerLimits]):
+    if limits is None:
+        yield None
+    else:
+        with CubeWorker(limits) as worker:
+            yield worker
+
+
+def _defer(session, product_id: int, e: LimitExceeded):
+    click.echo(f"Deferring {product_id}: {e}")
+    session.add(CubeDeferral(product_id, e.reason))
+    session.commit()
+
+
+def _pull_process_upload_large_cubes(
+    products: list[ProductMetadata],
+    s3,
+    bucket_name: str,
+    session,
+    options: PipelineOptions,
+    heartbeat: Optional[LeaseHeartbeat] = None,
+) -> list[ProductMetadata]:
+    """
+    The large-cube lane: retry deferred products one at a time, each in a
+    fresh worker under options.large_cube_limits
+
+    Returns:
+        The products uploaded
+    """
+    if not products:
+        return []
+
+    click.echo(f"Retrying {len(products)} deferred products in the large-cube lane")
+    uploaded = []
+    with CubeWorker(options.large_cube_limits) as worker:
+        for product in tqdm(products):
+            try:
+                if _pull_process_upload_cube(
+                    product, s3, bucket_name, session, options, worker, heartbeat
+                ):
+                    uploaded.append(product)
+            except LimitExceeded as e:
+                click.echo(f"{product.product_id} failed in the large-cube lane: {e}")
+    return uploaded
+
+
 def _pull_process_upload_cube_list(
-    products: list[ProductMetadata], skip: list[str] = [], session: Optional[Any] = None
+    products: list[ProductMetadata],
+    skip: list[str] = [],
+    session: Optional[Any] = None,
+    options: PipelineOptions = PipelineOptions(),
 ) -> int:
+    return len(_pull_process_upload_cubes(products, skip, session, options))
+
+
+def _pull_process_upload_cubes(
+    products: list[ProductMetadata],
+    skip: list[str] = [],
+    session: Optional[Any] = None,
+    options: PipelineOptions = PipelineOptions(),
+) -> list[ProductMetadata]:
+    """
+    Like _pull_process_upload_cube_list, but returns the products uploaded
+    (or found unchanged) rather than how many
+    """
     config = get_config()
     s3 = get_s3(config)
 
     skip = [int(x) for x in skip]
-    success_count = 0
-    with get_session(session) as session:
+    uploaded = []
+    deferred = []
+    with get_session(session) as session, _cube_worker(options.cube_limits) as worker:
         for product in (pbar := tqdm(products)):
             product_id = product.product_id
             if product_id in skip:
                 click.echo(f"Skipping {product_id}")
                 continue
             pbar.set_description(f"{product_id}")
-            success_count += _pull_process_upload_cube(
-                product, s3, config.r2_bucket, session
-            )
+            try:
+                if _pull_process_upload_cube(
+                    product, s3, config.r2_bucket, session, options, worker
+                ):
+                    uploaded.append(product)
+            except LimitExceeded as e:
+                _defer(session, product_id, e)
+                deferred.append(product)
+
+        uploaded += _pull_process_upload_large_cubes(
+            deferred, s3, config.r2_bucket, session, options
+        )
+    return uploaded
+
+
+def _pull_process_upload_cube_list_with_leases(
+    products: list[ProductMetadata],
+    worker_id: str,
+    lease_seconds: int,
+    poll_seconds: int,
+    skip: list[str] = [],
+    session: Optional[Any] = None,
+    options: PipelineOptions = PipelineOptions(),
+) -> int:
+    """
+    Like _pull_process_upload_cube_list, but only process the products this
+    worker manages to claim. Keeps going until every product has been finished
+    by _some_ worker, so that the products of dead workers are picked up once
+    their leases expire.
+
+    A deferred product is retried in the large-cube lane straight away, while
+    this worker still holds its lease. A product that fails is released rather
+    than finished, so that it is retried by a later run (or another worker),
+    but this worker doesn't try it again.
+    """
+    config = get_config()
+    s3 = get_s3(config)
+
+    skip = [int(x) for x in skip]
+    success_count = 0
+    failed = set()
+    with get_session(session) as session, _cube_worker(options.cube_limits) as worker:
+        engine = session.get_bind()
+        remaining = [p for p in products if p.product_id not in skip]
+        while remaining:
+            claimed_any = False
+            for product in (pbar := tqdm(remaining)):
+                product_id = product.product_id
+                if not claim_lease(session, product, worker_id, lease_seconds):
+                    continue
+
+                claimed_any = True
+                pbar.set_description(f"{product_id}")
+                try:
+                    with LeaseHeartbeat(
+                        engine, product_id, worker_id, lease_seconds
+                    ) as heartbeat:
+                        try:
+                            succeeded = _pull_process_upload_cube(
+                                product,
+                                s3,
+                                config.r2_bucket,
+                                session,
+                                options,
+                                worker,
+                                heartbeat,
+                            )
+                        except LimitExceeded as e:
+                            _defer(session, product_id, e)
+                            succeeded = bool(
+                                _pull_process_upload_large_cubes(
+                                    [product],
+                                    s3,
+                                    config.r2_bucket,
+                                    session,
+                                    options,
+                                    heartbeat,
+                                )
+                            )
+                except BaseException:
+                    release_lease(session, product_id, worker_id)
+                    raise
+                if succeeded:
+                    success_count += 1
+                    finish_lease(session, product_id, worker_id)
+                else:
+                    failed.add(product_id)
+                    release_lease(session, product_id, worker_id)
+
+            remaining = [
+                p
+                for p in unfinished_products(session, remaining)
+                if p.product_id not in failed
+            ]
+            if remaining and not claimed_any:
+                click.echo(
+                    f"Waiting on {len(remaining)} products claimed by other workers"
+                )
+                time.sleep(poll_seconds)
     return success_count
 
 
@@ -186,7 +1067,34 @@ def _pull_process_upload_cube_list(
 @click.option("--start-date", "-s", type=str, default=None)
 @click.option("--end-date", "-e", type=str, default=None)
 @click.option("--skip", "-k", type=int, multiple=True, default=[])
-def delta_command(start_date: Optional[str], end_date: Optional[str], skip: List[str]):
+@vector_index_dir_option
+@compact_target_mb_option
+@skip_unchanged_option
+@changes_option
+@observations_option
+@rollups_option
+@series_index_option
+@worker_limit_options
+@archive_option
+@archive_keep_option
+def delta_command(
+    start_date: Optional[str],
+    end_date: Optional[str],
+    skip: List[str],
+    vector_index_dir: Optional[Path],
+    compact_target_mb: int,
+    skip_unchanged: bool,
+    changes: bool,
+    observations: bool,
+    rollups: bool,
+    series_index: bool,
+    cube_timeout_minutes: float,
+    cube_max_rss_mb: int,
+    worker_max_cubes: int,
+    large_cube_timeout_minutes: float,
+    archive: Optional[str],
+    archive_keep: int,
+):
     """
     Only pull updated cubes between start-date and end-date (inclusive)
 
@@ -217,7 +1125,24 @@ def delta_command(start_date: Optional[str], end_date: Optional[str], skip: List
     ]
 
     click.echo(f"Pulling {len(product_ids)} product_ids")
-    success_count = _pull_process_upload_cube_list(product_ids, skip)
+    options = PipelineOptions(
+        vector_index_dir=vector_index_dir,
+        compact_target_bytes=compact_target_mb * 1_024 * 1_024,
+        skip_unchanged=skip_unchanged,
+        publish_changes=changes,
+        update_observations=observations,
+        write_rollups=rollups,
+        series_index=series_index,
+        **_worker_limits(
+            cube_timeout_minutes,
+            cube_max_rss_mb,
+            worker_max_cubes,
+            large_cube_timeout_minutes,
+        ),
+        archive=_open_archive(archive),
+        archive_keep=archive_keep,
+    )
+    success_count = _pull_process_upload_cube_list(product_ids, skip, options=options)
     click.echo(
         f"Successfully uploaded {success_count} out of {len(product_ids)} products"
     )
@@ -237,17 +1162,122 @@ def delta_command(start_date: Optional[str], end_date: Optional[str], skip: List
     default=0,
     help="Only download product ids which are at least this number",
 )
-def delta_by_diff_command(skip: List[str], max_product_ids: int, start_from: int):
+@click.option(
+    "--shard",
+    type=str,
+    default=None,
+    help="Only pull products in shard i/n (0-indexed), e.g., 3/8",
+)
+@click.option(
+    "--worker",
+    is_flag=True,
+    default=False,
+    help="Claim products from the shared lease table so several nodes can run at once",
+)
+@click.option(
+    "--worker-id",
+    type=str,
+    default=None,
+    help="The name of this worker in the lease table. Defaults to host name + random",
+)
+@click.option(
+    "--lease-seconds",
+    type=int,
+    default=DEFAULT_LEASE_SECONDS,
+    help="How long a claim lasts without a heartbeat",
+)
+@click.option(
+    "--poll-seconds",
+    type=int,
+    default=30,
+    help="How long to wait for other workers before checking for expired claims",
+)
+@click.option(
+    "--order",
+    type=click.Choice(["size", "id"]),
+    default="size",
+    help="Pull the largest products first (size) or in product id order (id)",
+)
+@click.option(
+    "--priority",
+    "-p",
+    type=int,
+    multiple=True,
+    default=[],
+    help="Products to pull before all others",
+)
+@click.option(
+    "--head-sizes",
+    is_flag=True,
+    default=False,
+    help="Ask StatCan for the size of products which have never been pulled",
+)
+@click.option(
+    "--small-lane-every",
+    type=int,
+    default=DEFAULT_SMALL_LANE_EVERY,
+    help="With --order size, every this many products pull the smallest one left",
+)
+@vector_index_dir_option
+@compact_target_mb_option
+@skip_unchanged_option
+@changes_option
+@observations_option
+@rollups_option
+@series_index_option
+@worker_limit_options
+@archive_option
+@archive_keep_option
+def delta_by_diff_command(
+    skip: List[str],
+    max_product_ids: int,
+    start_from: int,
+    shard: Optional[str],
+    worker: bool,
+    worker_id: Optional[str],
+    lease_seconds: int,
+    poll_seconds: int,
+    order: str,
+    priority: List[int],
+    head_sizes: bool,
+    small_lane_every: int,
+    vector_index_dir: Optional[Path],
+    compact_target_mb: int,
+    skip_unchanged: bool,
+    changes: bool,
+    observations: bool,
+    rollups: bool,
+    series_index: bool,
+    cube_timeout_minutes: float,
+    cube_max_rss_mb: int,
+    worker_max_cubes: int,
+    large_cube_timeout_minutes: float,
+    archive: Optional[str],
+    archive_keep: int,
+):
     """
     Pull all cubes which were either:
         * Not uploaded; or
         * Have a release time in our database earlier than statcan's
           metadata's release time
+
+    To spread the work across several nodes, either give each node a
+    different --shard, or run every node with --worker against the same
+    database.
+
+    By default, products are pulled largest first (based on the sizes seen the
+    last time they were pulled) so that a huge cube doesn't start at the very end.
     """
     config = get_config()
     skip = [int(x) for x in skip]
     start_from = int(start_from)
 
+    if shard:
+        try:
+            shard_index, shard_count = parse_shard(shard)
+        except ValueError as e:
+            raise click.BadParameter(str(e), param_hint="--shard")
+
     # Get all products
     all_product_ids = get_pid_list()
 
@@ -269,6 +1299,9 @@ def delta_by_diff_command(skip: List[str], max_product_ids: int, start_from: int
             )
         )
 
+        if shard:
+            to_pull = filter_shard(to_pull, shard_index, shard_count)
+
         click.echo(f"Need to pull {len(to_pull)} product ids")
         if max_product_ids > 0 and len(to_pull) > max_product_ids:
             to_pull = to_pull[:max_product_ids]
@@ -276,7 +1309,48 @@ def delta_by_diff_command(skip: List[str], max_product_ids: int, start_from: int
                 f"More products than allowed to upload. Uploading only {max_product_ids}"
             )
 
-        success_count = _pull_process_upload_cube_list(to_pull, skip, session=session)
+        if order == "size":
+            costs = estimate_costs(
+                to_pull, session, get_size=get_cube_size if head_sizes else None
+            )
+        else:
+            # No costs and no small lane is plain product id order
+            costs, small_lane_every = {}, 0
+        to_pull = schedule(
+            to_pull, costs, priority=priority, small_lane_every=small_lane_every
+        )
+
+        options = PipelineOptions(
+            vector_index_dir=vector_index_dir,
+            compact_target_bytes=compact_target_mb * 1_024 * 1_024,
+            skip_unchanged=skip_unchanged,
+            publish_changes=changes,
+            update_observations=observations,
+            write_rollups=rollups,
+            series_index=series_index,
+            **_worker_limits(
+                cube_timeout_minutes,
+                cube_max_rss_mb,
+                worker_max_cubes,
+                large_cube_timeout_minutes,
+            ),
+            archive=_open_archive(archive),
+            archive_keep=archive_keep,
+        )
+        if worker:
+            success_count = _pull_process_upload_cube_list_with_leases(
+                to_pull,
+                worker_id or default_worker_id(),
+                lease_seconds,
+                poll_seconds,
+                skip,
+                session=session,
+                options=options,
+            )
+        else:
+            success_count = _pull_process_upload_cube_list(
+                to_pull, skip, session=session, options=options
+            )
         click.echo(
             f"Successfully uploaded {success_count} out of {len(to_pull)} products"
         )
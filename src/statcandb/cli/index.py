@@ -0,0 +1,72 @@
+from pathlib import Path
+from typing import Optional
+
+import click
+
+from statcandb.vector_index import (
+    add_to_vector_index,
+    compact_vector_index,
+    index_cube,
+    index_delta_split,
+    lookup_vector,
+)
+
+index_dir_option = click.option(
+    "--index-dir",
+    "-i",
+    envvar="STATCANDB_VECTOR_INDEX_DIR",
+    required=True,
+    help="The directory holding the vectorId index",
+)
+
+
+@click.group("index")
+def index_group():
+    """Dealing with the global vectorId index"""
+
+
+@index_group.command("cube")
+@index_dir_option
+@click.argument("product_id", type=int)
+@click.argument("path")
+def index_cube_command(index_dir: str, product_id: int, path: str):
+    """Add a processed cube to the index, replacing its old entries"""
+    entries = index_cube(product_id, path)
+    add_to_vector_index(index_dir, entries, replace_product=product_id)
+    click.echo(f"Indexed {entries.num_rows} entries for {product_id}")
+
+
+@index_group.command("delta")
+@index_dir_option
+@click.argument("path")
+@click.option(
+    "--prefix",
+    default=None,
+    help="The path to record for the split delta file. Defaults to its name",
+)
+def index_delta_command(index_dir: str, path: str, prefix: Optional[str]):
+    """Add a delta file split into parquet by `statcandb delta split` to the index"""
+    entries = index_delta_split(path, prefix=prefix)
+    add_to_vector_index(index_dir, entries, replace_product=None)
+    click.echo(f"Indexed {entries.num_rows} entries for {Path(path).name}")
+
+
+@index_group.command("compact")
+@index_dir_option
+def compact_command(index_dir: str):
+    """Merge pending additions into the sorted index"""
+    num_rows = compact_vector_index(index_dir)
+    click.echo(f"Index has {num_rows} entries")
+
+
+@index_group.command("lookup")
+@index_dir_option
+@click.argument("vector_id")
+def lookup_command(index_dir: str, vector_id: str):
+    """Show where a vector lives. The vector may be given with or without its v"""
+    tab = lookup_vector(index_dir, int(vector_id.lstrip("vV")))
+    for row in tab.to_pylist():
+        click.echo(
+            f"{row['productId']}\t{row['coordinate']}\t{row['source']}\t"
+            f"{row['path']}\t{row['row_group']}"
+        )
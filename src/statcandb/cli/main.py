@@ -1,24 +1,45 @@
+from pathlib import Path
+from typing import Optional
+
 import click
 from dotenv import load_dotenv
 
 from statcandb.config import set_config_from_env
+from statcandb.profiling import PROFILE_ENV_VAR, set_profile_dir
 
+from .audit import audit_command
 from .db import db_group
 from .delta import delta_group
+from .flight import serve_flight_command
 from .full import full_group
+from .index import index_group
+from .refresh import serve_refresh_command
 
 load_dotenv()
 set_config_from_env()
 
 
 @click.group()
-def cli():
+@click.option(
+    "--profile",
+    "profile_dir",
+    envvar=PROFILE_ENV_VAR,
+    type=click.Path(file_okay=False, path_type=Path),
+    default=None,
+    help="Write a CPU profile and allocation summary of each stage to this directory",
+)
+def cli(profile_dir: Optional[Path]):
     """Basic CLI wrapper"""
+    set_profile_dir(profile_dir)
 
 
 cli.add_command(delta_group)
 cli.add_command(full_group)
 cli.add_command(db_group)
+cli.add_command(index_group)
+cli.add_command(audit_command)
+cli.add_command(serve_refresh_command)
+cli.add_command(serve_flight_command)
 
 if __name__ == "__main__":
     cli()
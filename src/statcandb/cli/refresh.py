@@ -0,0 +1,184 @@
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+from typing import List, Optional
+
+import click
+
+from statcandb.cubes import ProductMetadata, get_changed_pid_list
+from statcandb.materialize import latest_release_times
+from statcandb.refresh import RefreshWindow, freshness, serve_freshness, serve_refresh
+
+from .full import (
+    PipelineOptions,
+    _open_archive,
+    _pull_process_upload_cubes,
+    _worker_limits,
+    archive_keep_option,
+    archive_option,
+    changes_option,
+    compact_target_mb_option,
+    get_session,
+    observations_option,
+    rollups_option,
+    series_index_option,
+    skip_unchanged_option,
+    vector_index_dir_option,
+    worker_limit_options,
+)
+
+
+@click.command("serve-refresh")
+@click.option("--skip", "-k", type=int, multiple=True, default=[])
+@click.option(
+    "--poll-seconds",
+    type=float,
+    default=RefreshWindow.poll_seconds,
+    help="How often to poll the changed cube list while cubes keep appearing",
+)
+@click.option(
+    "--max-poll-seconds",
+    type=float,
+    default=RefreshWindow.max_poll_seconds,
+    help="How far to back off polling while no new cubes appear",
+)
+@click.option(
+    "--window-minutes",
+    type=float,
+    default=RefreshWindow.duration_seconds / 60,
+    help="How long after the 08:30 ET release to keep polling",
+)
+@click.option(
+    "--port",
+    type=int,
+    default=0,
+    help="If given, serve the freshness of each product at GET /freshness",
+)
+@vector_index_dir_option
+@compact_target_mb_option
+@skip_unchanged_option
+@changes_option
+@observations_option
+@rollups_option
+@series_index_option
+@worker_limit_options
+@archive_option
+@archive_keep_option
+def serve_refresh_command(
+    skip: List[int],
+    poll_seconds: float,
+    max_poll_seconds: float,
+    window_minutes: float,
+    port: int,
+    vector_index_dir: Optional[Path],
+    compact_target_mb: int,
+    skip_unchanged: bool,
+    changes: bool,
+    observations: bool,
+    rollups: bool,
+    series_index: bool,
+    cube_timeout_minutes: float,
+    cube_max_rss_mb: int,
+    worker_max_cubes: int,
+    large_cube_timeout_minutes: float,
+    archive: Optional[str],
+    archive_keep: int,
+):
+    """
+    Pull cubes as soon as StatCan releases them
+
+    Sleeps until each weekday's 08:30 ET release, then polls the changed cube
+    list and pulls each newly released cube, one batch at a time in the
+    background, until the window closes.
+    """
+    window = RefreshWindow(
+        poll_seconds=poll_seconds,
+        max_poll_seconds=max_poll_seconds,
+        duration_seconds=window_minutes * 60,
+    )
+    options = PipelineOptions(
+        vector_index_dir=vector_index_dir,
+        compact_target_bytes=compact_target_mb * 1_024 * 1_024,
+        skip_unchanged=skip_unchanged,
+        publish_changes=changes,
+        update_observations=observations,
+        write_rollups=rollups,
+        series_index=series_index,
+        **_worker_limits(
+            cube_timeout_minutes,
+            cube_max_rss_mb,
+            worker_max_cubes,
+            large_cube_timeout_minutes,
+        ),
+        archive=_open_archive(archive),
+        archive_keep=archive_keep,
+    )
+
+    # Dispatched releases which haven't finished uploading
+    pending: set[ProductMetadata] = set()
+    # Those of them which failed, until they're dispatched again
+    failed: set[ProductMetadata] = set()
+    lock = threading.Lock()
+
+    def get_known(product_ids: list[int]):
+        with get_session(None) as session:
+            return latest_release_times(session, product_ids)
+
+    def get_freshness():
+        with lock:
+            still_pending = list(pending)
+        with get_session(None) as session:
+            return freshness(session, still_pending)
+
+    def get_failed():
+        with lock:
+            return list(failed)
+
+    def dispatch(products: list[ProductMetadata]):
+        with lock:
+            pending.update(products)
+            failed.difference_update(products)
+
+        def finished(future: Future):
+            if future.exception() is not None:
+                click.echo(f"Refreshing failed: {future.exception()}")
+                uploaded = []
+            else:
+                uploaded = future.result()
+            # Failed releases stay pending, so /freshness keeps counting them
+            # as behind, until they're retried
+            skipped = [p for p in products if p.product_id in skip]
+            with lock:
+                pending.difference_update(uploaded + skipped)
+                failed.update(pending.intersection(products))
+            if len(uploaded) < len(products) - len(skipped):
+                click.echo(
+                    f"{len(products) - len(skipped) - len(uploaded)} products failed "
+                    "to refresh and will be retried"
+                )
+            for entry in get_freshness():
+                if entry.product_id in {p.product_id for p in uploaded}:
+                    click.echo(
+                        f"{entry.product_id} is {entry.lag_seconds / 60:,.1f} "
+                        "minutes behind its release"
+                    )
+
+        future = pipeline.submit(
+            _pull_process_upload_cubes, products, list(skip), options=options
+        )
+        future.add_done_callback(finished)
+
+    if port:
+        serve_freshness(port, get_freshness)
+        click.echo(f"Serving freshness at http://localhost:{port}/freshness")
+
+    # One batch at a time, so polling carries on while cubes are pulled
+    with ThreadPoolExecutor(1) as pipeline:
+        serve_refresh(
+            window,
+            get_changed_pid_list,
+            get_known,
+            dispatch,
+            log=click.echo,
+            get_failed=get_failed,
+        )
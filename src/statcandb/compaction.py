@@ -0,0 +1,216 @@
+"""
+Compacting cubes with many small `year=` partitions.
+
+`process_cube` partitions every cube over 10 MiB by year. For cubes with long,
+sparse histories, this leads to hundreds of tiny files, and every reader pays a
+request and a footer read for each one. Compaction merges runs of adjacent
+years into files of about a target size. The result uses the same layout as
+unpartitioned cubes: files at the root of the cube (part-0.parquet,
+part-1.parquet, ...) with `year` stored as an integer column, the type readers
+of the `year=` partitions (e.g., DuckDB) gave it. Rows are sorted by year,
+so parquet statistics still let readers skip years they don't need. Bloom
+filters (see `statcandb.series_index`) are kept if the cube had them.
+
+The series index and vectorId index point at the cube's files, so they are
+rebuilt whenever compaction changes the file set.
+"""
+import tempfile
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Optional, Union
+
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+from statcandb.s3 import download_prefix, list_objects
+from statcandb.series_index import (
+    SERIES_SORT_KEYS,
+    bloom_filter_columns,
+    bloom_filter_options,
+    series_index_path_for,
+    write_series_index,
+)
+from statcandb.vector_index import add_to_vector_index, index_cube
+
+DEFAULT_COMPACT_TARGET_BYTES = 64 * 1_024 * 1_024  # 64 MiB
+
+
+@dataclass(frozen=True)
+class CompactionReport:
+    files_before: int
+    files_after: int
+    bytes_before: int
+    bytes_after: int
+
+    @property
+    def requests_before(self) -> int:
+        """
+        Estimated requests for a full scan of the cube before compaction: one LIST,
+        then a footer read and a data read per file
+        """
+        return 1 + 2 * self.files_before
+
+    @property
+    def requests_after(self) -> int:
+        """Estimated requests for a full scan of the cube after compaction"""
+        return 1 + 2 * self.files_after
+
+    def __str__(self) -> str:
+        return (
+            f"{self.files_before} files ({self.bytes_before:,} bytes) -> "
+            f"{self.files_after} files ({self.bytes_after:,} bytes); "
+            f"a full scan takes ~{self.requests_after} requests instead of "
+            f"~{self.requests_before}"
+        )
+
+
+def group_adjacent(sizes: list[int], target_bytes: int) -> list[list[int]]:
+    """
+    Group adjacent items into runs whose total size is about target_bytes
+
+    Args:
+        sizes: The sizes of each item, in order
+        target_bytes: The size to aim for
+
+    Returns:
+        The indices of the items in each group
+    """
+    groups: list[list[int]] = []
+    current: list[int] = []
+    current_size = 0
+    for i, size in enumerate(sizes):
+        if current and current_size + size > target_bytes:
+            groups.append(current)
+            current, current_size = [], 0
+        current.append(i)
+        current_size += size
+    if current:
+        groups.append(current)
+    return groups
+
+
+def _size(path: Path) -> int:
+    return sum(f.stat().st_size for f in path.rglob("*") if f.is_file())
+
+
+def compact_cube(
+    cube_path: Union[str, Path], target_bytes: int = DEFAULT_COMPACT_TARGET_BYTES
+) -> CompactionReport:
+    """
+    Compact a cube written by `process_cube` in place.
+
+    Cubes which aren't partitioned by year, or where compaction wouldn't reduce
+    the number of files, are left alone. A series index next to the cube is
+    rewritten to point at the new files.
+
+    Args:
+        cube_path: The directory the cube was written to
+        target_bytes: The size to aim for when merging years
+
+    Returns:
+        What changed
+    """
+    cube_path = Path(cube_path)
+    files = [f for f in cube_path.rglob("*") if f.is_file()]
+    total_size = _size(cube_path)
+    unchanged = CompactionReport(len(files), len(files), total_size, total_size)
+
+    year_dirs = sorted(cube_path.glob("year=*"))
+    if not year_dirs or len(year_dirs) != len(list(cube_path.iterdir())):
+        return unchanged
+
+    groups = group_adjacent([_size(d) for d in year_dirs], target_bytes)
+    if len(groups) >= len(files):
+        return unchanged
+
+    # Keep year an integer, as DuckDB reads it from year= partitions, so that
+    # queries like `year > 2000` keep working
+    dataset = ds.dataset(
+        cube_path,
+        format="parquet",
+        partitioning=ds.partitioning(pa.schema([("year", pa.int64())]), flavor="hive"),
+    )
+    bloom_filters = bloom_filter_options(bloom_filter_columns(files[0]))
+    with tempfile.TemporaryDirectory(dir=cube_path.parent) as tmpdir:
+        new_path = Path(tmpdir) / "compacted"
+        new_path.mkdir()
+        for i, group in enumerate(groups):
+            years = [int(year_dirs[j].name[len("year=") :]) for j in group]
+            tab = dataset.to_table(filter=ds.field("year").isin(years))
+            # Keep series clustered within each year if the cube was sorted
+            # for its bloom filters
+            sort_keys = [("year", "ascending")]
+            if bloom_filters:
+                sort_keys += [k for k in SERIES_SORT_KEYS if k[0] in tab.column_names]
+            pq.write_table(
+                tab.sort_by(sort_keys),
+                new_path / f"part-{i}.parquet",
+                bloom_filter_options=bloom_filters or None,
+            )
+
+        old_path = Path(tmpdir) / "old"
+        cube_path.rename(old_path)
+        new_path.rename(cube_path)
+
+    if series_index_path_for(cube_path).exists():
+        write_series_index(cube_path)
+    return CompactionReport(len(files), len(groups), total_size, _size(cube_path))
+
+
+def compact_uploaded_cube(
+    s3,
+    bucket_name: str,
+    product_id: int,
+    target_bytes: int = DEFAULT_COMPACT_TARGET_BYTES,
+    vector_index_dir: Optional[Union[str, Path]] = None,
+) -> CompactionReport:
+    """
+    Compact a cube which has already been uploaded to the bucket, along with
+    its series index if it has one
+
+    Args:
+        s3: A boto3 S3 client (see `statcandb.s3.get_s3`)
+        bucket_name: The bucket the cube lives in
+        product_id: The product to compact
+        target_bytes: The size to aim for when merging years
+        vector_index_dir: If given, re-index the cube's vectors in this
+            vectorId index once it's compacted
+
+    Returns:
+        What changed
+    """
+    prefix = f"{product_id}.parquet/"
+    with tempfile.TemporaryDirectory() as tmpdir:
+        cube_path = Path(tmpdir) / f"{product_id}.parquet"
+        keys = download_prefix(s3, bucket_name, prefix, cube_path)
+        series_path = series_index_path_for(cube_path)
+        if any(
+            obj["Key"] == series_path.name
+            for obj in list_objects(s3, bucket_name, series_path.name)
+        ):
+            s3.download_file(bucket_name, series_path.name, str(series_path))
+
+        report = compact_cube(cube_path, target_bytes)
+        if report.files_after == report.files_before:
+            return report
+
+        # As when uploading a fresh cube, delete the old files first so that
+        # readers never see the same rows twice
+        old_keys = [{"Key": key} for key in keys]
+        for i in range(0, len(old_keys), 1_000):
+            s3.delete_objects(
+                Bucket=bucket_name, Delete={"Objects": old_keys[i : i + 1_000]}
+            )
+
+        for filepath in sorted(cube_path.rglob("*.parquet")):
+            key = f"{prefix}{filepath.relative_to(cube_path).as_posix()}"
+            s3.upload_file(str(filepath), bucket_name, key)
+        if series_path.exists():
+            s3.upload_file(str(series_path), bucket_name, series_path.name)
+
+        if vector_index_dir is not None:
+            add_to_vector_index(
+                vector_index_dir, index_cube(product_id, cube_path), product_id
+            )
+    return report
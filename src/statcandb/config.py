@@ -1,5 +1,24 @@
+"""
+Configuration, read from the environment, and the resource budget of this
+process
+"""
 import os
+import threading
+from contextlib import contextmanager
 from dataclasses import dataclass
+from typing import Any, Callable, Generator, NamedTuple, Optional
+
+import pyarrow as pa
+
+from statcandb.throttling import (
+    DEFAULT_CONCURRENCY,
+    DEFAULT_REQUESTS_PER_SECOND,
+    AdaptiveLimiter,
+    set_limiter,
+)
+
+DEFAULT_IO_THREADS = 8
+_MIB = 1_024 * 1_024
 
 
 @dataclass(frozen=True)
@@ -10,11 +29,23 @@ class Config:
     r2_bucket: str
     aws_endpoint: str
     sqlite_db_url: str
+    # How many cores and how much memory all of our workers may use together.
+    # None means the whole machine (for cores) or no limit (for memory)
+    cpu_budget: Optional[int] = None
+    memory_budget_bytes: Optional[int] = None
+    # Where the WDS request rate and concurrency start adapting from
+    wds_requests_per_second: Optional[float] = None
+    wds_concurrency: Optional[int] = None
 
 
 config = None
 
 
+def _int_from_env(name: str) -> Optional[int]:
+    value = os.environ.get(name)
+    return int(value) if value else None
+
+
 def set_config_from_env():
     global config
     config = Config(
@@ -24,8 +55,129 @@ def set_config_from_env():
         r2_bucket=os.environ.get("R2_BUCKET"),
         aws_endpoint=f"{os.environ.get('R2_ACCOUNT_ID')}.r2.cloudflarestorage.com",
         sqlite_db_url=os.environ.get("SQLITE_DB_URL"),
+        cpu_budget=_int_from_env("STATCANDB_CPU_BUDGET"),
+        memory_budget_bytes=(
+            memory_mb * _MIB
+            if (memory_mb := _int_from_env("STATCANDB_MEMORY_BUDGET_MB"))
+            else None
+        ),
+        wds_requests_per_second=(
+            float(rate)
+            if (rate := os.environ.get("STATCANDB_WDS_REQUESTS_PER_SECOND"))
+            else None
+        ),
+        wds_concurrency=_int_from_env("STATCANDB_WDS_CONCURRENCY"),
+    )
+    set_governor(ResourceGovernor(config.cpu_budget, config.memory_budget_bytes))
+    set_limiter(
+        AdaptiveLimiter(
+            rate=config.wds_requests_per_second or DEFAULT_REQUESTS_PER_SECOND,
+            concurrency=config.wds_concurrency or DEFAULT_CONCURRENCY,
+        )
     )
 
 
 def get_config() -> Config:
     return config
+
+
+class ResourceShare(NamedTuple):
+    """The part of the resource budget one worker may use"""
+
+    threads: int
+    memory_bytes: Optional[int] = None
+
+    def duckdb_config(self) -> dict[str, str]:
+        """Settings for `duckdb.connect(config=...)`"""
+        settings = {"threads": str(self.threads)}
+        if self.memory_bytes:
+            settings["memory_limit"] = f"{max(self.memory_bytes // _MIB, 1)}MB"
+        return settings
+
+
+class ResourceGovernor:
+    """
+    Divides a budget of cores and memory among the workers running at once.
+
+    pyarrow's thread pools are per process and every DuckDB connection starts
+    its own threads, so several cubes processed at once would each try to use
+    every core. The governor sizes pyarrow's pools to the budget, and hands
+    each worker an equal share of it. Shares are recomputed as workers start
+    and finish, so the last cubes of a run get more of the machine.
+    """
+
+    def __init__(
+        self,
+        cpus: Optional[int] = None,
+        memory_bytes: Optional[int] = None,
+        io_threads: Optional[int] = None,
+    ):
+        self.cpus = cpus or os.cpu_count() or 1
+        self.memory_bytes = memory_bytes
+        self.io_threads = io_threads or DEFAULT_IO_THREADS
+        self._active = 0
+        self._lock = threading.Lock()
+
+    @property
+    def active(self) -> int:
+        return self._active
+
+    def apply(self):
+        """Size pyarrow's thread pools in this process to the whole budget"""
+        pa.set_cpu_count(self.cpus)
+        pa.set_io_thread_count(self.io_threads)
+
+    def share(self, workers: Optional[int] = None) -> ResourceShare:
+        """
+        Args:
+            workers: How many workers to divide the budget among. Defaults to
+                the number running now (at least 1)
+        """
+        workers = max(workers or self._active, 1)
+        return ResourceShare(
+            threads=max(self.cpus // workers, 1),
+            memory_bytes=self.memory_bytes // workers if self.memory_bytes else None,
+        )
+
+    @contextmanager
+    def worker(self) -> Generator[ResourceShare, None, None]:
+        """Count a worker as running while in the block, and yield its share"""
+        with self._lock:
+            self._active += 1
+            share = self.share()
+        try:
+            yield share
+        finally:
+            with self._lock:
+                self._active -= 1
+
+
+governor = None
+
+
+def get_governor() -> ResourceGovernor:
+    """The governor of this process, with the whole machine as its budget by default"""
+    global governor
+    if governor is None:
+        governor = ResourceGovernor()
+    return governor
+
+
+def set_governor(new_governor: ResourceGovernor):
+    global governor
+    governor = new_governor
+    governor.apply()
+
+
+def duckdb_config() -> dict[str, str]:
+    """DuckDB settings for a connection opened now (see `ResourceGovernor`)"""
+    return get_governor().share().duckdb_config()
+
+
+def run_with_share(share: ResourceShare, func: Callable, *args, **kwargs) -> Any:
+    """
+    Call func in a worker process limited to share. Submit this to a process
+    pool rather than func itself
+    """
+    set_governor(ResourceGovernor(share.threads, share.memory_bytes))
+    return func(*args, **kwargs)
@@ -10,9 +10,22 @@ import pyarrow.compute as pc
 import pyarrow.csv as pcsv
 import pyarrow.dataset as ds
 import pyarrow.parquet as pq
-import requests
 
+from statcandb.arrow_files import arrow_path_for, ipc_file_format
+from statcandb.delta_files import null_if_empty, scaled_value
+from statcandb.dimensions import (
+    DIMENSION_MODES,
+    collect_dimensions,
+    dimension_columns,
+    dimension_table,
+    dimensions_path_for,
+    encode_batch,
+    encoded_schema,
+)
 from statcandb.file_utils import download_file, unzip_file
+from statcandb.latest import write_latest
+from statcandb.series_index import SERIES_SORT_KEYS, bloom_filter_options
+from statcandb.throttling import throttled_request
 
 BASE_URL_ALL_CUBES = "https://www150.statcan.gc.ca/t1/wds/rest/getAllCubesListLite"
 BASE_URL_FULL_TABLE = (
@@ -37,7 +50,7 @@ def get_pid_list(base_url: str = BASE_URL_ALL_CUBES) -> list[ProductMetadata]:
     Returns:
         The list of available product ids from the statcan web data service
     """
-    response = requests.get(base_url)
+    response = throttled_request("GET", base_url)
     response.raise_for_status()
     return [
         ProductMetadata(
@@ -56,17 +69,52 @@ def get_changed_pid_list(
     """
     the_date = the_date if isinstance(the_date, str) else the_date.strftime("%Y-%m-%d")
     url = base_url.format(yyyymmdd=the_date)
-    response = requests.get(url)
+    response = throttled_request("GET", url)
     response.raise_for_status()
-    [
+    # Unlike getAllCubesListLite, the list is wrapped in {"status", "object"}
+    payload = response.json()
+    if isinstance(payload, dict):
+        payload = payload["object"]
+    return [
         ProductMetadata(
             int(val["productId"]),
             datetime.strptime(val["releaseTime"], "%Y-%m-%dT%H:%M"),
         )
-        for val in response.json()
+        for val in payload
     ]
 
 
+def get_cube_url(product_id: int, base_url: str = BASE_URL_FULL_TABLE) -> str:
+    """
+    Args:
+        product_id: The product to look up
+        base_url: The format string used to ask the WDS for the download URL
+
+    Returns:
+        The URL of the ZIP file containing the full cube
+    """
+    response = throttled_request("GET", base_url.format(product_id=product_id))
+    response.raise_for_status()
+    return response.json()["object"]
+
+
+def get_cube_size(
+    product_id: int, base_url: str = BASE_URL_FULL_TABLE
+) -> Optional[int]:
+    """
+    Ask the server how large a cube's ZIP file is without downloading it
+
+    Returns:
+        The Content-Length of the ZIP file, or None if the server doesn't say
+    """
+    response = throttled_request(
+        "HEAD", get_cube_url(product_id, base_url), allow_redirects=True
+    )
+    response.raise_for_status()
+    length = response.headers.get("content-length")
+    return int(length) if length is not None else None
+
+
 def pull_cube(
     product_id: int,
     download_path: Optional[str | Path] = None,
@@ -74,9 +122,7 @@ def pull_cube(
     base_url: str = BASE_URL_FULL_TABLE,
     verbose: bool = False,
 ):
-    response = requests.get(base_url.format(product_id=product_id))
-    response.raise_for_status()
-    url = response.json()["object"]
+    url = get_cube_url(product_id, base_url)
     download_file(
         url, download_path=download_path, download_dir=download_dir, verbose=verbose
     )
@@ -96,7 +142,95 @@ def transform_files(folder_path: str | Path):
         pq.write_table(tab, file_name.with_suffix(".parquet"))
 
 
-def process_cube(filename: str | Path, outfile: str | Path):
+def _write_cube(
+    d: ds.Dataset,
+    columns: dict[str, ds.Expression],
+    outfile: Path,
+    format: str | ds.FileFormat,
+    file_options: Optional[ds.FileWriteOptions] = None,
+    dimensions: Optional[dict[str, pa.Array]] = None,
+    dimension_mode: str = "flat",
+    sort_by: Optional[list[tuple[str, str]]] = None,
+):
+    def source():
+        scanner = d.scanner(columns=columns)
+        if sort_by:
+            # Sorting needs the whole cube in memory
+            table = scanner.to_table().sort_by(sort_by)
+            schema, batches = table.schema, table.to_batches()
+        elif not dimensions or dimension_mode == "flat":
+            return scanner
+        else:
+            schema, batches = scanner.projected_schema, scanner.to_batches()
+        if not dimensions or dimension_mode == "flat":
+            return pa.RecordBatchReader.from_batches(schema, batches)
+        return pa.RecordBatchReader.from_batches(
+            encoded_schema(schema, dimensions, dimension_mode),
+            (encode_batch(batch, dimensions, dimension_mode) for batch in batches),
+        )
+
+    # TODO: Improve this file size test so we only write once
+    ds.write_dataset(
+        source(),
+        outfile,
+        format=format,
+        file_options=file_options,
+        partitioning=["year"],
+        partitioning_flavor="hive",
+        preserve_order=bool(sort_by),
+    )
+
+    # If the total size is < 10 MiB, then don't bother partitioning
+    total_size = sum(f.stat().st_size for f in outfile.rglob("*") if f.is_file())
+    if total_size < 10 * 1_024 * 1_024:  # 10 MiB
+        shutil.rmtree(outfile)
+        ds.write_dataset(
+            source(),
+            outfile,
+            format=format,
+            file_options=file_options,
+            preserve_order=bool(sort_by),
+        )
+
+
+def process_cube(
+    filename: str | Path,
+    outfile: str | Path,
+    latest_outfile: Optional[str | Path] = None,
+    release_time: Optional[datetime] = None,
+    format: str = "parquet",
+    compression: Optional[str] = None,
+    dimensions: str = "dictionary",
+    bloom_filters: bool = False,
+):
+    """
+    Convert a cube from its ZIP (or CSV) state to a parquet data set
+
+    Args:
+        filename: The ZIP or CSV file of the cube
+        outfile: The directory to write the data set to
+        latest_outfile: If given, also write the cube's latest value table here
+            (see `statcandb.latest`)
+        release_time: The release time of the cube, recorded in the latest table
+        format: One of "parquet", "arrow" (write Arrow IPC files to `outfile`
+            instead of parquet), or "both" (also write Arrow IPC files to
+            `statcandb.arrow_files.arrow_path_for(outfile)`)
+        compression: The compression of Arrow IPC files. One of None, "lz4",
+            or "zstd". Uncompressed files can be read without copying
+        dimensions: How to store the label columns (see `statcandb.dimensions`).
+            One of "dictionary", "flat" (plain strings), or "table" (integer
+            codes, with the labels written to
+            `statcandb.dimensions.dimensions_path_for(outfile)`)
+        bloom_filters: If true, write parquet bloom filters for COORDINATE and
+            GEO, and sort each parquet file by COORDINATE so that a series
+            sits in few row groups (see `statcandb.series_index`). Sorting
+            reads the whole cube into memory
+    """
+    if format not in ("parquet", "arrow", "both"):
+        raise ValueError(f"format must be one of parquet, arrow, or both: {format}")
+    if dimensions not in DIMENSION_MODES:
+        raise ValueError(f"dimensions must be one of {DIMENSION_MODES}: {dimensions}")
+
     filename = Path(filename)
     outfile = Path(outfile)
     with unzip_file(filename) as csv_path:
@@ -152,43 +286,74 @@ def process_cube(filename: str | Path, outfile: str | Path):
             max_decimals = None
 
         new_schema_list = []
+        string_columns = ["STATUS", "SYMBOL", "TERMINATED", "DGUID", "COORDINATE"]
         for name, type in zip(schema.names, schema.types):
-            if (name in ["STATUS", "SYMBOL", "TERMINATED", "DGUID"]) or (
+            if (name in string_columns) or (
                 name[:6] == "Symbol"
                 and ((len(name) < 7) or (name[6] == "." and name[7:].isdigit()))
             ):
-                # These fields are usually _mostly_ null but should be strings
+                # These fields are usually _mostly_ null but should be strings.
+                # COORDINATE looks like a float when a cube has only two dimensions
                 new_schema_list.append(pa.field(name, pa.string()))
             elif name == "VALUE":
                 # The VALUE column seems to appear only if DECIMALS appears,
-                # so this should be OK
-                if max_decimals > 0:
-                    new_schema_list.append(pa.field(name, pa.float64()))
-                else:
-                    new_schema_list.append(pa.field(name, pa.int64()))
+                # so this should be OK. Read it as text so that SCALED_VALUE
+                # can be computed exactly, then parse it as a number
+                new_schema_list.append(pa.field(name, pa.string()))
+                value_type = pa.float64() if max_decimals > 0 else pa.int64()
+                columns["VALUE"] = null_if_empty(ds.field("VALUE")).cast(value_type)
+                if "SCALAR_ID" in column_names:
+                    columns["SCALED_VALUE"] = scaled_value(
+                        ds.field("VALUE"), ds.field("SCALAR_ID")
+                    )
             else:
                 new_schema_list.append(pa.field(name, type))
         new_schema = pa.schema(new_schema_list)
 
         d = ds.dataset(csv_path, format=file_format, schema=new_schema)
-        s = d.scanner(columns=columns)
 
-        # TODO: Improve this file size test so we only write once
-        ds.write_dataset(
-            s,
-            outfile,
-            format="parquet",
-            partitioning=["year"],
-            partitioning_flavor="hive",
-        )
+        labels = None
+        if dimensions != "flat":
+            names = dimension_columns(new_schema)
+            labels = collect_dimensions(d.scanner(columns=names), names)
 
-        # If the total size is < 10 MiB, then don't bother partitioning
-        total_size = sum(f.stat().st_size for f in outfile.rglob("*") if f.is_file())
-        if total_size < 10 * 1_024 * 1_024:  # 10 MiB
-            shutil.rmtree(outfile)
-            s = d.scanner(columns=columns)
-            ds.write_dataset(
-                s,
+        if format in ("parquet", "both"):
+            parquet_format = ds.ParquetFileFormat()
+            parquet_options = None
+            sort_by = None
+            if bloom_filters:
+                parquet_options = parquet_format.make_write_options(
+                    bloom_filter_options=bloom_filter_options(columns)
+                )
+                sort_by = [key for key in SERIES_SORT_KEYS if key[0] in columns]
+            _write_cube(
+                d,
+                columns,
                 outfile,
-                format="parquet",
+                parquet_format,
+                parquet_options,
+                dimensions=labels,
+                dimension_mode=dimensions,
+                sort_by=sort_by,
+            )
+        if format in ("arrow", "both"):
+            ipc_format, ipc_options = ipc_file_format(compression)
+            _write_cube(
+                d,
+                columns,
+                outfile if format == "arrow" else arrow_path_for(outfile),
+                ipc_format,
+                ipc_options,
+                dimensions=labels,
+                dimension_mode=dimensions,
             )
+        if dimensions == "table":
+            pq.write_table(dimension_table(labels), dimensions_path_for(outfile))
+
+    if latest_outfile is not None:
+        write_latest(
+            outfile,
+            latest_outfile,
+            release_time=release_time,
+            format="arrow" if format == "arrow" else "parquet",
+        )
@@ -1,30 +1,19 @@
-from contextlib import closing
+import zipfile
+from contextlib import closing, contextmanager
 from datetime import date, datetime
 from pathlib import Path
-from typing import Optional, Union
+from typing import Any, BinaryIO, Generator, Optional, Union
 
 import duckdb
 import pyarrow as pa
+import pyarrow.compute as pc
 import pyarrow.csv as pcsv
 import pyarrow.dataset as ds
 import requests
 
+from statcandb.config import duckdb_config
 from statcandb.file_utils import download_file
-
-# Not sure how to use this yet :/
-# scalar_factor = int(row[scalar_factor_column])
-# if delta_value == "":
-#     # this handles if value is empty
-#     delta_value = 0.0
-# else:
-#     delta_value = float(delta_value) * math.pow(
-#         10, scalar_factor
-#     )  # Helena: note here that this computation-wise works!
-#     # however, not sure if it messes with schema since the value is eg,
-#     #  114512000000.0 after scalar (extra .0 at end)
-#     # but, my interpretation (helena) is that value is still a float so the
-#     # extra .0 doesn't affect anything (hopefully)
-
+from statcandb.profiling import profile_stage
 
 BASE_URL = "https://www150.statcan.gc.ca/n1/delta/{download_date}.zip"
 
@@ -47,6 +36,95 @@ DELTA_FILE_SCHEMA = pa.schema(
     ]
 )
 
+# Values multiplied out by their scalar factor (e.g., 1.5 thousand -> 1500) are
+# stored as exact decimals, both in full cubes (SCALED_VALUE) and in split delta
+# files (scaledValue), rather than as floats. The raw values are parsed straight
+# from the CSV text, so no float rounding is ever introduced
+SCALED_VALUE_TYPE = pa.decimal128(38, 10)
+# Leaves room in SCALED_VALUE_TYPE for a scalar factor of up to 10^9
+_UNSCALED_VALUE_TYPE = pa.decimal128(27, 10)
+
+SPLIT_DELTA_FILE_SCHEMA = DELTA_FILE_SCHEMA.append(
+    pa.field("scaledValue", SCALED_VALUE_TYPE)
+)
+
+# The following are pulled from the codeSet.xml file that accompanies each delta file
+# They map the codes in the delta file to the representations used in full cubes
+STATUS_CODES = {
+    0: None,  # normal
+    1: "..",  # not available for a specific reference period
+    2: "0s",  # value rounded to 0 where there is a meaningful distinction
+    3: "A",  # data quality: excellent
+    4: "B",  # data quality: very good
+    5: "C",  # data quality: good
+    6: "D",  # data quality: acceptable
+    7: "E",  # use with caution
+    8: "F",  # too unreliable to be published
+    9: "...",  # not applicable
+    10: "<LOD",  # less than the limit of detection
+}
+SYMBOL_CODES = {
+    0: None,  # none
+    1: "p",  # preliminary
+    3: "r",  # revised
+}
+# Full cubes report suppressed values in their STATUS column
+SECURITY_LEVEL_CODES = {
+    0: None,  # public
+    1: "x",  # suppressed to meet the confidentiality requirements
+}
+
+# Delta files pad coordinates out to 10 members (1.1.0.0.0.0.0.0.0.0) while
+# full cubes only list the members the cube has (1.1)
+PADDED_COORDINATE_REGEX = r"(\.0)+$"
+
+
+def _literal(like: Union[pa.Array, ds.Expression], value: Any):
+    """A scalar which can be combined with like, whether an array or an expression"""
+    scalar = pa.scalar(value, pa.string() if value is None else None)
+    return pc.scalar(scalar) if isinstance(like, ds.Expression) else scalar
+
+
+def null_if_empty(
+    value: Union[pa.Array, ds.Expression],
+) -> Union[pa.Array, ds.Expression]:
+    """Values read from a CSV as strings, with empty strings as null"""
+    return pc.if_else(
+        pc.equal(value, _literal(value, "")), _literal(value, None), value
+    )
+
+
+def scaled_value(
+    value: Union[pa.Array, ds.Expression], scalar_factor: Union[pa.Array, ds.Expression]
+) -> Union[pa.Array, ds.Expression]:
+    """
+    Multiply values by 10^scalar_factor exactly.
+
+    Args:
+        value: The values as they appear in the CSV, i.e., as strings. Empty
+            strings are treated as null
+        scalar_factor: The power of 10 to multiply by, i.e., SCALAR_ID in full
+            cubes or scalarFactorCode in delta files
+
+    Returns:
+        The scaled values as SCALED_VALUE_TYPE, rounded to its 10 decimal places.
+        Works on arrays as well as dataset expressions
+    """
+    value = null_if_empty(value)
+    # Casting an int64 straight to a decimal requires a precision of 19, which
+    # would overflow the product, so go through a string
+    factor = pc.power(_literal(value, 10), scalar_factor.cast(pa.int64()))
+    factor = factor.cast(pa.string()).cast(pa.decimal128(10, 0))
+    # Round anything more precise than SCALED_VALUE_TYPE rather than fail
+    value = pc.round(value.cast(pa.decimal128(38, 20)), ndigits=10)
+    product = pc.multiply(value.cast(_UNSCALED_VALUE_TYPE), factor)
+    return product.cast(SCALED_VALUE_TYPE)
+
+
+def trim_coordinate(coordinate: pa.Array) -> pa.Array:
+    """Convert padded delta file coordinates to the form used in full cubes"""
+    return pc.replace_substring_regex(coordinate, PADDED_COORDINATE_REGEX, "")
+
 
 def pull_delta_file(
     download_date: Union[str, datetime, date],
@@ -80,6 +158,67 @@ def pull_delta_file(
     return download_file(delta_file_url, download_dir=download_dir, session=session)
 
 
+@contextmanager
+def open_delta_file(
+    delta_file_path: Union[str, Path],
+) -> Generator[Union[Path, BinaryIO], None, None]:
+    """
+    Open a delta file for `split_delta_file`, whether it is still zipped or not
+
+    Args:
+        delta_file_path: The path to the delta file ZIP (e.g., 20230803.zip)
+            or the CSV inside of it
+
+    Yields:
+        Something `split_delta_file` can read
+    """
+    delta_file_path = Path(delta_file_path)
+    if delta_file_path.suffix.lower() == ".zip":
+        csv_filename = delta_file_path.with_suffix(".csv").name
+        with zipfile.ZipFile(delta_file_path) as zf:
+            with zf.open(csv_filename) as zf_csv:
+                yield zf_csv
+    else:
+        yield delta_file_path
+
+
+def delta_csv_options(
+    skip_rows: int = 1,
+) -> tuple[pcsv.ReadOptions, pcsv.ConvertOptions]:
+    """
+    The options to read a delta file CSV with. Batches read with them must be
+    passed through `with_scaled_value`
+
+    Args:
+        skip_rows: How many rows to skip, i.e., 1 to skip the header and 0 for
+            a slice of the file without it
+    """
+    cro = pcsv.ReadOptions(
+        skip_rows=skip_rows,
+        column_names=DELTA_FILE_SCHEMA.names,
+        encoding="utf8",
+    )
+    # Read value as text so that scaledValue can be computed without rounding
+    value_index = DELTA_FILE_SCHEMA.get_field_index("value")
+    cco = pcsv.ConvertOptions(
+        column_types=DELTA_FILE_SCHEMA.set(value_index, pa.field("value", pa.string()))
+    )
+    return cro, cco
+
+
+def with_scaled_value(batch: pa.RecordBatch) -> pa.RecordBatch:
+    """
+    Turn a batch read with `delta_csv_options` into one of
+    SPLIT_DELTA_FILE_SCHEMA
+    """
+    value_index = DELTA_FILE_SCHEMA.get_field_index("value")
+    value = batch["value"]
+    columns = batch.columns
+    columns[value_index] = null_if_empty(value).cast(pa.float64())
+    columns.append(scaled_value(value, batch["scalarFactorCode"]))
+    return pa.RecordBatch.from_arrays(columns, schema=SPLIT_DELTA_FILE_SCHEMA)
+
+
 def split_delta_file(
     delta_file_path: Union[str, Path], workdir: Union[str, Path], format: str = "arrow"
 ):
@@ -93,19 +232,14 @@ def split_delta_file(
             "arrow" as it will allow you to skip a lot of computation in
             reading and writing. For long term storage, use "parquet"
     """
-    cro = pcsv.ReadOptions(
-        skip_rows=1,
-        column_names=DELTA_FILE_SCHEMA.names,
-        encoding="utf8",
-    )
-    cco = pcsv.ConvertOptions(column_types=DELTA_FILE_SCHEMA)
-
+    cro, cco = delta_csv_options()
     with closing(
         pcsv.open_csv(delta_file_path, read_options=cro, convert_options=cco)
     ) as batches:
         ds.write_dataset(
-            batches,
+            (with_scaled_value(batch) for batch in batches),
             workdir,
+            schema=SPLIT_DELTA_FILE_SCHEMA,
             partitioning=ds.partitioning(
                 flavor="hive", schema=pa.schema([("productId", pa.int64())])
             ),
@@ -117,6 +251,9 @@ def merge_delta_file(
     original_path: Union[str, Path],
     delta_path: Union[str, Path],
     new_path: Union[str, Path],
+    latest_path: Optional[Union[str, Path]] = None,
+    new_latest_path: Optional[Union[str, Path]] = None,
+    product_id: Optional[int] = None,
 ):
     """
     Merge a delta file into an old data set.
@@ -130,25 +267,54 @@ def merge_delta_file(
         original_path: The path of the data being modified
         delta_path: The path to the delta data
         new_path: The path to write the new data to
+        latest_path: Optionally, the latest value table of the data set
+            (see `statcandb.latest`) to bring up to date as well
+        new_latest_path: Where to write the new latest value table. Must be
+            given if latest_path is
+        product_id: The product being merged, which keys its profile (see
+            `statcandb.profiling`). Defaults to the name of new_path
     """
-    with duckdb.connect(":memory:", read_only=False) as con:
-        # creating temp table and copying everything
-        con.execute(
-            f"CREATE TEMPORARY TABLE original_table AS SELECT * FROM '{original_path}'"
-        )
-        con.execute(f"CREATE TEMPORARY TABLE new_table AS SELECT * FROM '{delta_path}'")
+    key = product_id if product_id is not None else Path(new_path).stem
+    with profile_stage("merge", key):
+        if latest_path is not None:
+            if new_latest_path is None:
+                raise ValueError("new_latest_path must be given with latest_path")
+
+            # Imported here since statcandb.latest relies on this module
+            from statcandb.latest import update_latest
+
+            update_latest(latest_path, delta_path, new_latest_path)
 
-        # update rows in specified table using provided values
-        con.execute(
+        with duckdb.connect(":memory:", read_only=False, config=duckdb_config()) as con:
+            # creating temp table and copying everything
+            con.execute(
+                "CREATE TEMPORARY TABLE original_table AS "
+                f"SELECT * FROM '{original_path}'"
+            )
+            con.execute(
+                f"CREATE TEMPORARY TABLE new_table AS SELECT * FROM '{delta_path}'"
+            )
+
+            # update rows in specified table using provided values
+            both_scaled = all(
+                "scaledValue"
+                in [row[0] for row in con.execute(f"DESCRIBE {t}").fetchall()]
+                for t in ["original_table", "new_table"]
+            )
+            scaled_value = (
+                ", scaledValue = new_table.scaledValue" if both_scaled else ""
+            )
+            con.execute(
+                f"""
+                UPDATE original_table
+                SET value = new_table.value{scaled_value}
+                FROM new_table
+                WHERE original_table.vectorId = new_table.vectorId
             """
-            UPDATE original_table
-            SET value = new_table.value
-            FROM new_table
-            WHERE original_table.vectorId = new_table.vectorId
-        """
-        )
+            )
 
-        # write updated data back to original parquet
-        con.execute(
-            f"COPY (SELECT * FROM original_table) TO '{new_path}' (FORMAT 'parquet')"
-        )
+            # write updated data back to original parquet
+            con.execute(
+                "COPY (SELECT * FROM original_table) "
+                f"TO '{new_path}' (FORMAT 'parquet')"
+            )
@@ -0,0 +1,257 @@
+"""
+An append-only store of every delta file we have pulled.
+
+The store is a directory laid out as
+
+    productId=10100001/
+        20230714.parquet            <- the rows of one day's delta file
+        20230715.parquet
+        20230101-20230713.parquet   <- a compacted range of days
+    _dates/
+        20230714                    <- marks a day as ingested
+
+Each day's delta file is split by product and appended as one small file per
+product. Since most products only change a few rows a day, this quickly leads
+to thousands of tiny files, so `compact_delta_history` merges runs of adjacent
+small files into files of roughly a target size, sorted by vectorId so that
+parquet statistics can skip most of a file when looking for a single vector.
+
+Files (and directories) starting with an underscore are ignored by pyarrow,
+so the store can be read directly as a hive-partitioned data set.
+"""
+import tempfile
+from dataclasses import dataclass
+from datetime import date, datetime
+from pathlib import Path
+from typing import Iterable, Optional, Union
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+import requests
+
+from statcandb.delta_files import open_delta_file, pull_delta_file, split_delta_file
+
+DATES_DIRNAME = "_dates"
+DEFAULT_TARGET_BYTES = 128 * 1_024 * 1_024  # 128 MiB
+
+
+@dataclass(frozen=True, order=True)
+class HistoryFile:
+    """A file in the store covering the delta files from `start` to `end`"""
+
+    start: str
+    end: str
+    path: Path
+
+    @classmethod
+    def from_path(cls, path: Path) -> "HistoryFile":
+        start, _, end = path.stem.partition("-")
+        return cls(start, end or start, path)
+
+
+def _date_str(the_date: Union[str, datetime, date]) -> str:
+    return the_date if isinstance(the_date, str) else the_date.strftime("%Y%m%d")
+
+
+def ingested_dates(root: Union[str, Path]) -> set[str]:
+    """
+    Returns:
+        The dates (as YYYYMMDD) of the delta files already in the store
+    """
+    dates_dir = Path(root) / DATES_DIRNAME
+    return {p.name for p in dates_dir.iterdir()} if dates_dir.exists() else set()
+
+
+def ingest_delta_file(
+    root: Union[str, Path],
+    delta_file_path: Union[str, Path],
+    download_date: Union[str, datetime, date],
+) -> bool:
+    """
+    Add a delta file to the store.
+
+    Args:
+        root: The directory of the store. Created if it does not exist
+        delta_file_path: The delta file, either as a ZIP or a CSV
+        download_date: The date of the delta file
+
+    Returns:
+        False if the date had already been ingested, True otherwise
+    """
+    root = Path(root)
+    download_date = _date_str(download_date)
+    if download_date in ingested_dates(root):
+        return False
+
+    (root / DATES_DIRNAME).mkdir(parents=True, exist_ok=True)
+    # pyarrow ignores the partially split file since it starts with an underscore
+    with tempfile.TemporaryDirectory(dir=root, prefix="_") as tmpdir:
+        split_path = Path(tmpdir) / "split"
+        with open_delta_file(delta_file_path) as delta_file:
+            split_delta_file(delta_file, split_path, format="parquet")
+
+        for partition in split_path.iterdir():
+            product_dir = root / partition.name
+            product_dir.mkdir(exist_ok=True)
+            tab = ds.dataset(partition, format="parquet").to_table()
+            pq.write_table(tab, product_dir / f"{download_date}.parquet")
+
+    (root / DATES_DIRNAME / download_date).touch()
+    return True
+
+
+def pull_and_ingest_delta_file(
+    root: Union[str, Path],
+    download_date: Union[str, datetime, date],
+    session: Optional[requests.Session] = None,
+) -> bool:
+    """
+    Download a delta file and add it to the store, unless it's already there
+
+    Returns:
+        False if the date had already been ingested, True otherwise
+    """
+    if _date_str(download_date) in ingested_dates(root):
+        return False
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        delta_file_path = pull_delta_file(download_date, tmpdir, session=session)
+        return ingest_delta_file(root, delta_file_path, download_date)
+
+
+def _compaction_groups(
+    files: list[HistoryFile], target_bytes: int
+) -> list[list[HistoryFile]]:
+    """
+    Split a product's files into runs of adjacent small files whose total size is
+    about target_bytes. Files that are already large enough are left alone.
+    """
+    groups: list[list[HistoryFile]] = []
+    current: list[HistoryFile] = []
+    current_size = 0
+    for history_file in sorted(files):
+        size = history_file.path.stat().st_size
+        if size >= target_bytes:
+            groups.append(current)
+            current, current_size = [], 0
+            continue
+
+        current.append(history_file)
+        current_size += size
+        if current_size >= target_bytes:
+            groups.append(current)
+            current, current_size = [], 0
+    groups.append(current)
+    return [group for group in groups if len(group) > 1]
+
+
+def compact_delta_history(
+    root: Union[str, Path],
+    target_bytes: int = DEFAULT_TARGET_BYTES,
+    product_ids: Optional[Iterable[int]] = None,
+) -> tuple[int, int]:
+    """
+    Merge runs of small files in the store into files of about target_bytes
+
+    Args:
+        root: The directory of the store
+        target_bytes: The size to aim for when merging files
+        product_ids: Optionally, only compact these products
+
+    Returns:
+        The number of files before and after compaction
+    """
+    root = Path(root)
+    if product_ids is None:
+        product_dirs = sorted(root.glob("productId=*"))
+    else:
+        product_dirs = [root / f"productId={product_id}" for product_id in product_ids]
+
+    before = after = 0
+    for product_dir in product_dirs:
+        files = [
+            HistoryFile.from_path(p)
+            for p in product_dir.glob("*.parquet")
+            if not p.name.startswith("_")
+        ]
+        before += len(files)
+        after += len(files)
+        for group in _compaction_groups(files, target_bytes):
+            tab = pa.concat_tables(pq.read_table(f.path) for f in group)
+            tab = tab.sort_by(
+                [
+                    ("vectorId", "ascending"),
+                    ("refPer", "ascending"),
+                    ("releaseTime", "ascending"),
+                ]
+            )
+
+            # Write under a name pyarrow ignores, then swap it in. Until the
+            # old files are gone, readers see each row twice, which as_of
+            # tolerates, but they never see it missing
+            new_path = product_dir / f"{group[0].start}-{group[-1].end}.parquet"
+            tmp_path = product_dir / f"_{new_path.name}"
+            pq.write_table(tab, tmp_path)
+            tmp_path.rename(new_path)
+            for f in group:
+                if f.path != new_path:
+                    f.path.unlink()
+            after -= len(group) - 1
+    return before, after
+
+
+def as_of(
+    root: Union[str, Path],
+    as_of_date: Union[str, datetime, date],
+    product_id: Optional[int] = None,
+    vector_id: Optional[int] = None,
+) -> pa.Table:
+    """
+    Reconstruct what the delta files said as of a given date. For every vector and
+    reference period, return the last revision released on or before that date.
+
+    Args:
+        root: The directory of the store
+        as_of_date: The date (YYYYMMDD if a str) to reconstruct
+        product_id: Optionally, only look at this product. Much faster if given
+        vector_id: Optionally, only look at this vector
+
+    Returns:
+        One row per (vectorId, refPer)
+    """
+    if product_id is None and vector_id is None:
+        raise ValueError("At least one of product_id or vector_id must be given")
+
+    root = Path(root)
+    as_of_date = _date_str(as_of_date)
+    cutoff = f"{as_of_date[:4]}-{as_of_date[4:6]}-{as_of_date[6:]}T99:99"
+
+    if product_id is not None:
+        dataset = ds.dataset(root / f"productId={product_id}", format="parquet")
+    else:
+        dataset = ds.dataset(root, format="parquet", partitioning="hive")
+
+    filter = ds.field("releaseTime") <= cutoff
+    if vector_id is not None:
+        filter = filter & (ds.field("vectorId") == vector_id)
+
+    tab = dataset.to_table(filter=filter).sort_by(
+        [
+            ("vectorId", "ascending"),
+            ("refPer", "ascending"),
+            ("releaseTime", "descending"),
+        ]
+    )
+    if tab.num_rows == 0:
+        return tab
+
+    # Keep the first (i.e., latest released) row of each (vectorId, refPer)
+    vectors, periods = tab["vectorId"], tab["refPer"]
+    is_new = pc.or_(
+        pc.not_equal(vectors[1:], vectors[:-1]),
+        pc.not_equal(periods[1:], periods[:-1]),
+    ).fill_null(True)
+    mask = pa.concat_arrays([pa.array([True]), is_new.combine_chunks()])
+    return tab.filter(mask)
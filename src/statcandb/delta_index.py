@@ -0,0 +1,200 @@
+"""
+An index of where each product's rows are in a delta file.
+
+Delta file CSVs are sorted by productId, so each product's rows form a
+contiguous block of bytes. One pass over the file records the byte offset,
+length, and row count of each block in a small sidecar next to it, e.g.,
+20230803.zip -> 20230803.index.parquet. With it, reading one product means a
+seek and parsing just that block rather than the whole file, and splitting a
+few products (or all of them) can be done in parallel, one block at a time.
+
+Offsets are into the CSV itself. They work for delta files which are still
+zipped too, but seeking in a ZIP file decompresses everything up to the
+offset, so extract the CSV first if you'll read from it a lot.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing, contextmanager
+from pathlib import Path
+from typing import BinaryIO, Generator, Iterable, Optional, Union
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pcsv
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+from statcandb.delta_files import (
+    SPLIT_DELTA_FILE_SCHEMA,
+    delta_csv_options,
+    open_delta_file,
+    with_scaled_value,
+)
+
+DELTA_INDEX_SCHEMA = pa.schema(
+    [
+        ("productId", pa.int64()),
+        ("offset", pa.int64()),
+        ("length", pa.int64()),
+        ("rowCount", pa.int64()),
+    ]
+)
+CHUNK_BYTES = 16 * 1_024 * 1_024
+DEFAULT_PRODUCT_SPLIT_WORKERS = 4
+
+
+def delta_index_path_for(delta_file_path: Union[str, Path]) -> Path:
+    """
+    Where the index of a delta file lives, e.g., 20230803.zip ->
+    20230803.index.parquet
+    """
+    delta_file_path = Path(delta_file_path)
+    return delta_file_path.with_name(f"{delta_file_path.stem}.index.parquet")
+
+
+@contextmanager
+def _open_binary(delta_file_path: Union[str, Path]) -> Generator[BinaryIO, None, None]:
+    with open_delta_file(delta_file_path) as delta_file:
+        if isinstance(delta_file, Path):
+            with open(delta_file, "rb") as infile:
+                yield infile
+        else:
+            yield delta_file
+
+
+def index_delta_file(delta_file_path: Union[str, Path]) -> pa.Table:
+    """
+    Find the block of rows of each product in a delta file in one pass.
+
+    Args:
+        delta_file_path: The delta file ZIP or the CSV inside of it
+
+    Returns:
+        One row per block, in the order of the file. If the file isn't sorted,
+        a product has several blocks
+    """
+    blocks: list[list] = []
+    offset = 0
+
+    def add(line: bytes, length: int):
+        nonlocal offset
+        if line.strip():
+            product_id = line[: line.find(b",")]
+            if blocks and blocks[-1][0] == product_id:
+                blocks[-1][2] += length
+                blocks[-1][3] += 1
+            else:
+                blocks.append([product_id, offset, length, 1])
+        elif blocks:
+            # A blank line stays in its block, so blocks stay contiguous
+            blocks[-1][2] += length
+        offset += length
+
+    with _open_binary(delta_file_path) as infile:
+        offset = len(infile.readline())  # The header
+        remainder = b""
+        while chunk := infile.read(CHUNK_BYTES):
+            lines = (remainder + chunk).split(b"\n")
+            remainder = lines.pop()  # A partial line, or b"" after a newline
+            for line in lines:
+                add(line, len(line) + 1)
+        if remainder:
+            add(remainder, len(remainder))
+
+    return pa.table(
+        [
+            pa.array([int(block[0]) for block in blocks], pa.int64()),
+            pa.array([block[1] for block in blocks], pa.int64()),
+            pa.array([block[2] for block in blocks], pa.int64()),
+            pa.array([block[3] for block in blocks], pa.int64()),
+        ],
+        schema=DELTA_INDEX_SCHEMA,
+    )
+
+
+def write_delta_index(
+    delta_file_path: Union[str, Path], outfile: Optional[Union[str, Path]] = None
+) -> pa.Table:
+    """Index a delta file and write the index next to it (or to outfile)"""
+    index = index_delta_file(delta_file_path)
+    pq.write_table(index, outfile or delta_index_path_for(delta_file_path))
+    return index
+
+
+def load_delta_index(delta_file_path: Union[str, Path]) -> pa.Table:
+    """The index of a delta file, built (and written) if it doesn't exist yet"""
+    index_path = delta_index_path_for(delta_file_path)
+    if index_path.exists():
+        return pq.read_table(index_path, schema=DELTA_INDEX_SCHEMA)
+    return write_delta_index(delta_file_path)
+
+
+def read_delta_product(
+    delta_file_path: Union[str, Path], index: pa.Table, product_id: int
+) -> pa.Table:
+    """
+    Read the rows of one product from a delta file, parsing only its blocks
+
+    Args:
+        delta_file_path: The delta file ZIP or the CSV inside of it
+        index: The index of the delta file (see `load_delta_index`)
+        product_id: The product to read
+
+    Returns:
+        The product's rows, as `split_delta_file` would write them
+    """
+    blocks = index.filter(pc.field("productId") == product_id).sort_by("offset")
+    cro, cco = delta_csv_options(skip_rows=0)
+    batches = []
+    with _open_binary(delta_file_path) as infile:
+        for offset, length in zip(
+            blocks["offset"].to_pylist(), blocks["length"].to_pylist()
+        ):
+            infile.seek(offset)
+            data = pa.BufferReader(infile.read(length))
+            with closing(
+                pcsv.open_csv(data, read_options=cro, convert_options=cco)
+            ) as reader:
+                batches.extend(with_scaled_value(batch) for batch in reader)
+    return pa.Table.from_batches(batches, schema=SPLIT_DELTA_FILE_SCHEMA)
+
+
+def split_delta_products(
+    delta_file_path: Union[str, Path],
+    workdir: Union[str, Path],
+    product_ids: Optional[Iterable[int]] = None,
+    format: str = "arrow",
+    workers: int = DEFAULT_PRODUCT_SPLIT_WORKERS,
+) -> list[int]:
+    """
+    Like `split_delta_file`, but only for some products, and in parallel.
+
+    Args:
+        delta_file_path: The delta file ZIP or the CSV inside of it
+        workdir: The directory to write the hive-partitioned data set to
+        product_ids: The products to split. Defaults to all of them
+        format: The format to store the data set in
+        workers: How many products to read and write at once
+
+    Returns:
+        The products which were in the delta file and were written
+    """
+    index = load_delta_index(delta_file_path)
+    present = set(index["productId"].to_pylist())
+    wanted = present if product_ids is None else present & set(product_ids)
+    partitioning = ds.partitioning(
+        flavor="hive", schema=pa.schema([("productId", pa.int64())])
+    )
+
+    def split(product_id: int):
+        ds.write_dataset(
+            read_delta_product(delta_file_path, index, product_id),
+            workdir,
+            schema=SPLIT_DELTA_FILE_SCHEMA,
+            partitioning=partitioning,
+            format=format,
+            existing_data_behavior="overwrite_or_ignore",
+        )
+
+    with ThreadPoolExecutor(workers) as pool:
+        list(pool.map(split, sorted(wanted)))
+    return sorted(wanted)
@@ -0,0 +1,189 @@
+"""
+Encoding the dimension columns of a cube.
+
+Cubes repeat the same few labels (GEO, DGUID, UOM, SCALAR_FACTOR, and the
+member names of each dimension) on every row. `process_cube` can store them in
+one of three ways:
+
+    flat        plain strings, as in the CSV
+    dictionary  Arrow dictionary arrays. Readers get small integer codes plus
+                one copy of each label, both on disk and in memory
+    table       int32 codes only. The labels are written once to a dimension
+                table next to the cube, e.g., 14100287.dimensions.parquet,
+                with columns DIMENSION, CODE, and LABEL
+
+The codes of a column are the same throughout a cube: they index into the
+sorted distinct labels of that column. Use `decode_dimensions` to turn the codes
+of a "table" cube back into labels.
+"""
+from pathlib import Path
+from typing import Union
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+
+DIMENSION_MODES = ("flat", "dictionary", "table")
+
+# Columns which are measures or per-observation metadata rather than labels
+NON_DIMENSION_COLUMNS = {
+    "REF_DATE",
+    "VECTOR",
+    "COORDINATE",
+    "VALUE",
+    "STATUS",
+    "SYMBOL",
+    "TERMINATED",
+    "DECIMALS",
+    "UOM_ID",
+    "SCALAR_ID",
+    "year",
+}
+
+CODE_TYPE = pa.int32()
+DIMENSION_TABLE_SCHEMA = pa.schema(
+    [
+        pa.field("DIMENSION", pa.string()),
+        pa.field("CODE", CODE_TYPE),
+        pa.field("LABEL", pa.string()),
+    ]
+)
+
+
+def dimensions_path_for(cube_path: Union[str, Path]) -> Path:
+    """
+    Where the dimension table of a cube lives, e.g., 14100287.parquet ->
+    14100287.dimensions.parquet
+    """
+    cube_path = Path(cube_path)
+    return cube_path.with_name(f"{cube_path.stem}.dimensions.parquet")
+
+
+def dimension_columns(schema: pa.Schema) -> list[str]:
+    """
+    Returns:
+        The string columns of a cube which hold labels
+    """
+    return [
+        field.name
+        for field in schema
+        if pa.types.is_string(field.type)
+        and field.name not in NON_DIMENSION_COLUMNS
+        and not field.name.startswith("Symbol")
+    ]
+
+
+def collect_dimensions(scanner: ds.Scanner, names: list[str]) -> dict[str, pa.Array]:
+    """
+    Find the distinct labels of each dimension column in one pass over a cube.
+
+    Args:
+        scanner: A scanner over (at least) the dimension columns
+        names: The dimension columns
+
+    Returns:
+        The sorted distinct non-null labels of each column
+    """
+    uniques: dict[str, list[pa.Array]] = {name: [] for name in names}
+    for batch in scanner.to_batches():
+        for name in names:
+            uniques[name].append(pc.unique(batch[name]))
+
+    dimensions = {}
+    for name, arrays in uniques.items():
+        labels = (
+            pc.unique(pa.concat_arrays(arrays)) if arrays else pa.array([], pa.string())
+        )
+        dimensions[name] = pc.drop_null(labels).sort()
+    return dimensions
+
+
+def encoded_schema(
+    schema: pa.Schema, dimensions: dict[str, pa.Array], mode: str
+) -> pa.Schema:
+    """The schema of batches encoded by `encode_batch`"""
+    if mode == "flat":
+        return schema
+    new_type = (
+        pa.dictionary(CODE_TYPE, pa.string()) if mode == "dictionary" else CODE_TYPE
+    )
+    return pa.schema(
+        [
+            pa.field(field.name, new_type) if field.name in dimensions else field
+            for field in schema
+        ]
+    )
+
+
+def encode_batch(
+    batch: pa.RecordBatch, dimensions: dict[str, pa.Array], mode: str
+) -> pa.RecordBatch:
+    """
+    Encode the dimension columns of a batch.
+
+    Every batch shares the same dictionaries, which Arrow IPC files require.
+
+    Args:
+        batch: A batch of the cube
+        dimensions: The output of `collect_dimensions`
+        mode: One of DIMENSION_MODES
+    """
+    if mode not in DIMENSION_MODES:
+        raise ValueError(f"mode must be one of {DIMENSION_MODES}: {mode}")
+    if mode == "flat":
+        return batch
+
+    arrays = []
+    for name, array in zip(batch.schema.names, batch.columns):
+        if name in dimensions:
+            codes = pc.index_in(array, value_set=dimensions[name]).cast(CODE_TYPE)
+            if mode == "dictionary":
+                array = pa.DictionaryArray.from_arrays(codes, dimensions[name])
+            else:
+                array = codes
+        arrays.append(array)
+    return pa.RecordBatch.from_arrays(
+        arrays, schema=encoded_schema(batch.schema, dimensions, mode)
+    )
+
+
+def dimension_table(dimensions: dict[str, pa.Array]) -> pa.Table:
+    """
+    Returns:
+        One row per (dimension column, code) with the label it stands for
+    """
+    names, codes, labels = [], [], []
+    for name, values in dimensions.items():
+        names.extend([name] * len(values))
+        codes.extend(range(len(values)))
+        labels.append(values)
+    return pa.table(
+        [
+            pa.array(names, pa.string()),
+            pa.array(codes, CODE_TYPE),
+            pa.concat_arrays(labels) if labels else pa.array([], pa.string()),
+        ],
+        schema=DIMENSION_TABLE_SCHEMA,
+    )
+
+
+def decode_dimensions(tab: pa.Table, dimension_tab: pa.Table) -> pa.Table:
+    """
+    Replace the codes of a cube written with `dimensions="table"` by their labels.
+
+    Args:
+        tab: (Part of) the cube
+        dimension_tab: The cube's dimension table
+
+    Returns:
+        The table with every coded column as a dictionary array of labels
+    """
+    for name in set(dimension_tab["DIMENSION"].to_pylist()) & set(tab.column_names):
+        rows = dimension_tab.filter(pc.field("DIMENSION") == name).sort_by("CODE")
+        codes = tab[name].combine_chunks().cast(CODE_TYPE)
+        tab = tab.set_column(
+            tab.schema.get_field_index(name),
+            name,
+            pa.DictionaryArray.from_arrays(codes, rows["LABEL"].combine_chunks()),
+        )
+    return tab
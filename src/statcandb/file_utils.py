@@ -1,3 +1,5 @@
+import abc
+import io
 import tempfile
 import zipfile
 from contextlib import contextmanager
@@ -8,6 +10,20 @@ from urllib.parse import urlparse
 import requests
 
 from .pbar_utils import tqdm_if_verbose
+from .throttling import (
+    DEFAULT_RETRY_POLICY,
+    AdaptiveLimiter,
+    RetryPolicy,
+    get_limiter,
+    throttled_stream,
+)
+
+# Raised when the connection drops, or times out, while the body of a response
+# is being read
+INTERRUPTED_READ_ERRORS = (
+    requests.exceptions.ChunkedEncodingError,
+    requests.exceptions.ConnectionError,
+)
 
 
 def download_file(
@@ -16,6 +32,8 @@ def download_file(
     download_dir: Optional[Union[str, Path]] = None,
     session: Optional[requests.Session] = None,
     verbose: bool = False,
+    limiter: Optional[AdaptiveLimiter] = None,
+    policy: RetryPolicy = DEFAULT_RETRY_POLICY,
 ) -> Path:
     """
     Download the contents of a URL to a file.
@@ -32,6 +50,9 @@ def download_file(
             this or download_path
         session: Optionally, a requests.Session object to use when downloading
         verbose: If true, print a progressbar
+        limiter: Defaults to the process's (see `statcandb.throttling`)
+        policy: How often and how long to retry, both the request and a
+            download interrupted part way through
 
     Returns:
         The path to the downloaded file
@@ -53,24 +74,38 @@ def download_file(
     if not download_dir.exists():
         raise ValueError(f"download_dir must exist: {download_dir}")
 
-    with session.get(url, stream=True) as response:
-        response.raise_for_status()
-        with open(download_path, "wb") as outfile:
-            total_length = int(response.headers.get("content-length", 0))
-            with tqdm_if_verbose(
-                desc="Downloading",
-                total=total_length,
-                unit="iB",
-                unit_scale=True,
-                unit_divisor=1_024,
-                leave=False,
-                verbose=verbose,
-            ) as pbar:
-                for chunk in response.iter_content(1_024):
-                    outfile.write(chunk)
-                    pbar.update(len(chunk))
-
-    return download_path
+    limiter = limiter or get_limiter()
+    for attempt in range(policy.max_attempts):
+        with throttled_stream(
+            "GET", url, session=session, limiter=limiter, policy=policy
+        ) as response:
+            response.raise_for_status()
+            try:
+                _write_body(response, download_path, verbose)
+                return download_path
+            except INTERRUPTED_READ_ERRORS:
+                if attempt == policy.max_attempts - 1:
+                    raise
+        # Start again from the beginning, overwriting what was written
+        limiter.record_error()
+        limiter.sleep(policy.backoff(attempt))
+
+
+def _write_body(response: requests.Response, download_path: Path, verbose: bool):
+    with open(download_path, "wb") as outfile:
+        total_length = int(response.headers.get("content-length", 0))
+        with tqdm_if_verbose(
+            desc="Downloading",
+            total=total_length,
+            unit="iB",
+            unit_scale=True,
+            unit_divisor=1_024,
+            leave=False,
+            verbose=verbose,
+        ) as pbar:
+            for chunk in response.iter_content(1_024):
+                outfile.write(chunk)
+                pbar.update(len(chunk))
 
 
 @contextmanager
@@ -83,3 +118,60 @@ def unzip_file(filename: Path) -> Generator[Path, None, None]:
                 yield Path(tmpdir) / name
     else:
         yield filename
+
+
+class RangeFile(io.RawIOBase, abc.ABC):
+    """
+    A read-only, seekable file whose contents are fetched a range at a time,
+    e.g., with HTTP Range requests. Subclasses fetch the tail of the file when
+    created (which is where ZIP and parquet files keep their metadata) and
+    implement `_read_range`. Reads within the last range fetched are served
+    from memory.
+    """
+
+    def __init__(self, size: int, tail: bytes):
+        self.size = size
+        self.position = 0
+        self.block_start = size - len(tail)
+        self.block = tail
+        self.request_count = 1
+
+    @abc.abstractmethod
+    def _read_range(self, start: int, end: int) -> bytes:
+        """Fetch the bytes from start to end (exclusive)"""
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self.position
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_SET:
+            self.position = offset
+        elif whence == io.SEEK_CUR:
+            self.position += offset
+        elif whence == io.SEEK_END:
+            self.position = self.size + offset
+        else:
+            raise ValueError(f"Invalid whence: {whence}")
+        return self.position
+
+    def read(self, size: int = -1) -> bytes:
+        end = self.size if size < 0 else min(self.position + size, self.size)
+        if self.position >= end:
+            return b""
+
+        block_end = self.block_start + len(self.block)
+        if not (self.block_start <= self.position and end <= block_end):
+            self.request_count += 1
+            self.block_start = self.position
+            self.block = self._read_range(self.position, end)
+
+        offset = self.position - self.block_start
+        data = self.block[offset : offset + end - self.position]
+        self.position += len(data)
+        return data
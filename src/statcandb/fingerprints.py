@@ -0,0 +1,117 @@
+"""
+Detecting cube re-releases which didn't change the data.
+
+Many cubes are re-released with a new release time but a byte-identical CSV
+(e.g., only the metadata changed). To avoid re-downloading them, we record a
+fingerprint of each cube's CSV: the CRC32 and size of the CSV in the ZIP file.
+Both are stored in the ZIP's central directory at the end of the file, so the
+fingerprint of a remote cube can be read with a couple of small Range requests
+instead of downloading the whole ZIP file.
+"""
+import zipfile
+from pathlib import Path
+from typing import Optional, Union
+
+import requests
+from sqlalchemy import select
+
+from statcandb.file_utils import RangeFile
+from statcandb.models import CubeFingerprint
+from statcandb.throttling import throttled_request
+
+# Enough to cover the end of central directory record (and its comment) and,
+# for most cubes, the whole central directory in a single request
+TAIL_BYTES = 64 * 1_024
+
+
+class HttpRangeFile(RangeFile):
+    """A `RangeFile` backed by HTTP Range requests"""
+
+    def __init__(
+        self,
+        url: str,
+        session: Optional[requests.Session] = None,
+        tail_bytes: int = TAIL_BYTES,
+    ):
+        self.url = url
+        self.session = session or requests.session()
+
+        # Fetching the tail first tells us the size of the file
+        response = self._get(f"bytes=-{tail_bytes}")
+        # Some servers refuse a suffix longer than the file, but say how long it is
+        unsatisfiable = response.headers.get("Content-Range", "")
+        if response.status_code == 416 and unsatisfiable.startswith("bytes */"):
+            response.close()
+            response = self._get(f"bytes=0-{int(unsatisfiable[8:]) - 1}")
+        content_range = response.headers.get("Content-Range", "")
+        if response.status_code != 206 or "/" not in content_range:
+            response.close()
+            raise ValueError(f"Server does not support Range requests: {url}")
+        super().__init__(int(content_range.rsplit("/", 1)[1]), response.content)
+
+    def _get(self, range_header: str) -> requests.Response:
+        # Stream so that a server ignoring the Range header doesn't send us
+        # the whole file
+        response = throttled_request(
+            "GET",
+            self.url,
+            session=self.session,
+            headers={"Range": range_header},
+            stream=True,
+        )
+        if response.status_code != 416:
+            response.raise_for_status()
+        return response
+
+    def _read_range(self, start: int, end: int) -> bytes:
+        return self._get(f"bytes={start}-{end - 1}").content
+
+
+def zip_fingerprint(zf: zipfile.ZipFile, product_id: int) -> Optional[str]:
+    """
+    Returns:
+        The CRC32 and size of the cube's CSV as "<crc32>-<size>", or None if the
+        ZIP file doesn't contain it
+    """
+    try:
+        info = zf.getinfo(f"{product_id}.csv")
+    except KeyError:
+        return None
+    return f"{info.CRC:08x}-{info.file_size}"
+
+
+def get_local_fingerprint(zip_path: Union[str, Path], product_id: int) -> Optional[str]:
+    """The fingerprint of a downloaded cube's ZIP file"""
+    with zipfile.ZipFile(zip_path) as zf:
+        return zip_fingerprint(zf, product_id)
+
+
+def get_remote_fingerprint(
+    url: str, product_id: int, session: Optional[requests.Session] = None
+) -> Optional[str]:
+    """
+    The fingerprint of a cube's ZIP file, read from its central directory
+    without downloading the rest of the file
+
+    Returns:
+        The fingerprint, or None if it can't be determined (e.g., the server
+        doesn't support Range requests)
+    """
+    try:
+        with zipfile.ZipFile(HttpRangeFile(url, session=session)) as zf:
+            return zip_fingerprint(zf, product_id)
+    except (ValueError, zipfile.BadZipFile, requests.RequestException):
+        return None
+
+
+def get_stored_fingerprint(session, product_id: int) -> Optional[str]:
+    """
+    Returns:
+        The fingerprint recorded the last time this product was pulled, if any
+    """
+    return session.scalars(
+        select(CubeFingerprint.fingerprint)
+        .where(CubeFingerprint.number == product_id)
+        .order_by(CubeFingerprint.id.desc())
+        .limit(1)
+    ).first()
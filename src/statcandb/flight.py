@@ -0,0 +1,403 @@
+"""
+Serving cubes over Arrow Flight.
+
+Services which need whole cubes would otherwise each pull parquet from the
+bucket and decode it themselves. `CubeFlightServer` does that once and streams
+Arrow record batches instead. A request is a ticket holding JSON:
+
+    {"product_id": 14100287, "columns": ["REF_DATE", "VALUE"], "years": ["2023"]}
+
+where columns and years are optional and are pushed down into the read. Cubes
+come from a `statcandb.materialize.CubeSource` (local cubes, or ones downloaded
+from the bucket). Local Arrow IPC copies (e.g., 14100287.arrow next to
+14100287.parquet) are memory mapped rather than decoded.
+
+Hot cubes stay in memory in a `CubeCache`, which evicts the least recently
+used cubes once their total size passes its budget. Cubes too large for the
+budget are streamed from disk on every request. Streams are served from
+Flight's thread pool, so many `do_get`s can run at once.
+
+When a cube is republished, its cached copies (in memory and on disk) go
+stale. Given a way to get each cube's current version (e.g., its release time
+in the `products` table), the server checks it every so often and reloads
+cubes whose version changed.
+"""
+import json
+import shutil
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Callable, Optional, Union
+
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.flight as fl
+
+from statcandb.arrow_files import arrow_path_for, open_cube
+from statcandb.materialize import CubeSource
+
+DEFAULT_FLIGHT_PORT = 8815
+DEFAULT_CACHE_BYTES = 4 * 1_024 * 1_024 * 1_024  # 4 GiB
+DEFAULT_REVALIDATE_SECONDS = 60.0
+
+# Returns the current version of a product's cube, or None if unknown
+CubeVersion = Callable[[int], Optional[str]]
+
+# Keep year a string, as it is in unpartitioned cubes
+_YEAR_PARTITIONING = ds.partitioning(pa.schema([("year", pa.string())]), flavor="hive")
+
+
+def cube_ticket(
+    product_id: int,
+    columns: Optional[list[str]] = None,
+    years: Optional[list[Union[str, int]]] = None,
+) -> fl.Ticket:
+    """The ticket to ask `CubeFlightServer` for (part of) a cube"""
+    request = {"product_id": product_id}
+    if columns is not None:
+        request["columns"] = list(columns)
+    if years is not None:
+        request["years"] = [str(year) for year in years]
+    return fl.Ticket(json.dumps(request).encode())
+
+
+def open_cube_dataset(cube_path: Union[str, Path]) -> ds.Dataset:
+    """
+    A processed cube as a dataset, memory mapping its Arrow IPC copy if there
+    is one
+    """
+    cube_path = Path(cube_path)
+    arrow_path = arrow_path_for(cube_path)
+    if cube_path.suffix == ".arrow":
+        return open_cube(cube_path)
+    if arrow_path.is_dir():
+        return open_cube(arrow_path)
+    return ds.dataset(cube_path, format="parquet", partitioning=_YEAR_PARTITIONING)
+
+
+def cube_version_from_release_times(
+    get_release_times: Callable[[list[int]], dict],
+) -> CubeVersion:
+    """
+    Version cubes by their latest release time, e.g., with
+    `statcandb.materialize.latest_release_times`
+    """
+
+    def get_version(product_id: int) -> Optional[str]:
+        release_time = get_release_times([product_id]).get(product_id)
+        return None if release_time is None else str(release_time)
+
+    return get_version
+
+
+def local_cube_version(root: Union[str, Path]) -> CubeVersion:
+    """Version the cubes of `statcandb.materialize.local_cube_source` by mtime"""
+
+    def get_version(product_id: int) -> Optional[str]:
+        path = Path(root) / f"{product_id}.parquet"
+        if not path.is_dir():
+            return None
+        return str(max(p.stat().st_mtime_ns for p in [path, *path.rglob("*")]))
+
+    return get_version
+
+
+def _version_path(tmpdir: Path, product_id: int) -> Path:
+    return tmpdir / f"{product_id}.version"
+
+
+def remove_disk_copy(tmpdir: Path, product_id: int):
+    """
+    Remove a cube saved by `disk_cached_cube_source`. Cubes it didn't save
+    (e.g., those of a local source) are left alone
+    """
+    version_path = _version_path(tmpdir, product_id)
+    if version_path.exists():
+        shutil.rmtree(tmpdir / f"{product_id}.parquet", ignore_errors=True)
+        version_path.unlink(missing_ok=True)
+
+
+def disk_cached_cube_source(
+    get_cube: CubeSource, get_version: Optional[CubeVersion] = None
+) -> CubeSource:
+    """
+    Reuse cubes get_cube already downloaded into the directory it's given,
+    rather than fetching them again each time they're evicted from memory.
+    If get_version is given, a copy whose version has changed is fetched again
+    """
+
+    def get_cached_cube(product_id: int, tmpdir: Path) -> Optional[Path]:
+        path = tmpdir / f"{product_id}.parquet"
+        version_path = _version_path(tmpdir, product_id)
+        version = str(get_version(product_id)) if get_version is not None else ""
+        if path.is_dir() and version_path.exists():
+            if get_version is None or version_path.read_text() == version:
+                return path
+            remove_disk_copy(tmpdir, product_id)
+
+        path = get_cube(product_id, tmpdir)
+        if path is not None:
+            version_path.write_text(version)
+        return path
+
+    return get_cached_cube
+
+
+class CubeCache:
+    """Whole cubes in memory, evicting the least recently used past max_bytes"""
+
+    def __init__(self, max_bytes: int = DEFAULT_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self._tables: OrderedDict[int, pa.Table] = OrderedDict()
+        self._versions: dict[int, Optional[str]] = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def nbytes(self) -> int:
+        with self._lock:
+            return sum(table.nbytes for table in self._tables.values())
+
+    def product_ids(self) -> list[int]:
+        with self._lock:
+            return list(self._tables)
+
+    def get(self, product_id: int, version: Optional[str] = None) -> Optional[pa.Table]:
+        """The cached cube, unless it's missing or isn't of version"""
+        with self._lock:
+            table = self._tables.get(product_id)
+            if table is not None and self._versions.get(product_id) != version:
+                del self._tables[product_id]
+                table = None
+            if table is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._tables.move_to_end(product_id)
+            return table
+
+    def put(
+        self, product_id: int, table: pa.Table, version: Optional[str] = None
+    ) -> bool:
+        """
+        Cache a cube, evicting others to make room
+
+        Returns:
+            Whether the cube fit
+        """
+        if table.nbytes > self.max_bytes:
+            return False
+        with self._lock:
+            self._tables[product_id] = table
+            self._versions[product_id] = version
+            self._tables.move_to_end(product_id)
+            total = sum(t.nbytes for t in self._tables.values())
+            while total > self.max_bytes:
+                _, evicted = self._tables.popitem(last=False)
+                total -= evicted.nbytes
+        return True
+
+    def evict(self, product_id: int):
+        with self._lock:
+            self._tables.pop(product_id, None)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "products": list(self._tables),
+                "bytes": sum(t.nbytes for t in self._tables.values()),
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+
+def _project(
+    data: Union[pa.Table, ds.Dataset],
+    columns: Optional[list[str]],
+    years: Optional[list[str]],
+) -> Union[pa.Table, pa.RecordBatchReader]:
+    """Select columns and years from a cached table or a dataset on disk"""
+    names = data.schema.names
+    if columns is not None:
+        missing = sorted(set(columns) - set(names))
+        if missing:
+            raise fl.FlightServerError(f"No such columns: {', '.join(missing)}")
+    filter = None
+    if years is not None:
+        if "year" not in names:
+            raise fl.FlightServerError("The cube has no year column to filter on")
+        filter = ds.field("year").cast(pa.string()).isin(years)
+
+    if isinstance(data, pa.Table):
+        if filter is not None:
+            data = data.filter(filter)
+        return data.select(columns) if columns is not None else data
+    return data.scanner(columns=columns, filter=filter).to_reader()
+
+
+def estimated_nbytes(dataset: ds.Dataset) -> int:
+    """
+    Roughly how much memory a dataset takes once read: the uncompressed size
+    of its parquet row groups, or the size of its Arrow IPC files
+    """
+    total = 0
+    for fragment in dataset.get_fragments():
+        if isinstance(fragment, ds.ParquetFileFragment):
+            metadata = fragment.metadata
+            total += sum(
+                metadata.row_group(i).total_byte_size
+                for i in range(metadata.num_row_groups)
+            )
+        else:
+            total += Path(fragment.path).stat().st_size
+    return total
+
+
+def read_within(dataset: ds.Dataset, max_bytes: int) -> Optional[pa.Table]:
+    """
+    Read a dataset into memory, giving up as soon as it takes more than
+    max_bytes (e.g., if it's compressed more than `estimated_nbytes` guessed)
+    """
+    batches = []
+    total = 0
+    for batch in dataset.to_batches():
+        total += batch.nbytes
+        if total > max_bytes:
+            return None
+        batches.append(batch)
+    return pa.Table.from_batches(batches, schema=dataset.schema)
+
+
+class CubeFlightServer(fl.FlightServerBase):
+    """
+    An Arrow Flight server of processed cubes. See the module docstring for
+    the tickets it takes
+
+    Args:
+        location: Where to listen, e.g., "grpc://0.0.0.0:8815"
+        get_cube: Where to find each cube
+        cache: The cache of hot cubes
+        cache_dir: The directory get_cube may download cubes into. Defaults to
+            a temporary directory
+        get_version: If given, reload cubes whose version has changed
+        revalidate_seconds: Check the version of each cube this often
+    """
+
+    def __init__(
+        self,
+        location: str,
+        get_cube: CubeSource,
+        cache: Optional[CubeCache] = None,
+        cache_dir: Optional[Union[str, Path]] = None,
+        get_version: Optional[CubeVersion] = None,
+        revalidate_seconds: float = DEFAULT_REVALIDATE_SECONDS,
+        clock: Callable[[], float] = time.monotonic,
+        **kwargs,
+    ):
+        super().__init__(location, **kwargs)
+        self.get_cube = get_cube
+        self.cache = cache or CubeCache()
+        if cache_dir is None:
+            self._tmpdir = tempfile.TemporaryDirectory()
+            cache_dir = self._tmpdir.name
+        self.cache_dir = Path(cache_dir)
+        # One lock per product, so a cube is only loaded once at a time
+        self._load_locks: dict[int, threading.Lock] = {}
+        self._locks_lock = threading.Lock()
+        self.get_version = get_version
+        self.revalidate_seconds = revalidate_seconds
+        self.clock = clock
+        # When we last checked the version of each product, and what it was
+        self._checked: dict[int, tuple[float, Optional[str]]] = {}
+
+    def _load_lock(self, product_id: int) -> threading.Lock:
+        with self._locks_lock:
+            return self._load_locks.setdefault(product_id, threading.Lock())
+
+    def _version(self, product_id: int) -> Optional[str]:
+        """The product's version, checked at most every revalidate_seconds"""
+        if self.get_version is None:
+            return None
+        now = self.clock()
+        with self._locks_lock:
+            checked = self._checked.get(product_id)
+        if checked is not None and now - checked[0] < self.revalidate_seconds:
+            return checked[1]
+        version = self.get_version(product_id)
+        with self._locks_lock:
+            self._checked[product_id] = (now, version)
+        return version
+
+    def _cube(self, product_id: int) -> Union[pa.Table, ds.Dataset]:
+        """The cube from the cache, or else from its source"""
+        version = self._version(product_id)
+        table = self.cache.get(product_id, version)
+        if table is not None:
+            return table
+        with self._load_lock(product_id):
+            # Another stream may have loaded it while we waited
+            table = self.cache.get(product_id, version)
+            if table is not None:
+                return table
+            cube_path = self.get_cube(product_id, self.cache_dir)
+            if cube_path is None:
+                raise fl.FlightServerError(f"No cube for product {product_id}")
+            dataset = open_cube_dataset(cube_path)
+            if estimated_nbytes(dataset) > self.cache.max_bytes:
+                return dataset
+            table = read_within(dataset, self.cache.max_bytes)
+            if table is None or not self.cache.put(product_id, table, version):
+                return dataset
+            return table
+
+    def _request(self, ticket: fl.Ticket) -> tuple[int, Optional[list], Optional[list]]:
+        try:
+            request = json.loads(ticket.ticket.decode())
+            return (
+                int(request["product_id"]),
+                request.get("columns"),
+                request.get("years"),
+            )
+        except (ValueError, KeyError, TypeError) as e:
+            raise fl.FlightServerError(f"Bad ticket: {e}")
+
+    def do_get(self, context, ticket: fl.Ticket) -> fl.RecordBatchStream:
+        product_id, columns, years = self._request(ticket)
+        return fl.RecordBatchStream(_project(self._cube(product_id), columns, years))
+
+    def get_flight_info(self, context, descriptor: fl.FlightDescriptor):
+        """Descriptors are paths of one element, the product id"""
+        product_id = int(descriptor.path[0].decode())
+        cube = self._cube(product_id)
+        rows = cube.num_rows if isinstance(cube, pa.Table) else -1
+        endpoint = fl.FlightEndpoint(cube_ticket(product_id), [])
+        return fl.FlightInfo(cube.schema, descriptor, [endpoint], rows, -1)
+
+    def list_flights(self, context, criteria):
+        """The cubes in the cache"""
+        for product_id in self.cache.product_ids():
+            descriptor = fl.FlightDescriptor.for_path(str(product_id))
+            yield self.get_flight_info(context, descriptor)
+
+    def list_actions(self, context):
+        return [
+            ("cache-stats", "What's in the cache, as JSON"),
+            ("evict", "Drop the product id in the body from the caches"),
+        ]
+
+    def do_action(self, context, action: fl.Action):
+        if action.type == "cache-stats":
+            yield fl.Result(json.dumps(self.cache.stats()).encode())
+        elif action.type == "evict":
+            product_id = int(action.body.to_pybytes().decode())
+            with self._load_lock(product_id):
+                self.cache.evict(product_id)
+                with self._locks_lock:
+                    self._checked.pop(product_id, None)
+                remove_disk_copy(self.cache_dir, product_id)
+        else:
+            raise fl.FlightServerError(f"Unknown action {action.type}")
@@ -0,0 +1,181 @@
+"""
+Running cube conversions in a supervised worker process.
+
+A single pathological CSV can hang `process_cube` or use up all the memory on
+the machine, which would otherwise stall or kill a whole overnight run. A
+`CubeWorker` runs each conversion in a child process and watches it: if the
+conversion takes longer than its time limit, the child's resident memory
+grows past its limit, or the child dies, the child is killed and
+`LimitExceeded` is raised so the caller can defer the cube.
+
+Children are recycled after a number of conversions, so that memory
+fragmentation from one cube doesn't carry over to the next thousand. Resident
+memory is read from /proc, so the memory limit is only enforced on Linux.
+"""
+import multiprocessing
+import os
+import time
+from dataclasses import dataclass
+from multiprocessing.connection import Connection
+from typing import Any, Callable, Optional
+
+DEFAULT_POLL_SECONDS = 0.5
+
+
+@dataclass(frozen=True)
+class WorkerLimits:
+    """What a conversion may use before it's killed. 0 means unlimited"""
+
+    seconds: float = 0
+    max_rss_bytes: int = 0
+    # Replace the worker process after this many conversions
+    max_tasks: int = 0
+
+
+class LimitExceeded(Exception):
+    """
+    A conversion was killed. reason is one of "timeout", "memory", or "crashed"
+    """
+
+    def __init__(self, reason: str, message: str):
+        super().__init__(message)
+        self.reason = reason
+
+
+def _rss_bytes(pid: int) -> Optional[int]:
+    """The resident memory of a process, or None if it can't be determined"""
+    try:
+        with open(f"/proc/{pid}/statm") as infile:
+            return int(infile.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def _worker_main(conn: Connection):
+    while True:
+        task = conn.recv()
+        if task is None:
+            return
+        func, args, kwargs = task
+        try:
+            conn.send((True, func(*args, **kwargs)))
+        except Exception as e:
+            try:
+                conn.send((False, e))
+            except Exception:
+                # The exception itself can't be pickled
+                conn.send((False, RuntimeError(f"{type(e).__name__}: {e}")))
+
+
+class CubeWorker:
+    """
+    A child process which runs one function call at a time under `WorkerLimits`.
+
+    Use as a context manager so that the child is shut down at the end:
+
+        with CubeWorker(WorkerLimits(seconds=3_600)) as worker:
+            worker.run(process_cube, zip_path, outfile)
+    """
+
+    def __init__(
+        self, limits: WorkerLimits, poll_seconds: float = DEFAULT_POLL_SECONDS
+    ):
+        self.limits = limits
+        self.poll_seconds = poll_seconds
+        # Forking a process with pyarrow's and duckdb's thread pools running
+        # can deadlock, so always start from a fresh interpreter
+        self._context = multiprocessing.get_context("spawn")
+        self._process = None
+        self._conn = None
+        self._tasks = 0
+
+    @property
+    def pid(self) -> Optional[int]:
+        return self._process.pid if self._process is not None else None
+
+    def _start(self):
+        self._conn, child_conn = self._context.Pipe()
+        self._process = self._context.Process(
+            target=_worker_main, args=(child_conn,), daemon=True
+        )
+        self._process.start()
+        child_conn.close()
+        self._tasks = 0
+
+    def _kill(self):
+        if self._process is not None:
+            self._process.kill()
+            self._process.join()
+            self._conn.close()
+        self._process = None
+        self._conn = None
+
+    def close(self):
+        """Ask the child to exit, and kill it if it doesn't"""
+        if self._process is None:
+            return
+        try:
+            self._conn.send(None)
+        except OSError:
+            pass
+        self._process.join(timeout=5)
+        self._kill()
+
+    def __enter__(self) -> "CubeWorker":
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def run(self, func: Callable, *args, **kwargs) -> Any:
+        """
+        Call func(*args, **kwargs) in the worker process. func and its arguments
+        must be picklable, e.g., a module-level function like `process_cube`
+
+        Returns:
+            What func returned
+
+        Raises:
+            LimitExceeded: If the call breached a limit or the worker died. The
+                worker is replaced before the next call
+            Exception: Whatever func raised
+        """
+        if self._process is None:
+            self._start()
+
+        self._conn.send((func, args, kwargs))
+        start_time = time.monotonic()
+        while not self._conn.poll(self.poll_seconds):
+            if not self._process.is_alive():
+                exitcode = self._process.exitcode
+                self._kill()
+                raise LimitExceeded("crashed", f"Worker died with exit code {exitcode}")
+
+            elapsed = time.monotonic() - start_time
+            if self.limits.seconds and elapsed > self.limits.seconds:
+                self._kill()
+                raise LimitExceeded(
+                    "timeout", f"Took longer than {self.limits.seconds:,.0f} seconds"
+                )
+
+            rss = _rss_bytes(self._process.pid)
+            if self.limits.max_rss_bytes and rss and rss > self.limits.max_rss_bytes:
+                self._kill()
+                raise LimitExceeded(
+                    "memory",
+                    f"Used {rss:,} bytes, more than {self.limits.max_rss_bytes:,}",
+                )
+
+        try:
+            ok, value = self._conn.recv()
+        except EOFError:
+            self._kill()
+            raise LimitExceeded("crashed", "Worker exited without a result")
+
+        self._tasks += 1
+        if self.limits.max_tasks and self._tasks >= self.limits.max_tasks:
+            self.close()
+
+        if not ok:
+            raise value
+        return value
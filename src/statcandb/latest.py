@@ -0,0 +1,245 @@
+"""
+A small table per cube holding only the latest observation of each series.
+
+Most consumers only want the most recent value of each series, but cubes are
+stored as their full history. So next to each cube we keep a `latest` table
+with one row per COORDINATE: the cube's columns from the row with the most
+recent REF_DATE, plus the RELEASE_TIME of that row.
+
+The table is built once when a cube is processed and then kept up to date
+from the delta files, rather than recomputed from the full history.
+"""
+from datetime import datetime
+from pathlib import Path
+from typing import Optional, Union
+
+import duckdb
+import pyarrow.dataset as ds
+
+from statcandb.config import duckdb_config
+from statcandb.delta_files import (
+    PADDED_COORDINATE_REGEX,
+    SCALED_VALUE_TYPE,
+    SECURITY_LEVEL_CODES,
+    STATUS_CODES,
+    SYMBOL_CODES,
+)
+
+LATEST_REQUIRED_COLUMNS = {
+    "REF_DATE",
+    "VECTOR",
+    "COORDINATE",
+    "VALUE",
+    "STATUS",
+    "SYMBOL",
+}
+SCALED_VALUE_SQL_TYPE = (
+    f"DECIMAL({SCALED_VALUE_TYPE.precision}, {SCALED_VALUE_TYPE.scale})"
+)
+
+
+def latest_path_for(cube_path: Union[str, Path]) -> Path:
+    """
+    Where the latest table of a cube lives, e.g., 14100287.parquet ->
+    14100287.latest.parquet. This is a sibling rather than a child so that
+    globbing the cube's files doesn't pick it up
+    """
+    cube_path = Path(cube_path)
+    return cube_path.with_name(f"{cube_path.stem}.latest.parquet")
+
+
+def _quote(name: str) -> str:
+    return '"' + name.replace('"', '""') + '"'
+
+
+def _case(column: str, mapping: dict[int, Optional[str]]) -> str:
+    """Translate a delta file code into its representation in a full cube"""
+    whens = " ".join(
+        f"WHEN {code} THEN '{rep}'" for code, rep in mapping.items() if rep is not None
+    )
+    return f"CASE {column} {whens} ELSE NULL END"
+
+
+def delta_status_sql(alias: str = "d") -> str:
+    """
+    The STATUS a full cube would give a delta file row. Suppressed values are
+    reported as x, as in full cubes, which have empty strings rather than nulls
+    """
+    return (
+        f"coalesce({_case(f'{alias}.securityLevelCode', SECURITY_LEVEL_CODES)}, "
+        f"{_case(f'{alias}.statusCode', STATUS_CODES)}, '')"
+    )
+
+
+def delta_symbol_sql(alias: str = "d") -> str:
+    """The SYMBOL a full cube would give a delta file row"""
+    return f"coalesce({_case(f'{alias}.symbolCode', SYMBOL_CODES)}, '')"
+
+
+def delta_scaled_value_sql(names: list[str], alias: str = "d") -> str:
+    """
+    The SCALED_VALUE of a delta file row. Delta files split before scaledValue
+    existed (i.e., without it in names) only have the float value
+    """
+    if "scaledValue" in names:
+        return f"{alias}.scaledValue"
+    return (
+        f"CAST({alias}.value * pow(10, {alias}.scalarFactorCode) "
+        f"AS {SCALED_VALUE_SQL_TYPE})"
+    )
+
+
+def write_latest(
+    cube_path: Union[str, Path],
+    latest_path: Union[str, Path],
+    release_time: Optional[datetime] = None,
+    format: str = "parquet",
+) -> bool:
+    """
+    Compute the latest table of a processed cube.
+
+    Args:
+        cube_path: The directory the cube was written to by `process_cube`
+        latest_path: Where to write the latest table
+        release_time: The release time of the cube, recorded on every row
+        format: The format the cube was written in ("parquet" or "arrow")
+
+    Returns:
+        Whether a table was written. Cubes without vectors (e.g., the 98
+        series) have no latest table
+    """
+    cube = ds.dataset(cube_path, format=format, partitioning="hive")
+    if not LATEST_REQUIRED_COLUMNS <= set(cube.schema.names):
+        return False
+
+    columns = []
+    for name in cube.schema.names:
+        if name == "year":
+            continue
+        elif name == "REF_DATE":
+            columns.append("CAST(REF_DATE AS VARCHAR) AS REF_DATE")
+        elif name == "VALUE":
+            columns.append("CAST(VALUE AS DOUBLE) AS VALUE")
+        else:
+            columns.append(_quote(name))
+
+    release_time_sql = (
+        f"TIMESTAMP '{release_time:%Y-%m-%d %H:%M:%S}'" if release_time else "NULL"
+    )
+    columns.append(f"CAST({release_time_sql} AS TIMESTAMP) AS RELEASE_TIME")
+
+    with duckdb.connect(":memory:", read_only=False, config=duckdb_config()) as con:
+        con.register("cube", cube)
+        con.execute(
+            f"""
+            COPY (
+                SELECT {", ".join(columns)}
+                FROM cube
+                QUALIFY row_number() OVER (
+                    PARTITION BY COORDINATE ORDER BY CAST(REF_DATE AS VARCHAR) DESC
+                ) = 1
+                ORDER BY COORDINATE
+            ) TO '{latest_path}' (FORMAT 'parquet')
+            """
+        )
+    return True
+
+
+def update_latest(
+    latest_path: Union[str, Path],
+    delta_path: Union[str, Path],
+    new_path: Union[str, Path],
+    format: str = "parquet",
+):
+    """
+    Apply a delta file to a latest table.
+
+    A delta row replaces the latest row of its COORDINATE if its reference
+    period is at least as recent. Series which first appear in the delta file
+    are added, but without the dimension columns only the full cube has.
+
+    Args:
+        latest_path: The latest table to update
+        delta_path: The rows of the delta file for this cube, e.g., the
+            productId=... directory written by `split_delta_file`
+        new_path: Where to write the updated latest table
+        format: The format of the delta data ("parquet" or "arrow")
+    """
+    delta = ds.dataset(delta_path, format=format).to_table()
+
+    # Delta files give, e.g., 2023-01-01 for what the cube calls 2023-01
+    ref_date = "substr(d.refPer, 1, length(l.REF_DATE))"
+    # New series follow the format of the cube's other series
+    new_ref_date = (
+        "substr(d.refPer, 1, "
+        "coalesce((SELECT max(length(REF_DATE)) FROM latest), length(d.refPer)))"
+    )
+    is_newer = f"(d.coordinate IS NOT NULL AND {ref_date} >= l.REF_DATE)"
+    release_time = "strptime(d.releaseTime, '%Y-%m-%dT%H:%M')"
+    status = delta_status_sql()
+    symbol = delta_symbol_sql()
+    scaled_value = delta_scaled_value_sql(delta.schema.names)
+
+    with duckdb.connect(":memory:", read_only=False, config=duckdb_config()) as con:
+        con.register("delta", delta)
+        con.execute(f"CREATE TEMPORARY TABLE latest AS SELECT * FROM '{latest_path}'")
+        # Latest tables written before SCALED_VALUE existed don't get one
+        has_scaled_value = "SCALED_VALUE" in [
+            row[0] for row in con.execute("DESCRIBE latest").fetchall()
+        ]
+        replace_scaled_value = (
+            f"CASE WHEN {is_newer} THEN {scaled_value} ELSE l.SCALED_VALUE END"
+            " AS SCALED_VALUE,"
+            if has_scaled_value
+            else ""
+        )
+        select_scaled_value = (
+            f"{scaled_value} AS SCALED_VALUE," if has_scaled_value else ""
+        )
+        con.execute(
+            f"""
+            CREATE TEMPORARY TABLE d AS
+            SELECT * REPLACE (
+                regexp_replace(coordinate, '{PADDED_COORDINATE_REGEX}', '')
+                    AS coordinate
+            )
+            FROM delta
+            QUALIFY row_number() OVER (
+                PARTITION BY coordinate ORDER BY refPer DESC, releaseTime DESC
+            ) = 1
+            """
+        )
+        con.execute(
+            f"""
+            COPY (
+                SELECT l.* REPLACE (
+                    CASE WHEN {is_newer} THEN {ref_date} ELSE l.REF_DATE END
+                        AS REF_DATE,
+                    CASE WHEN {is_newer} THEN d.value ELSE l.VALUE END AS VALUE,
+                    {replace_scaled_value}
+                    CASE WHEN {is_newer} THEN {status} ELSE l.STATUS END AS STATUS,
+                    CASE WHEN {is_newer} THEN {symbol} ELSE l.SYMBOL END AS SYMBOL,
+                    CASE WHEN {is_newer} THEN {release_time} ELSE l.RELEASE_TIME END
+                        AS RELEASE_TIME
+                )
+                FROM latest l
+                LEFT JOIN d ON l.COORDINATE = d.coordinate
+
+                UNION ALL BY NAME
+
+                SELECT
+                    'v' || CAST(d.vectorId AS VARCHAR) AS VECTOR,
+                    d.coordinate AS COORDINATE,
+                    {new_ref_date} AS REF_DATE,
+                    d.value AS VALUE,
+                    {select_scaled_value}
+                    {status} AS STATUS,
+                    {symbol} AS SYMBOL,
+                    {release_time} AS RELEASE_TIME
+                FROM d
+                WHERE d.coordinate NOT IN (SELECT COORDINATE FROM latest)
+
+                ORDER BY COORDINATE
+            ) TO '{new_path}' (FORMAT 'parquet')
+            """
+        )
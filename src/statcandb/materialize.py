@@ -0,0 +1,251 @@
+"""
+Loading selected cubes into a local DuckDB database.
+
+Reading parquet over httpfs is too slow for low-latency lookups, so hot cubes
+can be loaded into a native DuckDB file instead. Each cube becomes
+
+    cube_<product id>    a table sorted by COORDINATE and REF_DATE, with a
+                         vectorId column and ART indexes on both
+    latest_<product id>  a view of the latest observation of each series
+
+A `_materialized` table records the release time each product was loaded at,
+so refreshing only reloads products released since.
+"""
+import shutil
+import tempfile
+from dataclasses import dataclass, field
+from datetime import datetime
+from pathlib import Path
+from typing import Callable, Optional, Union
+
+import duckdb
+import pyarrow.dataset as ds
+from sqlalchemy import func, select
+
+from statcandb.config import duckdb_config
+from statcandb.models import Product
+from statcandb.pbar_utils import tqdm_if_verbose
+from statcandb.s3 import download_prefix
+
+MATERIALIZED_TABLE = "_materialized"
+
+# Given a product and a scratch directory, returns where the product's cube is,
+# or None if there isn't one
+CubeSource = Callable[[int, Path], Optional[Path]]
+
+
+@dataclass
+class MaterializeResult:
+    """The products of a materialization, by what happened to them"""
+
+    loaded: list[int] = field(default_factory=list)
+    unchanged: list[int] = field(default_factory=list)
+    missing: list[int] = field(default_factory=list)
+
+    def __str__(self) -> str:
+        return (
+            f"{len(self.loaded)} loaded, {len(self.unchanged)} unchanged, "
+            f"{len(self.missing)} missing"
+        )
+
+
+def latest_release_times(session, product_ids: list[int]) -> dict[int, datetime]:
+    """
+    Returns:
+        The release time of the latest pull of each product that has been pulled
+    """
+    latest = (
+        select(func.max(Product.id))
+        .where(Product.number.in_(product_ids))
+        .group_by(Product.number)
+    )
+    rows = session.execute(
+        select(Product.number, Product.release_time).where(Product.id.in_(latest))
+    )
+    return dict(rows.all())
+
+
+def _create_materialized_table(con: duckdb.DuckDBPyConnection):
+    con.execute(
+        f"""
+        CREATE TABLE IF NOT EXISTS {MATERIALIZED_TABLE} (
+            product_id BIGINT PRIMARY KEY,
+            release_time TIMESTAMP,
+            materialized_at TIMESTAMP
+        )
+        """
+    )
+
+
+def materialized_products(con: duckdb.DuckDBPyConnection) -> dict[int, datetime]:
+    """
+    Returns:
+        The release time each product in the database was loaded at
+    """
+    _create_materialized_table(con)
+    return dict(
+        con.execute(
+            f"SELECT product_id, release_time FROM {MATERIALIZED_TABLE}"
+        ).fetchall()
+    )
+
+
+def load_cube(
+    con: duckdb.DuckDBPyConnection,
+    product_id: int,
+    cube_path: Union[str, Path],
+    release_time: Optional[datetime] = None,
+    format: str = "parquet",
+):
+    """
+    Replace a product's table and latest view with the cube in cube_path, in
+    a single transaction
+
+    Args:
+        con: A connection to the database
+        product_id: The product
+        cube_path: The directory the cube was written to by `process_cube`
+        release_time: The release time to record for the product
+        format: The format the cube was written in ("parquet" or "arrow")
+    """
+    cube = ds.dataset(cube_path, format=format, partitioning="hive")
+    names = set(cube.schema.names)
+    table = f"cube_{product_id}"
+    view = f"latest_{product_id}"
+
+    columns = ["*"]
+    if "VECTOR" in names:
+        # Cubes store vectors as, e.g., v41690973
+        columns.append("CAST(substr(VECTOR, 2) AS BIGINT) AS vectorId")
+    order_by = [name for name in ["COORDINATE", "REF_DATE"] if name in names]
+
+    _create_materialized_table(con)
+    con.register("cube_source", cube)
+    try:
+        con.execute("BEGIN TRANSACTION")
+        con.execute(f"DROP VIEW IF EXISTS {view}")
+        con.execute(f"DROP TABLE IF EXISTS {table}")
+        con.execute(
+            f"""
+            CREATE TABLE {table} AS
+            SELECT {", ".join(columns)}
+            FROM cube_source
+            {f"ORDER BY {', '.join(order_by)}" if order_by else ""}
+            """
+        )
+        if "COORDINATE" in names:
+            con.execute(f"CREATE INDEX {table}_coordinate ON {table} (COORDINATE)")
+        if "VECTOR" in names:
+            con.execute(f"CREATE INDEX {table}_vector_id ON {table} (vectorId)")
+        if {"COORDINATE", "REF_DATE"} <= names:
+            con.execute(
+                f"""
+                CREATE VIEW {view} AS
+                SELECT *
+                FROM {table}
+                QUALIFY row_number() OVER (
+                    PARTITION BY COORDINATE ORDER BY CAST(REF_DATE AS VARCHAR) DESC
+                ) = 1
+                """
+            )
+        con.execute(
+            f"""
+            INSERT OR REPLACE INTO {MATERIALIZED_TABLE}
+            VALUES (?, ?, current_timestamp)
+            """,
+            [product_id, release_time],
+        )
+        con.execute("COMMIT")
+    except Exception:
+        con.execute("ROLLBACK")
+        raise
+    finally:
+        con.unregister("cube_source")
+
+
+def needs_refresh(
+    product_id: int,
+    release_times: dict[int, datetime],
+    materialized: dict[int, datetime],
+) -> bool:
+    """
+    Whether a product has never been loaded, or has been released since it was.
+    Products the database doesn't know are always reloaded
+    """
+    if product_id not in materialized:
+        return True
+    release_time = release_times.get(product_id)
+    return release_time is None or release_time != materialized[product_id]
+
+
+def local_cube_source(root: Union[str, Path]) -> CubeSource:
+    """Cubes written by `statcandb full prepare` into root"""
+
+    def get_cube(product_id: int, tmpdir: Path) -> Optional[Path]:
+        path = Path(root) / f"{product_id}.parquet"
+        return path if path.is_dir() else None
+
+    return get_cube
+
+
+def bucket_cube_source(s3, bucket_name: str) -> CubeSource:
+    """Cubes uploaded to the bucket, downloaded one at a time"""
+
+    def get_cube(product_id: int, tmpdir: Path) -> Optional[Path]:
+        path = tmpdir / f"{product_id}.parquet"
+        shutil.rmtree(path, ignore_errors=True)
+        if download_prefix(s3, bucket_name, f"{product_id}.parquet/", path):
+            return path
+        return None
+
+    return get_cube
+
+
+def materialize(
+    database: Union[str, Path],
+    product_ids: list[int],
+    get_cube: CubeSource,
+    release_times: dict[int, datetime],
+    force: bool = False,
+    verbose: bool = False,
+) -> MaterializeResult:
+    """
+    Load cubes into a DuckDB database, skipping those already loaded at their
+    current release time
+
+    Args:
+        database: The DuckDB file. Created if it doesn't exist
+        product_ids: The products to load
+        get_cube: Where to find each cube (see `local_cube_source` and
+            `bucket_cube_source`)
+        release_times: The current release time of each product (see
+            `latest_release_times`)
+        force: If true, reload every product
+        verbose: If true, print a progressbar
+
+    Returns:
+        What happened to each product
+    """
+    result = MaterializeResult()
+    with duckdb.connect(
+        str(database), config=duckdb_config()
+    ) as con, tempfile.TemporaryDirectory() as tmpdir:
+        materialized = materialized_products(con)
+        with tqdm_if_verbose(
+            desc="Materializing", total=len(product_ids), verbose=verbose
+        ) as pbar:
+            for product_id in product_ids:
+                pbar.update(1)
+                if not force and not needs_refresh(
+                    product_id, release_times, materialized
+                ):
+                    result.unchanged.append(product_id)
+                    continue
+
+                cube_path = get_cube(product_id, Path(tmpdir))
+                if cube_path is None:
+                    result.missing.append(product_id)
+                    continue
+                load_cube(con, product_id, cube_path, release_times.get(product_id))
+                result.loaded.append(product_id)
+    return result
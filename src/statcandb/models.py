@@ -51,3 +51,105 @@ class Product(Base):
 
     created_at: Mapped[datetime] = mapped_column(default=UtcNow())
     updated_at: Mapped[datetime] = mapped_column(default=UtcNow(), onupdate=UtcNow())
+
+
+class Lease(Base):
+    """
+    A claim by a worker on a product that needs to be pulled. Used to share the
+    work of `delta-by-diff` among several nodes pointed at the same database
+    """
+
+    __tablename__ = "leases"
+
+    id: Mapped[int] = mapped_column(init=False, primary_key=True)
+    number: Mapped[int] = mapped_column(unique=True)
+    release_time: Mapped[datetime]
+    worker_id: Mapped[str]
+    expires_at: Mapped[datetime]
+    is_finished: Mapped[bool] = mapped_column(default=False)
+
+    created_at: Mapped[datetime] = mapped_column(default=UtcNow())
+    updated_at: Mapped[datetime] = mapped_column(default=UtcNow(), onupdate=UtcNow())
+
+
+class CubeStat(Base):
+    """
+    Size and timing of a single pull of a product. Used to estimate how long
+    the next pull will take
+    """
+
+    __tablename__ = "cube_stats"
+
+    id: Mapped[int] = mapped_column(init=False, primary_key=True)
+    number: Mapped[int] = mapped_column(index=True)
+    zip_bytes: Mapped[int]
+    row_count: Mapped[int]
+    seconds: Mapped[float]
+
+    created_at: Mapped[datetime] = mapped_column(default=UtcNow())
+
+
+class CubeFingerprint(Base):
+    """
+    The CRC32 and size of a product's CSV when it was last pulled. Used to skip
+    re-releases which didn't change the data (see `statcandb.fingerprints`)
+    """
+
+    __tablename__ = "cube_fingerprints"
+
+    id: Mapped[int] = mapped_column(init=False, primary_key=True)
+    number: Mapped[int] = mapped_column(index=True)
+    fingerprint: Mapped[str]
+
+    created_at: Mapped[datetime] = mapped_column(default=UtcNow())
+
+
+class UploadManifest(Base):
+    """
+    What a product's prefix in the bucket held right after it was uploaded.
+    `statcandb audit` checks the bucket against these
+    """
+
+    __tablename__ = "upload_manifests"
+
+    id: Mapped[int] = mapped_column(init=False, primary_key=True)
+    number: Mapped[int] = mapped_column(index=True)
+    file_count: Mapped[int]
+    row_count: Mapped[int]
+    schema_hash: Mapped[str]
+
+    created_at: Mapped[datetime] = mapped_column(default=UtcNow())
+
+
+class CubeChange(Base):
+    """
+    A change file published for a refresh of a product (see
+    `statcandb.changes`). The sequence numbers of a product count up from 1
+    """
+
+    __tablename__ = "cube_changes"
+
+    id: Mapped[int] = mapped_column(init=False, primary_key=True)
+    number: Mapped[int] = mapped_column(index=True)
+    sequence: Mapped[int]
+    inserted: Mapped[int]
+    updated: Mapped[int]
+    deleted: Mapped[int]
+
+    created_at: Mapped[datetime] = mapped_column(default=UtcNow())
+
+
+class CubeDeferral(Base):
+    """
+    A product whose conversion was killed for breaching a worker limit (see
+    `statcandb.isolation`) and moved to the large-cube lane. reason is one of
+    "timeout", "memory", or "crashed"
+    """
+
+    __tablename__ = "cube_deferrals"
+
+    id: Mapped[int] = mapped_column(init=False, primary_key=True)
+    number: Mapped[int] = mapped_column(index=True)
+    reason: Mapped[str]
+
+    created_at: Mapped[datetime] = mapped_column(default=UtcNow())
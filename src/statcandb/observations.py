@@ -0,0 +1,120 @@
+"""
+One long-format table of the observations of every cube.
+
+Each cube has its own schema, so catalog-wide questions (e.g., joining labour
+force data with population) otherwise mean one scan per cube, and DuckDB has
+to open thousands of prefixes. The observations dataset normalizes every cube
+into a common schema (see OBSERVATIONS_SCHEMA) and is partitioned by product:
+
+    observations/productId=14100287/part-0.parquet
+
+Within a file, rows are sorted by vectorId and then refDate and written in
+modest row groups, so the parquet statistics let readers skip most of a file
+when filtering on a vector. Refreshing a cube rewrites only its own partition,
+so the dataset is kept up to date one cube at a time. Read it all with, e.g.,
+
+    SELECT * FROM read_parquet('observations/*/*.parquet', hive_partitioning=1)
+"""
+from pathlib import Path
+from typing import Union
+
+import duckdb
+import pyarrow as pa
+import pyarrow.dataset as ds
+
+from statcandb.config import duckdb_config
+from statcandb.delta_files import SCALED_VALUE_TYPE
+from statcandb.latest import SCALED_VALUE_SQL_TYPE
+
+OBSERVATIONS_PREFIX = "observations"
+OBSERVATIONS_FILENAME = "part-0.parquet"
+OBSERVATIONS_ROW_GROUP_SIZE = 64 * 1_024
+
+# productId isn't stored in the files: it comes from the partition
+OBSERVATIONS_SCHEMA = pa.schema(
+    [
+        ("vectorId", pa.int64()),
+        ("coordinate", pa.string()),
+        ("refDate", pa.string()),
+        ("value", pa.float64()),
+        ("scaledValue", SCALED_VALUE_TYPE),
+        ("status", pa.string()),
+        ("symbol", pa.string()),
+    ]
+)
+OBSERVATIONS_REQUIRED_COLUMNS = {"REF_DATE", "VECTOR", "COORDINATE", "VALUE"}
+
+
+def observations_key(product_id: int) -> str:
+    """
+    Where a cube's observations live, relative to the root of the bucket or
+    the local observations directory
+    """
+    return f"{OBSERVATIONS_PREFIX}/productId={product_id}/{OBSERVATIONS_FILENAME}"
+
+
+def write_observations(
+    cube_path: Union[str, Path],
+    outfile: Union[str, Path],
+    format: str = "parquet",
+) -> bool:
+    """
+    Normalize a processed cube into the common observations schema.
+
+    Args:
+        cube_path: The directory the cube was written to by `process_cube`
+        outfile: Where to write the observations, usually under
+            `observations_key`
+        format: The format the cube was written in ("parquet" or "arrow")
+
+    Returns:
+        Whether a file was written. Cubes without vectors (e.g., the 98 series)
+        have no observations
+    """
+    cube = ds.dataset(cube_path, format=format, partitioning="hive")
+    names = set(cube.schema.names)
+    if not OBSERVATIONS_REQUIRED_COLUMNS <= names:
+        return False
+
+    # Cubes processed before SCALED_VALUE existed only have the float value
+    if "SCALED_VALUE" in names:
+        scaled_value = "SCALED_VALUE"
+    elif "SCALAR_ID" in names:
+        scaled_value = "VALUE * pow(10, SCALAR_ID)"
+    else:
+        scaled_value = "VALUE"
+    status = "CAST(STATUS AS VARCHAR)" if "STATUS" in names else "NULL"
+    symbol = "CAST(SYMBOL AS VARCHAR)" if "SYMBOL" in names else "NULL"
+
+    Path(outfile).parent.mkdir(parents=True, exist_ok=True)
+    with duckdb.connect(":memory:", read_only=False, config=duckdb_config()) as con:
+        con.register("cube", cube)
+        con.execute(
+            f"""
+            COPY (
+                SELECT
+                    CAST(substr(VECTOR, 2) AS BIGINT) AS vectorId,
+                    CAST(COORDINATE AS VARCHAR) AS coordinate,
+                    CAST(REF_DATE AS VARCHAR) AS refDate,
+                    CAST(VALUE AS DOUBLE) AS value,
+                    CAST({scaled_value} AS {SCALED_VALUE_SQL_TYPE}) AS scaledValue,
+                    {status} AS status,
+                    {symbol} AS symbol
+                FROM cube
+                ORDER BY vectorId, refDate
+            ) TO '{outfile}' (
+                FORMAT 'parquet', ROW_GROUP_SIZE {OBSERVATIONS_ROW_GROUP_SIZE}
+            )
+            """
+        )
+    return True
+
+
+def upload_observations(
+    s3, bucket_name: str, product_id: int, observations_path: Union[str, Path]
+):
+    """
+    Replace a cube's partition of the observations dataset in the bucket. It's a
+    single object, so readers see either the old or the new observations
+    """
+    s3.upload_file(str(observations_path), bucket_name, observations_key(product_id))
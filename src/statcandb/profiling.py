@@ -0,0 +1,190 @@
+"""
+Profiling the stages of processing a cube or a delta file.
+
+With `statcandb --profile DIR` (or STATCANDB_PROFILE=DIR), each stage wrapped
+in `profile_stage` writes three files to DIR/<key>/, where the key is usually
+the product id:
+
+    <stage>.pstats           cProfile statistics, for `python -m pstats` or
+                             snakeviz
+    <stage>.collapsed        stacks sampled every few milliseconds, one
+                             "frame;frame;frame count" line per stack, for
+                             flamegraph.pl or speedscope
+    <stage>.allocations.txt  the lines which allocated the most memory during
+                             the stage (from tracemalloc), its peak traced
+                             memory, and the peak of pyarrow's memory pool,
+                             which tracemalloc can't see
+
+Only the thread which enters a stage is profiled, and stages nested in another
+stage are profiled as part of it. When profiling is off, a stage costs a single
+check of a global. The setting is also stored in the environment, so worker
+processes started afterwards (e.g., by `statcandb.isolation.CubeWorker`)
+profile their stages too.
+"""
+import cProfile
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from contextlib import contextmanager
+from pathlib import Path
+from types import FrameType
+from typing import Any, Callable, Generator, Optional, Union
+
+import pyarrow as pa
+
+PROFILE_ENV_VAR = "STATCANDB_PROFILE"
+DEFAULT_SAMPLE_SECONDS = 0.005
+DEFAULT_TOP_ALLOCATIONS = 25
+
+_profile_dir: Optional[Path] = (
+    Path(os.environ[PROFILE_ENV_VAR]) if os.environ.get(PROFILE_ENV_VAR) else None
+)
+# Whether a stage is being profiled in this thread
+_active = threading.local()
+
+
+def get_profile_dir() -> Optional[Path]:
+    """Where profiles are written, or None if profiling is off"""
+    return _profile_dir
+
+
+def set_profile_dir(profile_dir: Optional[Union[str, Path]]):
+    """Turn profiling on (writing to profile_dir) or off (with None)"""
+    global _profile_dir
+    _profile_dir = Path(profile_dir) if profile_dir else None
+    if _profile_dir is None:
+        os.environ.pop(PROFILE_ENV_VAR, None)
+    else:
+        os.environ[PROFILE_ENV_VAR] = str(_profile_dir)
+
+
+def _frame_name(frame: FrameType) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({Path(code.co_filename).name}:{code.co_firstlineno})"
+
+
+class StackSampler:
+    """Counts the stacks of a thread, sampled from a background thread"""
+
+    def __init__(
+        self,
+        thread_id: Optional[int] = None,
+        interval: float = DEFAULT_SAMPLE_SECONDS,
+    ):
+        self.thread_id = thread_id or threading.get_ident()
+        self.interval = interval
+        self.stacks: Counter[str] = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            names = []
+            while frame is not None:
+                names.append(_frame_name(frame))
+                frame = frame.f_back
+            if names:
+                self.stacks[";".join(reversed(names))] += 1
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def write(self, path: Union[str, Path]):
+        """Write the stacks in the collapsed format of flamegraph.pl"""
+        with open(path, "w") as outfile:
+            for stack, count in self.stacks.most_common():
+                outfile.write(f"{stack} {count}\n")
+
+
+def _write_allocations(
+    path: Path,
+    before: tracemalloc.Snapshot,
+    after: tracemalloc.Snapshot,
+    peak_bytes: int,
+    seconds: float,
+    top: int,
+):
+    pool = pa.default_memory_pool()
+    with open(path, "w") as outfile:
+        outfile.write(f"Wall time: {seconds:,.2f}s\n")
+        outfile.write(f"Peak traced Python memory: {peak_bytes:,} bytes\n")
+        outfile.write(
+            f"Peak pyarrow memory pool ({pool.backend_name}) in this process: "
+            f"{pool.max_memory():,} bytes\n"
+        )
+        outfile.write(f"\nTop {top} allocations by net size:\n")
+        for stat in after.compare_to(before, "lineno")[:top]:
+            outfile.write(f"{stat}\n")
+
+
+@contextmanager
+def profile_stage(
+    stage: str, key: Union[str, int], top: int = DEFAULT_TOP_ALLOCATIONS
+) -> Generator[None, None, None]:
+    """
+    Profile the code in the block, if profiling is on
+
+    Args:
+        stage: The name of the stage, e.g., "process"
+        key: What the stage works on, usually a product id. Profiles are
+            written to a directory of this name
+        top: How many of the largest allocations to list
+    """
+    if _profile_dir is None or getattr(_active, "stage", None) is not None:
+        yield
+        return
+
+    outdir = _profile_dir / str(key)
+    outdir.mkdir(parents=True, exist_ok=True)
+
+    started_tracing = not tracemalloc.is_tracing()
+    if started_tracing:
+        tracemalloc.start()
+    tracemalloc.reset_peak()
+    before = tracemalloc.take_snapshot()
+
+    sampler = StackSampler()
+    profiler = cProfile.Profile()
+    start_time = time.monotonic()
+    _active.stage = stage
+    sampler.start()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        sampler.stop()
+        _active.stage = None
+        seconds = time.monotonic() - start_time
+        after = tracemalloc.take_snapshot()
+        _, peak_bytes = tracemalloc.get_traced_memory()
+        if started_tracing:
+            tracemalloc.stop()
+
+        profiler.dump_stats(outdir / f"{stage}.pstats")
+        sampler.write(outdir / f"{stage}.collapsed")
+        _write_allocations(
+            outdir / f"{stage}.allocations.txt",
+            before,
+            after,
+            peak_bytes,
+            seconds,
+            top,
+        )
+
+
+def profiled(stage: str, key: Union[str, int], func: Callable, *args, **kwargs) -> Any:
+    """
+    Call func(*args, **kwargs) in `profile_stage(stage, key)`. Module-level,
+    so that it can be sent to a worker process to profile the call there
+    """
+    with profile_stage(stage, key):
+        return func(*args, **kwargs)
@@ -0,0 +1,274 @@
+"""
+Refreshing cubes as soon as StatCan releases them.
+
+StatCan publishes at a fixed time (08:30 Eastern) on weekdays, and the changed
+cube list of the WDS reflects a release within minutes. Rather than polling on
+a fixed schedule, the refresh daemon sleeps until shortly before the next
+release, polls the changed cube list at a tight interval while the release
+window is open, hands newly changed cubes to the pipeline as soon as they
+appear, and backs off (doubling its interval) while nothing new shows up.
+Releases the pipeline reports as failed are dispatched again on a later poll.
+
+Freshness is the time from a cube's release to its upload, which the
+`products` table already records (release_time is Eastern time, created_at is
+UTC). Products which have been released but not yet uploaded are measured up
+to now.
+"""
+import json
+import threading
+import time as _time
+from dataclasses import asdict, dataclass
+from datetime import date, datetime, time, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Iterable, Optional
+from zoneinfo import ZoneInfo
+
+from sqlalchemy import func, select
+
+from statcandb.cubes import ProductMetadata
+from statcandb.models import Product
+
+RELEASE_TIMEZONE = ZoneInfo("America/Toronto")
+DEFAULT_RELEASE_TIME = time(8, 30)
+
+
+@dataclass(frozen=True)
+class RefreshWindow:
+    """When to poll the changed cube list, and how often"""
+
+    release_time: time = DEFAULT_RELEASE_TIME
+    # Start polling this long before the release time
+    lead_seconds: float = 60
+    # Stop polling this long after the release time
+    duration_seconds: float = 45 * 60
+    # Poll this often while new cubes keep appearing...
+    poll_seconds: float = 15
+    # ...and back off up to this often while none do
+    max_poll_seconds: float = 5 * 60
+    # StatCan doesn't publish on weekends
+    weekdays_only: bool = True
+
+    def release_on(self, day: date) -> datetime:
+        return datetime.combine(day, self.release_time, tzinfo=RELEASE_TIMEZONE)
+
+    def start_on(self, day: date) -> datetime:
+        return self.release_on(day) - timedelta(seconds=self.lead_seconds)
+
+    def end_on(self, day: date) -> datetime:
+        return self.release_on(day) + timedelta(seconds=self.duration_seconds)
+
+    def next_release_day(self, now: datetime) -> date:
+        """
+        The day of the window that's open at now, or else of the next one to
+        open. now must be timezone-aware
+        """
+        day = now.astimezone(RELEASE_TIMEZONE).date()
+        while (self.weekdays_only and day.weekday() >= 5) or self.end_on(day) <= now:
+            day += timedelta(days=1)
+        return day
+
+
+def new_releases(
+    changed: Iterable[ProductMetadata], known: dict[int, datetime]
+) -> list[ProductMetadata]:
+    """
+    Returns:
+        The latest release of each changed product that's newer than the
+        release time in known, sorted by product id
+    """
+    latest: dict[int, ProductMetadata] = {}
+    for product in changed:
+        if (
+            product.product_id not in latest
+            or product.release_time > latest[product.product_id].release_time
+        ):
+            latest[product.product_id] = product
+    return sorted(
+        product
+        for product in latest.values()
+        if product.product_id not in known
+        or product.release_time > known[product.product_id]
+    )
+
+
+def poll_window(
+    window: RefreshWindow,
+    day: date,
+    get_changed: Callable[[date], list[ProductMetadata]],
+    get_known: Callable[[list[int]], dict[int, datetime]],
+    dispatch: Callable[[list[ProductMetadata]], None],
+    now: Callable[[], datetime] = lambda: datetime.now(timezone.utc),
+    sleep: Callable[[float], None] = _time.sleep,
+    log: Callable[[str], None] = print,
+    get_failed: Callable[[], Iterable[ProductMetadata]] = lambda: (),
+) -> list[ProductMetadata]:
+    """
+    Poll the changed cube list of day until its window closes, dispatching
+    each new release once
+
+    Args:
+        window: When and how often to poll
+        day: The release day
+        get_changed: Returns the products changed on a day, e.g.,
+            `statcandb.cubes.get_changed_pid_list`
+        get_known: Returns the release time of the last pull of each of the
+            given products, e.g., `statcandb.materialize.latest_release_times`
+        dispatch: Hands new releases to the pipeline. Should return quickly
+        now: The current (timezone-aware) time
+        sleep: Sleeps for a number of seconds
+        get_failed: Returns the dispatched releases which failed and haven't
+            been dispatched again since. Each is dispatched again on the next
+            poll, even if it's no longer in the changed cube list
+
+    Returns:
+        The products dispatched
+    """
+    dispatched: dict[int, datetime] = {}
+    interval = window.poll_seconds
+    while (current := now()) < window.end_on(day):
+        failed = list(get_failed())
+        for product in failed:
+            if dispatched.get(product.product_id) == product.release_time:
+                del dispatched[product.product_id]
+
+        try:
+            changed = get_changed(day) + failed
+            known = get_known(sorted({product.product_id for product in changed}))
+        except Exception as e:
+            # The list is often briefly unavailable right at release time, and
+            # the database may be locked by the pipeline
+            log(f"Couldn't check for new releases: {e}")
+            changed, known = [], {}
+
+        new = new_releases(changed, {**known, **dispatched})
+        if new:
+            log(f"Dispatching {len(new)} newly released products")
+            dispatch(new)
+            dispatched.update((p.product_id, p.release_time) for p in new)
+            interval = window.poll_seconds
+        else:
+            interval = min(interval * 2, window.max_poll_seconds)
+
+        remaining = (window.end_on(day) - current).total_seconds()
+        sleep(max(min(interval, remaining), 0))
+    return [ProductMetadata(pid, release) for pid, release in dispatched.items()]
+
+
+def serve_refresh(
+    window: RefreshWindow,
+    get_changed: Callable[[date], list[ProductMetadata]],
+    get_known: Callable[[list[int]], dict[int, datetime]],
+    dispatch: Callable[[list[ProductMetadata]], None],
+    now: Callable[[], datetime] = lambda: datetime.now(timezone.utc),
+    sleep: Callable[[float], None] = _time.sleep,
+    log: Callable[[str], None] = print,
+    max_windows: Optional[int] = None,
+    get_failed: Callable[[], Iterable[ProductMetadata]] = lambda: (),
+):
+    """
+    Sleep until each release window opens and then `poll_window` it. Runs
+    forever unless max_windows is given. Arguments are as for `poll_window`
+    """
+    windows = 0
+    while max_windows is None or windows < max_windows:
+        day = window.next_release_day(now())
+        wait = (window.start_on(day) - now()).total_seconds()
+        if wait > 0:
+            log(f"Sleeping until {window.start_on(day):%Y-%m-%d %H:%M %Z}")
+            sleep(wait)
+        dispatched = poll_window(
+            window, day, get_changed, get_known, dispatch, now, sleep, log, get_failed
+        )
+        log(f"Window of {day} closed after dispatching {len(dispatched)} products")
+        windows += 1
+
+
+@dataclass(frozen=True)
+class Freshness:
+    product_id: int
+    # As published by StatCan, in Eastern time
+    release_time: datetime
+    # When the release was uploaded (in UTC), or None if it hasn't been yet
+    available_at: Optional[datetime]
+    # From the release to its upload, or to now if it hasn't been uploaded
+    lag_seconds: float
+
+
+def _as_utc(release_time: datetime) -> datetime:
+    return release_time.replace(tzinfo=RELEASE_TIMEZONE).astimezone(timezone.utc)
+
+
+def freshness(
+    session,
+    pending: Iterable[ProductMetadata] = (),
+    product_ids: Optional[list[int]] = None,
+    now: Optional[datetime] = None,
+) -> list[Freshness]:
+    """
+    The freshness of the latest release of each product
+
+    Args:
+        session: A database session
+        pending: Releases which have been dispatched but not uploaded yet
+        product_ids: Only these products. Defaults to every product uploaded
+        now: The current (timezone-aware) time
+
+    Returns:
+        One entry per product, sorted by product id
+    """
+    now = now or datetime.now(timezone.utc)
+    latest = select(func.max(Product.id)).where(Product.is_uploaded)
+    if product_ids is not None:
+        latest = latest.where(Product.number.in_(product_ids))
+    rows = session.execute(
+        select(Product.number, Product.release_time, Product.created_at).where(
+            Product.id.in_(latest.group_by(Product.number))
+        )
+    )
+
+    entries = {}
+    for number, release_time, created_at in rows:
+        available_at = created_at.replace(tzinfo=timezone.utc)
+        lag = (available_at - _as_utc(release_time)).total_seconds()
+        entries[number] = Freshness(number, release_time, available_at, lag)
+    for product in pending:
+        uploaded = entries.get(product.product_id)
+        if uploaded is None or uploaded.release_time < product.release_time:
+            lag = (now - _as_utc(product.release_time)).total_seconds()
+            entries[product.product_id] = Freshness(
+                product.product_id, product.release_time, None, lag
+            )
+    return [entries[number] for number in sorted(entries)]
+
+
+def serve_freshness(
+    port: int, get_freshness: Callable[[], list[Freshness]], host: str = ""
+) -> ThreadingHTTPServer:
+    """
+    Serve the freshness of every product as JSON at GET /freshness from a
+    background thread
+
+    Returns:
+        The server. Call its `shutdown` method to stop it
+    """
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.rstrip("/") != "/freshness":
+                self.send_error(404)
+                return
+            body = json.dumps(
+                [asdict(entry) for entry in get_freshness()], default=str
+            ).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
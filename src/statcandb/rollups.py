@@ -0,0 +1,349 @@
+"""
+Annual and quarterly aggregates of monthly and quarterly cubes.
+
+Users of sub-annual cubes mostly want annual (or quarterly) averages or sums,
+which otherwise get recomputed from the full monthly history on every query.
+So next to such cubes we keep one small rollup table per coarser frequency,
+e.g., 14100287.rollup-annual.parquet and 14100287.rollup-quarterly.parquet,
+with one row per COORDINATE and PERIOD (2019 or 2019-Q1):
+
+    VECTOR, COORDINATE, PERIOD
+    N_PERIODS       how many months (or quarters) the period has
+    N_OBSERVATIONS  how many of them have a value
+    COMPLETE        whether every one of them does
+    SUM, AVG, MIN, MAX
+                    of SCALED_VALUE, so scalar factors are applied and sums
+                    are exact. Missing (e.g., suppressed) values are skipped
+    STATUS, SYMBOL  every distinct flag of the period's observations, e.g.,
+                    "E,x". Empty if none of them were flagged
+
+Rollups have no dimension columns; join them to the latest table (see
+`statcandb.latest`) on COORDINATE for the labels. Use `table_for` to find the
+coarsest table which answers a query.
+
+The frequency of a cube is detected from its REF_DATEs: YYYY-MM dates are
+monthly, unless every month starts a quarter, in which case they're quarterly.
+Other cubes have no rollups.
+"""
+import re
+from pathlib import Path
+from typing import Iterable, Optional, Union
+
+import duckdb
+import pyarrow.dataset as ds
+
+from statcandb.config import duckdb_config
+from statcandb.delta_files import PADDED_COORDINATE_REGEX
+from statcandb.latest import (
+    SCALED_VALUE_SQL_TYPE,
+    delta_scaled_value_sql,
+    delta_status_sql,
+    delta_symbol_sql,
+)
+
+# The frequencies each frequency of cube is rolled up to, and how many of its
+# periods make up one of theirs
+ROLLUPS = {
+    "monthly": {"quarterly": 3, "annual": 12},
+    "quarterly": {"annual": 4},
+}
+# From coarsest to finest
+FREQUENCIES = ["annual", "quarterly", "monthly"]
+
+_YEAR_MONTH = re.compile(r"^\d{4}-(\d{2})$")
+_QUARTER_MONTHS = {1, 4, 7, 10}
+
+
+def rollup_path_for(cube_path: Union[str, Path], frequency: str) -> Path:
+    """
+    Where a rollup of a cube lives, e.g., (14100287.parquet, "annual") ->
+    14100287.rollup-annual.parquet
+    """
+    cube_path = Path(cube_path)
+    return cube_path.with_name(f"{cube_path.stem}.rollup-{frequency}.parquet")
+
+
+def rollup_paths(cube_path: Union[str, Path]) -> list[Path]:
+    """The rollups which exist next to a cube"""
+    return [
+        path
+        for path in (rollup_path_for(cube_path, frequency) for frequency in FREQUENCIES)
+        if path.exists()
+    ]
+
+
+def detect_frequency(ref_dates: Iterable[str]) -> Optional[str]:
+    """
+    Returns:
+        "monthly" or "quarterly" if ref_dates look like those of a monthly or
+        quarterly cube, or else None
+    """
+    months = set()
+    for ref_date in ref_dates:
+        match = _YEAR_MONTH.match(ref_date)
+        if match is None:
+            return None
+        months.add(int(match.group(1)))
+    if not months:
+        return None
+    # A single month could be either, so it's treated as monthly
+    if len(months) > 1 and months <= _QUARTER_MONTHS:
+        return "quarterly"
+    return "monthly"
+
+
+def cube_frequency(
+    cube_path: Union[str, Path], format: str = "parquet"
+) -> Optional[str]:
+    """The frequency of a processed cube (see `detect_frequency`)"""
+    cube = ds.dataset(cube_path, format=format, partitioning="hive")
+    if "REF_DATE" not in cube.schema.names:
+        return None
+    with duckdb.connect(":memory:", read_only=False, config=duckdb_config()) as con:
+        con.register("cube", cube)
+        ref_dates = con.execute(
+            "SELECT DISTINCT CAST(REF_DATE AS VARCHAR) FROM cube"
+        ).fetchall()
+    return detect_frequency(row[0] for row in ref_dates)
+
+
+def table_for(cube_path: Union[str, Path], frequency: str) -> Path:
+    """
+    The coarsest table next to a cube which answers queries at frequency,
+    i.e., its rollup to frequency if there is one and the cube itself if not
+
+    Args:
+        cube_path: The cube
+        frequency: "annual", "quarterly", or "monthly"
+    """
+    if frequency not in FREQUENCIES:
+        raise ValueError(f"Unknown frequency {frequency}")
+    rollup_path = rollup_path_for(cube_path, frequency)
+    return rollup_path if rollup_path.exists() else Path(cube_path)
+
+
+def _period(ref_date: str, frequency: str) -> str:
+    """The period of frequency a YYYY-MM REF_DATE falls in"""
+    year = f"substr({ref_date}, 1, 4)"
+    if frequency == "annual":
+        return year
+    quarter = f"(CAST(substr({ref_date}, 6, 2) AS INTEGER) + 2) // 3"
+    return f"{year} || '-Q' || CAST({quarter} AS VARCHAR)"
+
+
+def _flags(column: str) -> str:
+    return (
+        f"coalesce(string_agg(DISTINCT nullif({column}, ''), ',' "
+        f"ORDER BY nullif({column}, '')), '')"
+    )
+
+
+def _rollup_sql(table: str, source: str, frequency: str) -> str:
+    """
+    Aggregate a table of VECTOR, COORDINATE, REF_DATE (as text), SCALED_VALUE,
+    STATUS, and SYMBOL at frequency source up to frequency
+    """
+    n_periods = ROLLUPS[source][frequency]
+    return f"""
+        SELECT
+            any_value(VECTOR) AS VECTOR,
+            COORDINATE,
+            {_period("REF_DATE", frequency)} AS PERIOD,
+            CAST({n_periods} AS INTEGER) AS N_PERIODS,
+            CAST(count(SCALED_VALUE) AS INTEGER) AS N_OBSERVATIONS,
+            count(SCALED_VALUE) = {n_periods} AS COMPLETE,
+            CAST(sum(SCALED_VALUE) AS {SCALED_VALUE_SQL_TYPE}) AS SUM,
+            CAST(avg(SCALED_VALUE) AS {SCALED_VALUE_SQL_TYPE}) AS AVG,
+            min(SCALED_VALUE) AS MIN,
+            max(SCALED_VALUE) AS MAX,
+            {_flags("STATUS")} AS STATUS,
+            {_flags("SYMBOL")} AS SYMBOL
+        FROM {table}
+        GROUP BY COORDINATE, PERIOD
+        """
+
+
+def _cube_observations_sql(names: list[str], where: str = "") -> str:
+    """Select a cube's observations in the shape `_rollup_sql` expects"""
+    if "SCALED_VALUE" in names:
+        scaled_value = "SCALED_VALUE"
+    elif "SCALAR_ID" in names:
+        # Cubes written before SCALED_VALUE existed only have the float value
+        scaled_value = f"CAST(VALUE * pow(10, SCALAR_ID) AS {SCALED_VALUE_SQL_TYPE})"
+    else:
+        scaled_value = f"CAST(VALUE AS {SCALED_VALUE_SQL_TYPE})"
+    return f"""
+        SELECT
+            VECTOR,
+            COORDINATE,
+            CAST(REF_DATE AS VARCHAR) AS REF_DATE,
+            {scaled_value} AS SCALED_VALUE,
+            coalesce(STATUS, '') AS STATUS,
+            coalesce(SYMBOL, '') AS SYMBOL
+        FROM cube
+        {where}
+        """
+
+
+def write_rollups(
+    cube_path: Union[str, Path],
+    format: str = "parquet",
+    frequency: Optional[str] = None,
+) -> dict[str, Path]:
+    """
+    Compute the rollups of a processed cube and write them next to it.
+
+    Args:
+        cube_path: The directory the cube was written to by `process_cube`
+        format: The format the cube was written in ("parquet" or "arrow")
+        frequency: The frequency of the cube. Detected if not given
+
+    Returns:
+        The path of each rollup written, by its frequency. Empty for cubes
+        which aren't monthly or quarterly, or don't have vectors
+    """
+    cube = ds.dataset(cube_path, format=format, partitioning="hive")
+    if not {"VECTOR", "COORDINATE", "REF_DATE", "VALUE"} <= set(cube.schema.names):
+        return {}
+    frequency = frequency or cube_frequency(cube_path, format=format)
+    if frequency not in ROLLUPS:
+        return {}
+
+    paths = {}
+    with duckdb.connect(":memory:", read_only=False, config=duckdb_config()) as con:
+        con.register("cube", cube)
+        con.execute(
+            f"""
+            CREATE TEMPORARY TABLE observations AS
+            {_cube_observations_sql(cube.schema.names)}
+            """
+        )
+        for rollup in ROLLUPS[frequency]:
+            paths[rollup] = rollup_path_for(cube_path, rollup)
+            con.execute(
+                f"""
+                COPY (
+                    {_rollup_sql("observations", frequency, rollup)}
+                    ORDER BY COORDINATE, PERIOD
+                ) TO '{paths[rollup]}' (FORMAT 'parquet')
+                """
+            )
+    return paths
+
+
+def update_rollup(
+    rollup_path: Union[str, Path],
+    cube_path: Union[str, Path],
+    delta_path: Union[str, Path],
+    new_path: Union[str, Path],
+    frequency: str,
+    format: str = "parquet",
+    cube_format: str = "parquet",
+    source_frequency: Optional[str] = None,
+):
+    """
+    Apply a delta file to a rollup.
+
+    Only the periods the delta file touches are recomputed, from the delta
+    rows laid over the cube's observations of those periods. Only the years of
+    the cube the delta file touches are read, so the cube must be the version
+    the delta file applies to; rows of earlier delta files which weren't
+    merged into it are lost for the periods which are recomputed.
+
+    Args:
+        rollup_path: The rollup to update
+        cube_path: The directory the cube was written to by `process_cube`
+        delta_path: The rows of the delta file for this cube, e.g., the
+            productId=... directory written by `split_delta_file`
+        new_path: Where to write the updated rollup
+        frequency: The frequency of the rollup ("annual" or "quarterly")
+        format: The format of the delta data ("parquet" or "arrow")
+        cube_format: The format the cube was written in
+        source_frequency: The frequency of the cube. Detected if not given
+    """
+    source = source_frequency or cube_frequency(cube_path, format=cube_format)
+    if source not in ROLLUPS or frequency not in ROLLUPS[source]:
+        raise ValueError(f"A {source} cube has no {frequency} rollup")
+
+    delta = ds.dataset(delta_path, format=format).to_table()
+    cube = ds.dataset(cube_path, format=cube_format, partitioning="hive")
+
+    with duckdb.connect(":memory:", read_only=False, config=duckdb_config()) as con:
+        con.register("delta", delta)
+        con.register("cube", cube)
+        # Delta files give, e.g., 2023-01-01 for what the cube calls 2023-01
+        con.execute(
+            f"""
+            CREATE TEMPORARY TABLE d AS
+            SELECT * EXCLUDE (releaseTime)
+            FROM (
+                SELECT
+                    'v' || CAST(d.vectorId AS VARCHAR) AS VECTOR,
+                    regexp_replace(d.coordinate, '{PADDED_COORDINATE_REGEX}', '')
+                        AS COORDINATE,
+                    substr(d.refPer, 1, 7) AS REF_DATE,
+                    {delta_scaled_value_sql(delta.schema.names)} AS SCALED_VALUE,
+                    {delta_status_sql()} AS STATUS,
+                    {delta_symbol_sql()} AS SYMBOL,
+                    d.releaseTime
+                FROM delta d
+            )
+            QUALIFY row_number() OVER (
+                PARTITION BY COORDINATE, REF_DATE ORDER BY releaseTime DESC
+            ) = 1
+            """
+        )
+        con.execute(
+            f"""
+            CREATE TEMPORARY TABLE affected AS
+            SELECT DISTINCT COORDINATE, {_period("REF_DATE", frequency)} AS PERIOD
+            FROM d
+            """
+        )
+        years = [
+            row[0]
+            for row in con.execute(
+                "SELECT DISTINCT substr(REF_DATE, 1, 4) FROM d"
+            ).fetchall()
+        ]
+        if "year" in cube.schema.names:
+            # Skip the partitions of the years the delta file doesn't touch
+            year_list = ", ".join(f"'{year}'" for year in years) or "NULL"
+            where = f"WHERE CAST(year AS VARCHAR) IN ({year_list})"
+        else:
+            where = ""
+        # Delta rows win over the cube's rows for the same observation
+        con.execute(
+            f"""
+            CREATE TEMPORARY TABLE observations AS
+            SELECT * EXCLUDE (priority)
+            FROM (
+                SELECT *, 0 AS priority FROM d
+                UNION ALL BY NAME
+                SELECT c.*, 1 AS priority
+                FROM ({_cube_observations_sql(cube.schema.names, where)}) c
+                SEMI JOIN affected a
+                    ON c.COORDINATE = a.COORDINATE
+                    AND {_period("c.REF_DATE", frequency)} = a.PERIOD
+            )
+            QUALIFY row_number() OVER (
+                PARTITION BY COORDINATE, REF_DATE ORDER BY priority
+            ) = 1
+            """
+        )
+        con.execute(
+            f"""
+            COPY (
+                SELECT r.*
+                FROM '{rollup_path}' r
+                ANTI JOIN affected a
+                    ON r.COORDINATE = a.COORDINATE AND r.PERIOD = a.PERIOD
+
+                UNION ALL BY NAME
+
+                {_rollup_sql("observations", source, frequency)}
+
+                ORDER BY COORDINATE, PERIOD
+            ) TO '{new_path}' (FORMAT 'parquet')
+            """
+        )
@@ -1,6 +1,10 @@
+from pathlib import Path
+from typing import Union
+
 import boto3
 
 from statcandb.config import Config
+from statcandb.file_utils import RangeFile
 
 
 def get_s3(config: Config):
@@ -11,3 +15,51 @@ def get_s3(config: Config):
         aws_secret_access_key=config.aws_secret_access_key,
         region_name="auto",
     )
+
+
+class S3RangeFile(RangeFile):
+    """A `RangeFile` backed by ranged GETs of an object in a bucket"""
+
+    def __init__(self, s3, bucket_name: str, key: str, size: int, tail_bytes: int):
+        self.s3 = s3
+        self.bucket_name = bucket_name
+        self.key = key
+        super().__init__(size, self._read_range(max(size - tail_bytes, 0), size))
+
+    def _read_range(self, start: int, end: int) -> bytes:
+        if start >= end:
+            return b""
+        response = self.s3.get_object(
+            Bucket=self.bucket_name, Key=self.key, Range=f"bytes={start}-{end - 1}"
+        )
+        return response["Body"].read()
+
+
+def list_objects(s3, bucket_name: str, prefix: str) -> list[dict]:
+    """
+    Returns:
+        Every object under prefix (as returned by list_objects_v2), across pages
+    """
+    objects = []
+    paginator = s3.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix):
+        objects.extend(page.get("Contents", []))
+    return objects
+
+
+def download_prefix(
+    s3, bucket_name: str, prefix: str, download_dir: Union[str, Path]
+) -> list[str]:
+    """
+    Download every object under prefix, keeping the layout below the prefix
+
+    Returns:
+        The keys downloaded
+    """
+    download_dir = Path(download_dir)
+    keys = [obj["Key"] for obj in list_objects(s3, bucket_name, prefix)]
+    for key in keys:
+        local_path = download_dir / key[len(prefix) :]
+        local_path.parent.mkdir(parents=True, exist_ok=True)
+        s3.download_file(bucket_name, key, str(local_path))
+    return keys
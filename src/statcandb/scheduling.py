@@ -0,0 +1,127 @@
+"""
+Ordering cubes so that a run finishes as early as possible.
+
+A handful of cubes are tens of gigabytes while most are a few kilobytes. If a
+huge cube happens to start last, it dominates the end of the run. So we
+estimate the cost of each cube and dispatch the largest first. To make sure
+small cubes keep flowing (and so their freshness doesn't suffer), every few
+slots are given to the smallest remaining cube.
+"""
+import statistics
+from collections import deque
+from typing import Callable, Iterable, Optional
+
+import requests
+from sqlalchemy import func, select
+from sqlalchemy.orm import Session
+
+from statcandb.cubes import ProductMetadata
+from statcandb.models import CubeStat
+
+DEFAULT_SMALL_LANE_EVERY = 4
+
+
+def get_historical_costs(session: Session) -> dict[int, float]:
+    """
+    Returns:
+        A map from product id to the zip size of its most recent pull
+    """
+    latest = (
+        select(CubeStat.number, func.max(CubeStat.id).label("id"))
+        .group_by(CubeStat.number)
+        .subquery()
+    )
+    rows = session.execute(
+        select(CubeStat.number, CubeStat.zip_bytes).join(
+            latest, CubeStat.id == latest.c.id
+        )
+    )
+    return {number: float(zip_bytes) for number, zip_bytes in rows}
+
+
+def estimate_costs(
+    products: Iterable[ProductMetadata],
+    session: Session,
+    get_size: Optional[Callable[[int], Optional[int]]] = None,
+) -> dict[int, float]:
+    """
+    Estimate the cost of pulling each product, in bytes of ZIP file.
+
+    Uses the size recorded the last time a product was pulled. If that's
+    unavailable and `get_size` is passed (e.g., `statcandb.cubes.get_cube_size`)
+    ask the server. Otherwise, fall back to the median known cost.
+
+    Args:
+        products: The products to estimate
+        session: The database session
+        get_size: Optionally, a function from product id to its size in bytes
+
+    Returns:
+        A map from product id to estimated cost
+    """
+    history = get_historical_costs(session)
+    costs: dict[int, float] = {}
+    unknown = []
+    for product in products:
+        product_id = product.product_id
+        if product_id in history:
+            costs[product_id] = history[product_id]
+            continue
+
+        size = None
+        if get_size is not None:
+            try:
+                size = get_size(product_id)
+            except requests.exceptions.RequestException:
+                size = None
+
+        if size is None:
+            unknown.append(product_id)
+        else:
+            costs[product_id] = float(size)
+
+    default = statistics.median(costs.values()) if costs else 0.0
+    costs.update({product_id: default for product_id in unknown})
+    return costs
+
+
+def schedule(
+    products: Iterable[ProductMetadata],
+    costs: dict[int, float],
+    priority: Iterable[int] = (),
+    small_lane_every: int = DEFAULT_SMALL_LANE_EVERY,
+) -> list[ProductMetadata]:
+    """
+    Order products for processing.
+
+    Priority products go first. The rest are ordered largest-first, except
+    that every `small_lane_every`-th slot goes to the smallest remaining product.
+
+    Args:
+        products: The products to order
+        costs: The estimated cost of each product (see `estimate_costs`)
+        priority: Product ids which should be processed before all others
+        small_lane_every: How often to take from the small end. If <= 0,
+            the order is purely largest-first
+
+    Returns:
+        The products in the order they should be processed
+    """
+    priority = set(priority)
+
+    def key(p: ProductMetadata) -> tuple[float, int]:
+        return (-costs.get(p.product_id, 0.0), p.product_id)
+
+    products = list(products)
+    hot = sorted((p for p in products if p.product_id in priority), key=key)
+    rest = deque(sorted((p for p in products if p.product_id not in priority), key=key))
+
+    ordered = hot
+    slot = 0
+    while rest:
+        slot += 1
+        if small_lane_every > 0 and slot % small_lane_every == 0:
+            ordered.append(rest.pop())
+        else:
+            ordered.append(rest.popleft())
+    return ordered
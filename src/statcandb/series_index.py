@@ -0,0 +1,213 @@
+"""
+An index of the row groups holding each series of a cube.
+
+StatCan orders the rows of a cube by REF_DATE, so every row group holds
+every series, and pulling a single series out of a large cube means reading
+all of it. With `bloom_filters=True`, `process_cube` instead sorts each file
+by COORDINATE, so each series sits in one or two row groups, and writes:
+
+  * Bloom filters on COORDINATE and GEO. Readers which check them (e.g.,
+    DuckDB) skip row groups which certainly don't hold a value
+  * A small sidecar next to the cube, e.g., 14100287.series.parquet, listing
+    the (file, row group) pairs holding each COORDINATE and GEO. It's sorted,
+    so a lookup reads one of its own row groups, and then `read_series` reads
+    only the cube's row groups that hold the series. Over a
+    `pyarrow.fs.S3FileSystem`, those are Range GETs
+
+Paths are recorded relative to the parent of the cube, as in the bucket, e.g.,
+14100287.parquet/year=2013/part-0.parquet. Cubes whose GEO is stored as codes
+(`dimensions="table"`) only have their COORDINATEs indexed.
+"""
+from pathlib import Path
+from typing import Iterable, Optional, Union
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.fs as pafs
+import pyarrow.parquet as pq
+
+SERIES_INDEX_SCHEMA = pa.schema(
+    [
+        ("column", pa.string()),
+        ("value", pa.string()),
+        ("path", pa.string()),
+        ("row_group", pa.int32()),
+    ]
+)
+INDEXED_COLUMNS = ("COORDINATE", "GEO")
+SERIES_INDEX_ROW_GROUP_SIZE = 64 * 1_024
+
+# How `process_cube` sorts each file of a cube with bloom filters
+SERIES_SORT_KEYS = [("COORDINATE", "ascending"), ("REF_DATE", "ascending")]
+
+# Sized for the distinct COORDINATEs of a row group of a large cube
+BLOOM_FILTER_NDV = 100_000
+BLOOM_FILTER_FPP = 0.01
+
+
+def series_index_path_for(cube_path: Union[str, Path]) -> Path:
+    """
+    Where the series index of a cube lives, e.g., 14100287.parquet ->
+    14100287.series.parquet
+    """
+    cube_path = Path(cube_path)
+    return cube_path.with_name(f"{cube_path.stem}.series.parquet")
+
+
+def bloom_filter_options(names: Iterable[str]) -> dict[str, dict]:
+    """The `bloom_filter_options` for the indexed columns among names"""
+    return {
+        name: {"ndv": BLOOM_FILTER_NDV, "fpp": BLOOM_FILTER_FPP}
+        for name in names
+        if name in INDEXED_COLUMNS
+    }
+
+
+def bloom_filter_columns(path: Union[str, Path]) -> list[str]:
+    """The columns of a parquet file which have bloom filters"""
+    metadata = pq.ParquetFile(path).metadata
+    if metadata.num_row_groups == 0:
+        return []
+    row_group = metadata.row_group(0)
+    return [
+        row_group.column(i).path_in_schema
+        for i in range(row_group.num_columns)
+        if row_group.column(i).bloom_filter_offset is not None
+    ]
+
+
+def _indexable(field: pa.Field) -> bool:
+    type = field.type
+    if pa.types.is_dictionary(type):
+        type = type.value_type
+    return field.name in INDEXED_COLUMNS and pa.types.is_string(type)
+
+
+def index_cube_series(cube_path: Union[str, Path]) -> pa.Table:
+    """
+    Find the row groups holding each COORDINATE and GEO of a processed cube
+
+    Args:
+        cube_path: The directory the cube was written to by `process_cube`
+
+    Returns:
+        The index, sorted by column, value, and path
+    """
+    cube_path = Path(cube_path)
+    tables = [SERIES_INDEX_SCHEMA.empty_table()]
+    for filepath in sorted(cube_path.rglob("*.parquet")):
+        parquet_file = pq.ParquetFile(filepath)
+        columns = [
+            field.name for field in parquet_file.schema_arrow if _indexable(field)
+        ]
+        path = filepath.relative_to(cube_path.parent).as_posix()
+        for row_group in range(parquet_file.num_row_groups):
+            tab = parquet_file.read_row_group(row_group, columns=columns)
+            for column in columns:
+                values = pc.unique(tab[column].cast(pa.string())).drop_null()
+                n = len(values)
+                tables.append(
+                    pa.table(
+                        [
+                            pa.array([column] * n, pa.string()),
+                            values,
+                            pa.array([path] * n, pa.string()),
+                            pa.array([row_group] * n, pa.int32()),
+                        ],
+                        schema=SERIES_INDEX_SCHEMA,
+                    )
+                )
+    return pa.concat_tables(tables).sort_by(
+        [("column", "ascending"), ("value", "ascending"), ("path", "ascending")]
+    )
+
+
+def write_series_index(
+    cube_path: Union[str, Path], outfile: Optional[Union[str, Path]] = None
+) -> pa.Table:
+    """Index a cube and write the index next to it (or to outfile)"""
+    index = index_cube_series(cube_path)
+    pq.write_table(
+        index,
+        outfile or series_index_path_for(cube_path),
+        row_group_size=SERIES_INDEX_ROW_GROUP_SIZE,
+    )
+    return index
+
+
+def lookup_series(
+    index_path: str,
+    value: str,
+    column: str = "COORDINATE",
+    filesystem: Optional[pafs.FileSystem] = None,
+) -> pa.Table:
+    """
+    Find the row groups holding a series. Since the index is sorted, parquet
+    statistics let us skip all but the index's row group(s) holding it
+
+    Args:
+        index_path: The series index of the cube
+        value: The COORDINATE (or GEO) to look up
+        column: "COORDINATE" or "GEO"
+        filesystem: The filesystem the index lives on. Defaults to local disk
+
+    Returns:
+        The index entries for this value
+    """
+    return pq.read_table(
+        index_path,
+        filesystem=filesystem,
+        filters=[("column", "=", column), ("value", "=", value)],
+        schema=SERIES_INDEX_SCHEMA,
+    )
+
+
+def read_series(
+    cube_path: str,
+    value: str,
+    column: str = "COORDINATE",
+    root: str = ".",
+    filesystem: Optional[pafs.FileSystem] = None,
+    filter: Optional[ds.Expression] = None,
+) -> pa.Table:
+    """
+    Read the rows of a single series of a cube, touching only the row groups
+    that hold it
+
+    Args:
+        cube_path: The cube, relative to root, e.g., 14100287.parquet
+        value: The COORDINATE (or GEO) of the series
+        column: "COORDINATE" or "GEO"
+        root: The directory (or bucket) the cube and its index are in
+        filesystem: The filesystem `root` lives on. Defaults to local disk.
+            Pass, e.g., a `pyarrow.fs.S3FileSystem` to read from the bucket
+        filter: Further conditions on the rows, e.g., on the other dimensions
+            of a GEO
+
+    Returns:
+        The rows of the series
+    """
+    filesystem = filesystem or pafs.LocalFileSystem()
+    root = root.rstrip("/")
+    hits = lookup_series(
+        f"{root}/{series_index_path_for(cube_path).as_posix()}",
+        value,
+        column=column,
+        filesystem=filesystem,
+    )
+
+    condition = pc.field(column) == value
+    if filter is not None:
+        condition = condition & filter
+
+    tables = []
+    for path in pc.unique(hits["path"]).to_pylist():
+        row_groups = hits.filter(pc.equal(hits["path"], path))["row_group"]
+        with filesystem.open_input_file(f"{root}/{path}") as infile:
+            tab = pq.ParquetFile(infile).read_row_groups(row_groups.to_pylist())
+        tables.append(tab.filter(condition))
+
+    if not tables:
+        return pa.table({})
+    return pa.concat_tables(tables, promote_options="permissive")
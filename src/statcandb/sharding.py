@@ -0,0 +1,246 @@
+"""
+Utilities for splitting the work of pulling cubes among several nodes.
+
+There are two strategies:
+
+  * Static sharding: each node is told `--shard i/n` and only considers the
+    products whose hash lands in bucket `i`
+  * Leases: each node claims products one at a time from the `leases` table.
+    A claim expires unless it is renewed by a heartbeat, so if a node dies its
+    products are picked up by the others
+"""
+import socket
+import threading
+import uuid
+import zlib
+from datetime import datetime, timedelta, timezone
+from typing import Iterable
+
+from sqlalchemy import Engine, delete, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+from statcandb.cubes import ProductMetadata
+from statcandb.models import Lease
+
+DEFAULT_LEASE_SECONDS = 600
+
+
+def _utcnow() -> datetime:
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+def parse_shard(shard: str) -> tuple[int, int]:
+    """
+    Parse a shard specification of the form `i/n`
+
+    Args:
+        shard: The shard specification. `i` is 0-indexed, so must be in [0, n)
+
+    Returns:
+        The pair (i, n)
+    """
+    try:
+        index, count = (int(x) for x in shard.split("/"))
+    except ValueError:
+        raise ValueError(f"shard must be in the format i/n: {shard}")
+
+    if count <= 0 or not (0 <= index < count):
+        raise ValueError(f"shard index must satisfy 0 <= i < n: {shard}")
+
+    return index, count
+
+
+def shard_of(product_id: int, count: int) -> int:
+    """
+    Return the shard a product belongs to. This is stable across machines
+    and python processes (unlike `hash`)
+    """
+    return zlib.crc32(str(product_id).encode("ascii")) % count
+
+
+def filter_shard(
+    products: Iterable[ProductMetadata], index: int, count: int
+) -> list[ProductMetadata]:
+    """Keep only the products which belong to shard `index` of `count`"""
+    return [p for p in products if shard_of(p.product_id, count) == index]
+
+
+def default_worker_id() -> str:
+    """A worker id that is unique per process"""
+    return f"{socket.gethostname()}-{uuid.uuid4().hex[:8]}"
+
+
+def claim_lease(
+    session: Session,
+    product: ProductMetadata,
+    worker_id: str,
+    lease_seconds: int = DEFAULT_LEASE_SECONDS,
+) -> bool:
+    """
+    Attempt to claim a product for this worker.
+
+    A claim succeeds if no one has claimed the product, if a previous claim
+    finished an older release, or if a previous claim was never finished and
+    has expired.
+
+    Args:
+        session: The database session
+        product: The product to claim
+        worker_id: The id of the worker claiming the product
+        lease_seconds: How long the claim lasts without a heartbeat
+
+    Returns:
+        Whether the claim succeeded
+    """
+    now = _utcnow()
+    expires_at = now + timedelta(seconds=lease_seconds)
+
+    # The common case is that a previous release has been claimed and finished
+    # or that an old claim has died. Take it over atomically.
+    result = session.execute(
+        update(Lease)
+        .where(Lease.number == product.product_id)
+        .where(
+            (Lease.is_finished & (Lease.release_time < product.release_time))
+            | (~Lease.is_finished & (Lease.expires_at < now))
+        )
+        .values(
+            release_time=product.release_time,
+            worker_id=worker_id,
+            expires_at=expires_at,
+            is_finished=False,
+        )
+    )
+    session.commit()
+    if result.rowcount == 1:
+        return True
+
+    # Otherwise, no one may have ever claimed this product
+    try:
+        session.add(
+            Lease(
+                product.product_id,
+                product.release_time,
+                worker_id=worker_id,
+                expires_at=expires_at,
+            )
+        )
+        session.commit()
+    except IntegrityError:
+        session.rollback()
+        return False
+    return True
+
+
+def renew_lease(
+    session: Session,
+    product_id: int,
+    worker_id: str,
+    lease_seconds: int = DEFAULT_LEASE_SECONDS,
+) -> bool:
+    """
+    Extend a claim held by this worker
+
+    Returns:
+        Whether this worker still held the claim
+    """
+    result = session.execute(
+        update(Lease)
+        .where(Lease.number == product_id)
+        .where(Lease.worker_id == worker_id)
+        .where(~Lease.is_finished)
+        .values(expires_at=_utcnow() + timedelta(seconds=lease_seconds))
+    )
+    session.commit()
+    return result.rowcount == 1
+
+
+def finish_lease(session: Session, product_id: int, worker_id: str):
+    """Mark a claimed product as done so no other worker picks it up"""
+    session.execute(
+        update(Lease)
+        .where(Lease.number == product_id)
+        .where(Lease.worker_id == worker_id)
+        .values(is_finished=True)
+    )
+    session.commit()
+
+
+def release_lease(session: Session, product_id: int, worker_id: str):
+    """Give up a claim so another worker may pick up the product immediately"""
+    session.execute(
+        delete(Lease)
+        .where(Lease.number == product_id)
+        .where(Lease.worker_id == worker_id)
+        .where(~Lease.is_finished)
+    )
+    session.commit()
+
+
+def unfinished_products(
+    session: Session, products: Iterable[ProductMetadata]
+) -> list[ProductMetadata]:
+    """
+    Return the products whose current release has not been finished by any worker
+    """
+    finished = {
+        lease.number: lease.release_time
+        for lease in session.query(Lease).filter(Lease.is_finished)
+    }
+    return [
+        p
+        for p in products
+        if (p.product_id not in finished) or (finished[p.product_id] < p.release_time)
+    ]
+
+
+class LeaseHeartbeat:
+    """
+    A context manager which renews a claim in a background thread for as long
+    as the body is running. Uses its own session since sessions may not be
+    shared across threads.
+
+    If a renewal finds that another worker has taken the product over, the
+    heartbeat stops and sets `lost`, which the body should check before doing
+    anything the other worker will also do, e.g., uploading.
+    """
+
+    def __init__(
+        self,
+        engine: Engine,
+        product_id: int,
+        worker_id: str,
+        lease_seconds: int = DEFAULT_LEASE_SECONDS,
+    ):
+        self.engine = engine
+        self.product_id = product_id
+        self.worker_id = worker_id
+        self.lease_seconds = lease_seconds
+        self.lost = threading.Event()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        with Session(self.engine) as session:
+            while not self._stop.wait(self.lease_seconds / 3):
+                try:
+                    renewed = renew_lease(
+                        session, self.product_id, self.worker_id, self.lease_seconds
+                    )
+                except Exception:
+                    # E.g., the database is briefly locked. Try again next time,
+                    # while the lease still has time left
+                    session.rollback()
+                    continue
+                if not renewed:
+                    self.lost.set()
+                    return
+
+    def __enter__(self) -> "LeaseHeartbeat":
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
@@ -0,0 +1,359 @@
+"""
+Rate limiting and retrying requests to StatCan.
+
+The WDS throttles clients which make too many requests at once, answering
+409 or 429 (sometimes with a Retry-After header) rather than the data. Every
+WDS call goes through `throttled_request` (and every cube download through
+`throttled_stream`, which keeps counting the download until its body has been
+read), which waits for the process's `AdaptiveLimiter` before each attempt
+and retries throttled and failed attempts with jittered exponential backoff.
+
+The limiter is a token bucket plus a cap on requests in flight. Both adapt
+to what the server tells us: each throttled or failed request halves the
+rate and the cap (at most once per cooldown, since requests in flight when
+the server starts throttling all fail together), and a run of successful
+requests raises them again, one step at a time. A Retry-After pauses every
+request, not just the one that got it. So throughput settles just under the
+server's real limit.
+"""
+import random
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import Callable, Generator, Optional
+
+import requests
+
+# Retried, and count against the limiter. 409 is what the WDS sends when a
+# client makes too many requests
+RETRY_STATUSES = frozenset({409, 429, 500, 502, 503, 504})
+
+DEFAULT_REQUESTS_PER_SECOND = 5.0
+DEFAULT_CONCURRENCY = 4
+
+
+def retry_after_seconds(
+    response: requests.Response, now: Optional[datetime] = None
+) -> Optional[float]:
+    """
+    Returns:
+        How long the response's Retry-After header asks us to wait, or None if
+        it doesn't have one we understand
+    """
+    value = response.headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        when = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    now = now or datetime.now(timezone.utc)
+    return max((when - now).total_seconds(), 0.0)
+
+
+class TokenBucket:
+    """Allows rate requests per second on average, in bursts of up to burst"""
+
+    def __init__(
+        self,
+        rate: float,
+        burst: float = 1.0,
+        clock: Callable[[], float] = time.monotonic,
+        sleep: Callable[[float], None] = time.sleep,
+    ):
+        self.rate = rate
+        self.burst = burst
+        self.clock = clock
+        self.sleep = sleep
+        self._tokens = burst
+        self._updated = clock()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = self.clock()
+        self._tokens = min(self._tokens + (now - self._updated) * self.rate, self.burst)
+        self._updated = now
+
+    def acquire(self):
+        """Wait for a token and take it"""
+        while True:
+            with self._lock:
+                self._refill()
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            self.sleep(wait)
+
+
+class AdaptiveLimiter:
+    """
+    Limits the rate and concurrency of requests, adapting both to how often
+    the server throttles us. See the module docstring
+
+    Args:
+        rate: The requests per second to start at
+        concurrency: The requests in flight to start at
+        min_rate, max_rate: The range rate adapts within
+        max_concurrency: The most requests in flight concurrency adapts to
+        increase_after: Raise the rate and concurrency after this many
+            successes in a row
+        rate_step: How much to raise the rate by each time
+        decrease_factor: What to multiply the rate and concurrency by after
+            an error
+        cooldown_seconds: Decrease at most this often
+    """
+
+    def __init__(
+        self,
+        rate: float = DEFAULT_REQUESTS_PER_SECOND,
+        concurrency: int = DEFAULT_CONCURRENCY,
+        min_rate: float = 0.1,
+        max_rate: float = 50.0,
+        max_concurrency: int = 32,
+        increase_after: int = 10,
+        rate_step: float = 0.5,
+        decrease_factor: float = 0.5,
+        cooldown_seconds: float = 5.0,
+        clock: Callable[[], float] = time.monotonic,
+        sleep: Callable[[float], None] = time.sleep,
+    ):
+        self.bucket = TokenBucket(rate, max(concurrency, 1), clock, sleep)
+        self.concurrency = concurrency
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.max_concurrency = max_concurrency
+        self.increase_after = increase_after
+        self.rate_step = rate_step
+        self.decrease_factor = decrease_factor
+        self.cooldown_seconds = cooldown_seconds
+        self.clock = clock
+        self.sleep = sleep
+        self.successes = 0
+        self.errors = 0
+        self._streak = 0
+        self._last_decrease: Optional[float] = None
+        self._paused_until = clock()
+        self._in_flight = 0
+        self._condition = threading.Condition()
+
+    @property
+    def rate(self) -> float:
+        return self.bucket.rate
+
+    @property
+    def in_flight(self) -> int:
+        return self._in_flight
+
+    def acquire(self):
+        """
+        Wait until a request may start (no pause, a free slot, and a token)
+        and count it as in flight. Call `release` once it's done
+        """
+        while True:
+            with self._condition:
+                pause = self._paused_until - self.clock()
+                if pause <= 0:
+                    if self._in_flight < self.concurrency:
+                        self._in_flight += 1
+                        break
+                    # Check the pause again once woken, as it may have changed
+                    self._condition.wait()
+                    continue
+            self.sleep(pause)
+        try:
+            self.bucket.acquire()
+        except BaseException:
+            self.release()
+            raise
+
+    def release(self):
+        with self._condition:
+            self._in_flight -= 1
+            self._condition.notify_all()
+
+    @contextmanager
+    def slot(self) -> Generator[None, None, None]:
+        """Count a request as in flight in the block (see `acquire`)"""
+        self.acquire()
+        try:
+            yield
+        finally:
+            self.release()
+
+    def record_success(self):
+        with self._condition:
+            self.successes += 1
+            self._streak += 1
+            if self._streak >= self.increase_after:
+                self._streak = 0
+                self.bucket.rate = min(self.bucket.rate + self.rate_step, self.max_rate)
+                self.concurrency = min(self.concurrency + 1, self.max_concurrency)
+                self.bucket.burst = self.concurrency
+                self._condition.notify_all()
+
+    def record_error(self, retry_after: Optional[float] = None):
+        """Count a throttled or failed request, pausing for retry_after seconds"""
+        with self._condition:
+            self.errors += 1
+            self._streak = 0
+            now = self.clock()
+            if retry_after:
+                self._paused_until = max(self._paused_until, now + retry_after)
+            if (
+                self._last_decrease is None
+                or now - self._last_decrease >= self.cooldown_seconds
+            ):
+                self._last_decrease = now
+                self.bucket.rate = max(
+                    self.bucket.rate * self.decrease_factor, self.min_rate
+                )
+                self.concurrency = max(int(self.concurrency * self.decrease_factor), 1)
+                self.bucket.burst = self.concurrency
+
+
+@dataclass(frozen=True)
+class RetryPolicy:
+    max_attempts: int = 6
+    # The first retry waits up to this long, doubling each attempt...
+    base_seconds: float = 1.0
+    # ...up to this long
+    max_seconds: float = 120.0
+
+    def __post_init__(self):
+        if self.max_attempts < 1:
+            raise ValueError("max_attempts must be at least 1")
+
+    def backoff(self, attempt: int, rng: random.Random = random) -> float:
+        """How long to wait after attempt (from 0), with full jitter"""
+        return rng.uniform(0, min(self.max_seconds, self.base_seconds * 2**attempt))
+
+
+DEFAULT_RETRY_POLICY = RetryPolicy()
+
+limiter = None
+
+
+def get_limiter() -> AdaptiveLimiter:
+    """The limiter shared by every request of this process"""
+    global limiter
+    if limiter is None:
+        limiter = AdaptiveLimiter()
+    return limiter
+
+
+def set_limiter(new_limiter: AdaptiveLimiter):
+    global limiter
+    limiter = new_limiter
+
+
+def _throttled_response(
+    method: str,
+    url: str,
+    session: Optional[requests.Session],
+    limiter: AdaptiveLimiter,
+    policy: RetryPolicy,
+    rng: random.Random,
+    **kwargs,
+) -> requests.Response:
+    """
+    The work of `throttled_request`, except that the response is returned
+    still holding a slot of limiter, which the caller must release
+    """
+    session = session or requests
+    for attempt in range(policy.max_attempts):
+        last_attempt = attempt == policy.max_attempts - 1
+        limiter.acquire()
+        try:
+            response = session.request(method, url, **kwargs)
+        except (requests.ConnectionError, requests.Timeout):
+            limiter.release()
+            limiter.record_error()
+            if last_attempt:
+                raise
+            limiter.sleep(policy.backoff(attempt, rng))
+            continue
+        except BaseException:
+            limiter.release()
+            raise
+
+        if response.status_code not in RETRY_STATUSES:
+            limiter.record_success()
+            return response
+
+        retry_after = retry_after_seconds(response)
+        limiter.record_error(retry_after)
+        if last_attempt:
+            return response
+        response.close()
+        limiter.release()
+        limiter.sleep(max(policy.backoff(attempt, rng), retry_after or 0))
+
+
+def throttled_request(
+    method: str,
+    url: str,
+    session: Optional[requests.Session] = None,
+    limiter: Optional[AdaptiveLimiter] = None,
+    policy: RetryPolicy = DEFAULT_RETRY_POLICY,
+    rng: random.Random = random,
+    **kwargs,
+) -> requests.Response:
+    """
+    Make a request once the limiter allows it, retrying throttled requests,
+    server errors, and connection errors. The request stops counting against
+    the limiter once the response arrives, so use `throttled_stream` for
+    large bodies
+
+    Args:
+        method: E.g., "GET"
+        url: The URL to request
+        session: Optionally, a requests.Session to make the request with
+        limiter: Defaults to the process's (see `get_limiter`)
+        policy: How often and how long to retry
+        **kwargs: Passed to `requests.Session.request`
+
+    Returns:
+        The response. Like `requests.request`, this doesn't raise for error
+        statuses, including one still throttled after the last attempt
+
+    Raises:
+        requests.exceptions.ConnectionError, requests.exceptions.Timeout: If
+            the last attempt failed to connect
+    """
+    limiter = limiter or get_limiter()
+    response = _throttled_response(method, url, session, limiter, policy, rng, **kwargs)
+    limiter.release()
+    return response
+
+
+@contextmanager
+def throttled_stream(
+    method: str,
+    url: str,
+    session: Optional[requests.Session] = None,
+    limiter: Optional[AdaptiveLimiter] = None,
+    policy: RetryPolicy = DEFAULT_RETRY_POLICY,
+    rng: random.Random = random,
+    **kwargs,
+) -> Generator[requests.Response, None, None]:
+    """
+    `throttled_request` with stream=True, counting the request as in flight
+    until the block exits, so the limiter covers reading the whole body
+    """
+    limiter = limiter or get_limiter()
+    response = _throttled_response(
+        method, url, session, limiter, policy, rng, stream=True, **kwargs
+    )
+    try:
+        with response:
+            yield response
+    finally:
+        limiter.release()
@@ -0,0 +1,338 @@
+"""
+A global index from vectorId to where that vector's rows live.
+
+StatCan addresses series by vectorId, but our cubes are stored by product, so
+without an index, pulling the history of one vector means knowing its product
+and scanning the whole cube. The index maps each vectorId to its productId,
+coordinate, and the (file, row group) pairs that contain it, both in processed
+cubes and in split delta files.
+
+The index lives in a directory:
+
+  * `index.parquet` is the compacted index, sorted by vectorId and written with
+    small row groups so that a point lookup reads a single row group
+  * `pending/` holds small sorted fragments added since the last compaction.
+    Their names record the order they were added in, their source, and for
+    cubes, the product they replace
+
+Re-indexing a cube drops everything previously indexed for that product
+(including delta files, which are folded into the refreshed cube).
+"""
+from pathlib import Path
+from typing import Optional, Union
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.fs as pafs
+import pyarrow.parquet as pq
+
+from statcandb.delta_files import trim_coordinate
+
+VECTOR_INDEX_SCHEMA = pa.schema(
+    [
+        ("vectorId", pa.int64()),
+        ("productId", pa.int64()),
+        ("coordinate", pa.string()),
+        ("source", pa.string()),  # Either "cube" or "delta"
+        ("path", pa.string()),  # Relative to the root of the bucket / output dir
+        ("row_group", pa.int32()),
+    ]
+)
+
+INDEX_FILENAME = "index.parquet"
+PENDING_DIRNAME = "pending"
+INDEX_ROW_GROUP_SIZE = 64 * 1_024
+
+
+def _row_group_entries(
+    parquet_file: pq.ParquetFile,
+    product_id: int,
+    source: str,
+    path: str,
+    vector_column: str,
+    coordinate_column: str,
+) -> list[pa.Table]:
+    tables = []
+    for row_group in range(parquet_file.num_row_groups):
+        tab = parquet_file.read_row_group(
+            row_group, columns=[vector_column, coordinate_column]
+        )
+        vectors = tab[vector_column]
+        coordinates = tab[coordinate_column].cast(pa.string())
+        if source == "cube":
+            # Cubes store vectors as, e.g., v41690973
+            vectors = pc.utf8_slice_codeunits(vectors, 1)
+        else:
+            coordinates = trim_coordinate(coordinates)
+        tab = (
+            pa.table(
+                {
+                    "vectorId": vectors.cast(pa.int64()),
+                    "coordinate": coordinates,
+                }
+            )
+            .group_by(["vectorId", "coordinate"])
+            .aggregate([])
+        )
+        n = tab.num_rows
+        tables.append(
+            pa.table(
+                [
+                    tab["vectorId"],
+                    pa.array([product_id] * n, pa.int64()),
+                    tab["coordinate"],
+                    pa.array([source] * n, pa.string()),
+                    pa.array([path] * n, pa.string()),
+                    pa.array([row_group] * n, pa.int32()),
+                ],
+                schema=VECTOR_INDEX_SCHEMA,
+            )
+        )
+    return tables
+
+
+def _sorted(tab: pa.Table) -> pa.Table:
+    return tab.sort_by([("vectorId", "ascending"), ("path", "ascending")])
+
+
+def index_cube(product_id: int, cube_path: Union[str, Path]) -> pa.Table:
+    """
+    Build index entries for a processed cube (the output of `process_cube`).
+
+    Paths are recorded relative to the parent of `cube_path`, so that they
+    match the layout of the bucket, e.g., `14100287.parquet/year=2013/part-0.parquet`
+
+    Args:
+        product_id: The product the cube belongs to
+        cube_path: The directory the cube was written to
+
+    Returns:
+        The index entries, sorted by vectorId
+    """
+    cube_path = Path(cube_path)
+    tables = [VECTOR_INDEX_SCHEMA.empty_table()]
+    for filepath in sorted(cube_path.rglob("*.parquet")):
+        parquet_file = pq.ParquetFile(filepath)
+        # The 98 series does not have vectors at all
+        if not {"VECTOR", "COORDINATE"} <= set(parquet_file.schema_arrow.names):
+            continue
+        tables.extend(
+            _row_group_entries(
+                parquet_file,
+                product_id,
+                "cube",
+                filepath.relative_to(cube_path.parent).as_posix(),
+                "VECTOR",
+                "COORDINATE",
+            )
+        )
+    return _sorted(pa.concat_tables(tables))
+
+
+def index_delta_split(
+    split_path: Union[str, Path], prefix: Optional[str] = None
+) -> pa.Table:
+    """
+    Build index entries for a delta file split into parquet by `split_delta_file`
+
+    Args:
+        split_path: The directory the delta file was split into
+        prefix: The path to record for `split_path`. Defaults to its name
+
+    Returns:
+        The index entries, sorted by vectorId
+    """
+    split_path = Path(split_path)
+    prefix = split_path.name if prefix is None else prefix.rstrip("/")
+    tables = [VECTOR_INDEX_SCHEMA.empty_table()]
+    for filepath in sorted(split_path.rglob("*.parquet")):
+        partition = filepath.parent.name
+        if not partition.startswith("productId="):
+            raise ValueError(f"Expected a productId partition for {filepath}")
+        tables.extend(
+            _row_group_entries(
+                pq.ParquetFile(filepath),
+                int(partition[len("productId=") :]),
+                "delta",
+                f"{prefix}/{filepath.relative_to(split_path).as_posix()}",
+                "vectorId",
+                "coordinate",
+            )
+        )
+    return _sorted(pa.concat_tables(tables))
+
+
+def _pending_fragments(index_dir: Path) -> list[tuple[Path, str, Optional[int]]]:
+    """
+    Returns:
+        The pending fragments in the order they were added, along with their
+        source and, for cubes, the product id they replace
+    """
+    fragments = []
+    for filepath in sorted((index_dir / PENDING_DIRNAME).glob("*.parquet")):
+        _, source, product_id = filepath.stem.split("-")
+        fragments.append(
+            (filepath, source, int(product_id) if source == "cube" else None)
+        )
+    return fragments
+
+
+def add_to_vector_index(
+    index_dir: Union[str, Path], entries: pa.Table, replace_product: Optional[int]
+) -> Path:
+    """
+    Add entries to the index as a pending fragment.
+
+    Args:
+        index_dir: The directory holding the index. Created if it doesn't exist
+        entries: The output of `index_cube` or `index_delta_split`
+        replace_product: If the entries come from a cube, its product id. All
+            previous entries for this product are dropped
+
+    Returns:
+        The path of the new fragment
+    """
+    index_dir = Path(index_dir)
+    pending_dir = index_dir / PENDING_DIRNAME
+    pending_dir.mkdir(parents=True, exist_ok=True)
+
+    fragments = _pending_fragments(index_dir)
+    seq = int(fragments[-1][0].stem.split("-")[0]) + 1 if fragments else 0
+    if replace_product is None:
+        name = f"{seq:012d}-delta-0.parquet"
+    else:
+        name = f"{seq:012d}-cube-{replace_product}.parquet"
+
+    fragment_path = pending_dir / name
+    # Written under another name first, so a compaction never reads half of it
+    tmp_path = pending_dir / f"{name}.tmp"
+    pq.write_table(
+        _sorted(entries.cast(VECTOR_INDEX_SCHEMA)),
+        tmp_path,
+        row_group_size=INDEX_ROW_GROUP_SIZE,
+    )
+    tmp_path.replace(fragment_path)
+    return fragment_path
+
+
+def _resolve(
+    compacted: Optional[pa.Table],
+    fragments: list[tuple[pa.Table, Optional[int]]],
+) -> pa.Table:
+    """
+    Combine the compacted index with its pending fragments, dropping entries
+    which have been replaced by a later cube
+    """
+    tables = [] if compacted is None else [compacted]
+    for tab, replace_product in fragments:
+        if replace_product is not None:
+            tables = [
+                t.filter(pc.not_equal(t["productId"], replace_product)) for t in tables
+            ]
+        tables.append(tab)
+    if not tables:
+        return VECTOR_INDEX_SCHEMA.empty_table()
+    return _sorted(pa.concat_tables(tables))
+
+
+def _read_index(
+    index_dir: Path,
+    filters: Optional[list[tuple]] = None,
+    fragments: Optional[list[tuple[Path, str, Optional[int]]]] = None,
+) -> pa.Table:
+    """
+    Read the index, with the given pending fragments (by default, all of them)
+    """
+    if fragments is None:
+        fragments = _pending_fragments(index_dir)
+    compacted_path = index_dir / INDEX_FILENAME
+    compacted = (
+        pq.read_table(compacted_path, filters=filters)
+        if compacted_path.exists()
+        else None
+    )
+    tables = [
+        (pq.read_table(filepath, filters=filters), replace_product)
+        for filepath, _, replace_product in fragments
+    ]
+    return _resolve(compacted, tables)
+
+
+def compact_vector_index(index_dir: Union[str, Path]) -> int:
+    """
+    Merge all pending fragments into the compacted index
+
+    Returns:
+        The number of entries in the compacted index
+    """
+    index_dir = Path(index_dir)
+    index_dir.mkdir(parents=True, exist_ok=True)
+    # Only remove the fragments merged here, not any added in the meantime
+    fragments = _pending_fragments(index_dir)
+    tab = _read_index(index_dir, fragments=fragments)
+
+    tmp_path = index_dir / f"{INDEX_FILENAME}.tmp"
+    pq.write_table(tab, tmp_path, row_group_size=INDEX_ROW_GROUP_SIZE)
+    tmp_path.replace(index_dir / INDEX_FILENAME)
+
+    for filepath, _, _ in fragments:
+        filepath.unlink()
+    return tab.num_rows
+
+
+def lookup_vector(index_dir: Union[str, Path], vector_id: int) -> pa.Table:
+    """
+    Find where a vector lives. Since the index is sorted, parquet statistics
+    let us skip every row group but the one(s) containing the vector.
+
+    Args:
+        index_dir: The directory holding the index
+        vector_id: The vector to look up, without its leading "v"
+
+    Returns:
+        The index entries for this vector
+    """
+    return _read_index(Path(index_dir), filters=[("vectorId", "=", vector_id)])
+
+
+def read_vector(
+    index_dir: Union[str, Path],
+    vector_id: int,
+    root: str,
+    filesystem: Optional[pafs.FileSystem] = None,
+    source: str = "cube",
+) -> pa.Table:
+    """
+    Read the rows of a single vector, touching only the row groups that hold it
+
+    Args:
+        index_dir: The directory holding the index
+        vector_id: The vector to read, without its leading "v"
+        root: The directory (or bucket) the index's paths are relative to
+        filesystem: The filesystem `root` lives on. Defaults to local disk.
+            Pass, e.g., a `pyarrow.fs.S3FileSystem` to read from the bucket
+        source: Either "cube" to read from processed cubes, or "delta" to read
+            revisions from split delta files
+
+    Returns:
+        The rows of the vector
+    """
+    filesystem = filesystem or pafs.LocalFileSystem()
+    hits = lookup_vector(index_dir, vector_id)
+    hits = hits.filter(pc.equal(hits["source"], source))
+
+    if source == "cube":
+        column, value = "VECTOR", f"v{vector_id}"
+    else:
+        column, value = "vectorId", vector_id
+
+    tables = []
+    for path in pc.unique(hits["path"]).to_pylist():
+        row_groups = hits.filter(pc.equal(hits["path"], path))["row_group"]
+        with filesystem.open_input_file(f"{root.rstrip('/')}/{path}") as infile:
+            tab = pq.ParquetFile(infile).read_row_groups(row_groups.to_pylist())
+        tables.append(tab.filter(pc.equal(tab[column], value)))
+
+    if not tables:
+        return pa.table({})
+    return pa.concat_tables(tables)
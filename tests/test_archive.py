@@ -0,0 +1,121 @@
+import os
+import shutil
+import tempfile
+from datetime import datetime
+from pathlib import Path
+
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session
+
+from statcandb.archive import LocalArchive, archive_key, file_digest
+from statcandb.audit import expected_manifests
+from statcandb.cli import full
+from statcandb.cli.full import PipelineOptions, _reprocess_cubes
+from statcandb.cubes import ProductMetadata
+from statcandb.models import Base, Product
+
+
+class DirectoryBucket:
+    """Just enough of a boto3 S3 client to upload a cube to a directory"""
+
+    def __init__(self, root: Path):
+        self.root = root
+
+    def list_objects_v2(self, Bucket: str, Prefix: str):
+        paths = sorted(p for p in self.root.rglob("*") if p.is_file())
+        keys = [p.relative_to(self.root).as_posix() for p in paths]
+        return {"Contents": [{"Key": k} for k in keys if k.startswith(Prefix)]}
+
+    def delete_objects(self, Bucket: str, Delete: dict):
+        for obj in Delete["Objects"]:
+            (self.root / obj["Key"]).unlink()
+
+    def upload_file(self, filename: str, bucket_name: str, key: str, Callback=None):
+        (self.root / key).parent.mkdir(parents=True, exist_ok=True)
+        shutil.copyfile(filename, self.root / key)
+
+
+class BrokenArchive(LocalArchive):
+    def put(self, product_id: int, zip_path: Path):
+        raise OSError("No space left on device")
+
+
+@pytest.fixture
+def session():
+    engine = create_engine("sqlite://")
+    Base.metadata.create_all(engine)
+    with Session(engine) as session:
+        yield session
+
+
+def test_local_archive(fixtures_path: Path):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        tmpdir = Path(tmpdir)
+        archive = LocalArchive(tmpdir / "archive")
+        zip_path = fixtures_path / "10100001-eng.zip"
+        other_path = fixtures_path / "20230803.zip"
+
+        first = archive.put(10100001, zip_path)
+        assert first.digest == file_digest(zip_path)
+        assert (archive.root / archive_key(10100001, first.digest)).exists()
+
+        # Identical contents are stored once, but become the newest version
+        second = archive.put(10100001, other_path)
+        os.utime(archive.root / second.key, (0, 0))
+        assert archive.put(10100001, zip_path).digest == first.digest
+        assert [v.digest for v in archive.versions(10100001)] == [
+            first.digest,
+            second.digest,
+        ]
+        assert archive.products() == [10100001]
+
+        assert archive.prune(10100001, keep=1) == 1
+        assert len(archive.versions(10100001)) == 1
+        fetched = archive.fetch(archive.versions(10100001)[0], tmpdir / "x.zip")
+        assert file_digest(fetched) == first.digest
+
+
+def test_reprocess_cubes(fixtures_path: Path, session: Session):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        tmpdir = Path(tmpdir)
+        archive = LocalArchive(tmpdir / "archive")
+        archive.put(10100001, fixtures_path / "10100001-eng.zip")
+        bucket = DirectoryBucket(tmpdir / "bucket")
+        session.add(Product(10100001, datetime(2023, 1, 1), is_uploaded=True))
+        session.commit()
+
+        # Left over from a version built with a series index and rollups
+        bucket.root.mkdir()
+        for name in ["10100001.series.parquet", "10100001.rollup-annual.parquet"]:
+            (bucket.root / name).touch()
+
+        count = _reprocess_cubes(
+            [10100001, 10100002], archive, bucket, "bucket", session, workers=2
+        )
+        assert count == 1
+        assert not (bucket.root / "10100001.series.parquet").exists()
+        assert not (bucket.root / "10100001.rollup-annual.parquet").exists()
+        assert list((bucket.root / "10100001.parquet").rglob("*.parquet"))
+        assert (bucket.root / "10100001.latest.parquet").exists()
+        assert expected_manifests(session)[10100001].row_count > 0
+
+
+def test_failed_archive_does_not_stop_the_pull(
+    fixtures_path: Path, session: Session, monkeypatch
+):
+    def download_file(url, download_dir, verbose=False):
+        shutil.copy(fixtures_path / "10100001-eng.zip", download_dir)
+
+    monkeypatch.setattr(full, "get_cube_url", lambda product_id: "")
+    monkeypatch.setattr(full, "download_file", download_file)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        tmpdir = Path(tmpdir)
+        bucket = DirectoryBucket(tmpdir / "bucket")
+        options = PipelineOptions(archive=BrokenArchive(tmpdir / "archive"))
+        product = ProductMetadata(10100001, datetime(2023, 1, 1))
+
+        assert full._pull_process_upload_cube(
+            product, bucket, "bucket", session, options
+        )
+        assert list((bucket.root / "10100001.parquet").rglob("*.parquet"))
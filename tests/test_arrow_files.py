@@ -0,0 +1,43 @@
+import tempfile
+from pathlib import Path
+
+import pyarrow.dataset as ds
+import pytest
+
+from statcandb.arrow_files import arrow_path_for, read_cube
+from statcandb.cubes import process_cube
+
+
+def test_process_cube_both_formats(fixtures_path: Path):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        parquet_path = Path(tmpdir) / "23100309.parquet"
+        process_cube(fixtures_path / "23100309.csv", parquet_path, format="both")
+
+        arrow_path = arrow_path_for(parquet_path)
+        assert arrow_path == Path(tmpdir) / "23100309.arrow"
+        assert list(arrow_path.rglob("*.arrow"))
+
+        expected = ds.dataset(parquet_path).to_table()
+        assert read_cube(arrow_path).equals(expected)
+
+        tab = read_cube(
+            arrow_path, columns=["VALUE"], filter=ds.field("GEO") == "Canada"
+        )
+        assert tab.column_names == ["VALUE"]
+        assert tab.num_rows == expected.filter(ds.field("GEO") == "Canada").num_rows
+
+
+@pytest.mark.parametrize("compression", ["lz4", "zstd"])
+def test_process_cube_compressed_arrow(fixtures_path: Path, compression: str):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        tmpdir = Path(tmpdir)
+        process_cube(fixtures_path / "23100309.csv", tmpdir / "parquet")
+        process_cube(
+            fixtures_path / "23100309.csv",
+            tmpdir / "arrow",
+            format="arrow",
+            compression=compression,
+        )
+        assert read_cube(tmpdir / "arrow").equals(
+            ds.dataset(tmpdir / "parquet").to_table()
+        )
@@ -0,0 +1,99 @@
+import io
+import shutil
+import tempfile
+from datetime import datetime
+from pathlib import Path
+
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session
+
+from statcandb.audit import (
+    audit_bucket,
+    expected_manifests,
+    local_manifest,
+    record_manifest,
+)
+from statcandb.cubes import process_cube
+from statcandb.models import Base, Product
+
+
+class DirectoryBucket:
+    """Just enough of a boto3 S3 client to read a bucket stored in a directory"""
+
+    def __init__(self, root: Path):
+        self.root = root
+        self.bytes_read = 0
+
+    def get_paginator(self, name: str):
+        return self
+
+    def paginate(self, Bucket: str, Prefix: str = "", Delimiter: str = None):
+        paths = sorted(p for p in self.root.rglob("*") if p.is_file())
+        keys = [p.relative_to(self.root).as_posix() for p in paths]
+        if Delimiter:
+            prefixes = {
+                k.split(Delimiter)[0] + Delimiter for k in keys if Delimiter in k
+            }
+            yield {"CommonPrefixes": [{"Prefix": p} for p in sorted(prefixes)]}
+        else:
+            yield {
+                "Contents": [
+                    {"Key": k, "Size": (self.root / k).stat().st_size}
+                    for k in keys
+                    if k.startswith(Prefix)
+                ]
+            }
+
+    def get_object(self, Bucket: str, Key: str, Range: str):
+        start, end = Range.removeprefix("bytes=").split("-")
+        with open(self.root / Key, "rb") as infile:
+            infile.seek(int(start))
+            data = infile.read(int(end) - int(start) + 1)
+        self.bytes_read += len(data)
+        return {"Body": io.BytesIO(data)}
+
+
+@pytest.fixture
+def session():
+    engine = create_engine("sqlite://")
+    Base.metadata.create_all(engine)
+    with Session(engine) as session:
+        yield session
+
+
+def test_audit_bucket(session: Session, fixtures_path: Path):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        bucket = DirectoryBucket(Path(tmpdir))
+        cube_path = bucket.root / "23100309.parquet"
+        process_cube(fixtures_path / "23100309.csv", cube_path)
+        shutil.copytree(cube_path, bucket.root / "10100001.parquet")
+
+        for product_id in [23100309, 10100001, 10100002]:
+            session.add(Product(product_id, datetime(2023, 1, 1), is_uploaded=True))
+        manifest = local_manifest(cube_path)
+        record_manifest(session, 23100309, manifest)
+        session.commit()
+
+        expected = expected_manifests(session)
+        assert expected == {23100309: manifest, 10100001: None, 10100002: None}
+        problems = audit_bucket(bucket, "bucket", expected)
+        assert [(p.product_id, p.problem) for p in problems] == [(10100002, "missing")]
+        # Only the footers were read
+        size = sum(p.stat().st_size for p in cube_path.rglob("*.parquet"))
+        assert bucket.bytes_read < 2 * size
+
+        # Truncate the upload
+        (part,) = cube_path.rglob("*.parquet")
+        part.write_bytes(part.read_bytes()[:-100])
+        shutil.copytree(cube_path, bucket.root / "10100003.parquet")
+        problems = {
+            (p.product_id, p.problem)
+            for p in audit_bucket(bucket, "bucket", expected_manifests(session))
+        }
+        assert problems == {
+            (23100309, "unreadable"),
+            (23100309, "row_count"),
+            (10100002, "missing"),
+            (10100003, "untracked"),
+        }
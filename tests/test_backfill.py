@@ -0,0 +1,94 @@
+import tempfile
+from pathlib import Path
+
+import pyarrow.dataset as ds
+from pytest_httpserver import HTTPServer
+
+from statcandb import backfill
+from statcandb.backfill import backfill_delta_files, date_range
+
+
+def test_date_range():
+    assert date_range("20230730", "20230802") == [
+        "20230730",
+        "20230731",
+        "20230801",
+        "20230802",
+    ]
+    assert date_range("20230802", "20230801") == []
+
+
+def test_backfill_delta_files(httpserver: HTTPServer, fixtures_path: Path):
+    httpserver.expect_request("/n1/delta/20230803.zip").respond_with_data(
+        (fixtures_path / "20230803.zip").read_bytes()
+    )
+    httpserver.expect_request("/n1/delta/20230804.zip").respond_with_data(
+        b"not a zip file"
+    )
+    # Days without a delta file
+    for missing in ["20230802", "20230805"]:
+        httpserver.expect_request(f"/n1/delta/{missing}.zip").respond_with_data(
+            "Not Found", status=404
+        )
+    base_url = httpserver.url_for("/n1/delta/") + "{download_date}.zip"
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        tmpdir = Path(tmpdir)
+        result = backfill_delta_files(
+            "20230802",
+            "20230805",
+            tmpdir / "zips",
+            split_dir=tmpdir / "split",
+            base_url=base_url,
+        )
+        assert result.downloaded == ["20230803"]
+        assert result.not_published == ["20230802", "20230805"]
+        assert result.failed == ["20230804"]
+        assert result.split == ["20230803"]
+        assert not (tmpdir / "zips" / "20230804.zip").exists()
+        assert ds.dataset(tmpdir / "split" / "20230803").count_rows() > 0
+
+        result = backfill_delta_files(
+            "20230803",
+            "20230803",
+            tmpdir / "zips",
+            split_dir=tmpdir / "split",
+            base_url=base_url,
+        )
+        assert result.skipped == ["20230803"]
+        assert result.downloaded == result.split == []
+
+
+def test_backfill_records_disk_errors(monkeypatch):
+    def pull_delta_file(download_date, download_dir, base_url):
+        raise OSError(28, "No space left on device")
+
+    monkeypatch.setattr(backfill, "pull_delta_file", pull_delta_file)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        result = backfill_delta_files("20230803", "20230803", Path(tmpdir))
+    assert result.failed == ["20230803"]
+
+
+def test_backfill_records_split_errors(
+    httpserver: HTTPServer, fixtures_path: Path, monkeypatch
+):
+    def split_delta_file(delta_file, split_path, format):
+        raise OSError(28, "No space left on device")
+
+    monkeypatch.setattr(backfill, "split_delta_file", split_delta_file)
+    httpserver.expect_request("/n1/delta/20230803.zip").respond_with_data(
+        (fixtures_path / "20230803.zip").read_bytes()
+    )
+    base_url = httpserver.url_for("/n1/delta/") + "{download_date}.zip"
+    with tempfile.TemporaryDirectory() as tmpdir:
+        tmpdir = Path(tmpdir)
+        result = backfill_delta_files(
+            "20230803",
+            "20230803",
+            tmpdir / "zips",
+            split_dir=tmpdir / "split",
+            base_url=base_url,
+        )
+        assert result.downloaded == result.split_failed == ["20230803"]
+        assert result.failed == result.split == []
+        assert not (tmpdir / "split" / "20230803").exists()
@@ -0,0 +1,95 @@
+import csv
+import tempfile
+from pathlib import Path
+
+import pyarrow.parquet as pq
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session
+
+from statcandb.changes import (
+    ChangeCounts,
+    change_key,
+    diff_cubes,
+    next_sequence,
+    publish_changes,
+)
+from statcandb.cubes import process_cube
+from statcandb.models import Base
+
+
+class RecordingBucket:
+    def __init__(self):
+        self.uploads = []
+
+    def upload_file(self, filename: str, bucket_name: str, key: str):
+        self.uploads.append(key)
+
+
+@pytest.fixture
+def session():
+    engine = create_engine("sqlite://")
+    Base.metadata.create_all(engine)
+    with Session(engine) as session:
+        yield session
+
+
+def test_diff_cubes(fixtures_path: Path):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        tmpdir = Path(tmpdir)
+        with open(fixtures_path / "23100309.csv", encoding="utf-8-sig") as infile:
+            rows = list(csv.reader(infile))
+        header, old_rows = rows[0], rows[1:]
+        value = header.index("VALUE")
+        ref_date = header.index("REF_DATE")
+
+        # Revise the first row, drop the second, and move the third to a new year
+        new_rows = [list(row) for row in old_rows]
+        new_rows[0][value] = "1"
+        new_rows[2][ref_date] = "2099"
+        del new_rows[1]
+
+        for name, data in [("old", old_rows), ("new", new_rows)]:
+            with open(tmpdir / f"{name}.csv", "w", newline="") as outfile:
+                csv.writer(outfile, quoting=csv.QUOTE_ALL).writerows([header] + data)
+            process_cube(tmpdir / f"{name}.csv", tmpdir / f"{name}.parquet")
+
+        counts = diff_cubes(
+            tmpdir / "old.parquet", tmpdir / "new.parquet", tmpdir / "changes.parquet"
+        )
+        assert counts == ChangeCounts(inserted=1, updated=1, deleted=2)
+
+        changes = pq.read_table(tmpdir / "changes.parquet").to_pylist()
+        by_op = {}
+        for change in changes:
+            by_op.setdefault(change["OP"], []).append(change)
+        assert (
+            by_op["update"][0]["COORDINATE"] == old_rows[0][header.index("COORDINATE")]
+        )
+        assert by_op["update"][0]["VALUE"] == 1
+        assert by_op["insert"][0]["REF_DATE"] == "2099"
+        assert all(change["VALUE"] is None for change in by_op["delete"])
+
+        # Nothing changed, so nothing is written
+        counts = diff_cubes(
+            tmpdir / "new.parquet", tmpdir / "new.parquet", tmpdir / "none.parquet"
+        )
+        assert counts.total == 0
+        assert not (tmpdir / "none.parquet").exists()
+
+
+def test_publish_changes(session: Session):
+    bucket = RecordingBucket()
+    counts = ChangeCounts(inserted=1)
+    assert next_sequence(session, 23100309) == 1
+    for _ in range(2):
+        publish_changes(bucket, "bucket", session, 23100309, "changes.parquet", counts)
+        session.commit()
+    publish_changes(bucket, "bucket", session, 10100001, "changes.parquet", counts)
+
+    assert bucket.uploads == [
+        change_key(23100309, 1),
+        change_key(23100309, 2),
+        change_key(10100001, 1),
+    ]
+    assert change_key(23100309, 2) == "changes/23100309/0000000002.parquet"
@@ -0,0 +1,89 @@
+import tempfile
+from pathlib import Path
+
+import duckdb
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+from statcandb.compaction import compact_cube, group_adjacent
+from statcandb.cubes import process_cube
+from statcandb.series_index import series_index_path_for, write_series_index
+
+
+def test_group_adjacent():
+    assert group_adjacent([1, 1, 1, 5, 1, 1], 3) == [[0, 1, 2], [3], [4, 5]]
+    assert group_adjacent([], 3) == []
+
+
+def test_compact_cube(fixtures_path: Path):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        tmpdir = Path(tmpdir)
+        process_cube(fixtures_path / "10100001-eng.zip", tmpdir / "flat.parquet")
+        expected = ds.dataset(tmpdir / "flat.parquet").to_table()
+
+        # The fixture is too small to be partitioned, so partition it by hand
+        cube_path = tmpdir / "10100001.parquet"
+        ds.write_dataset(
+            expected,
+            cube_path,
+            format="parquet",
+            partitioning=["year"],
+            partitioning_flavor="hive",
+        )
+        num_years = len(list(cube_path.glob("year=*")))
+        assert num_years > 2
+
+        report = compact_cube(cube_path, target_bytes=1)
+        assert report.files_before == report.files_after == num_years
+
+        report = compact_cube(cube_path)
+        assert report.files_before == num_years
+        assert report.files_after == 1
+        assert report.requests_after < report.requests_before
+        assert [p.name for p in cube_path.iterdir()] == ["part-0.parquet"]
+
+        actual = ds.dataset(cube_path, format="parquet").to_table()
+        assert actual.schema.field("year").type == pa.int64()
+        # As DuckDB read the year= partitions before compaction
+        glob = f"{cube_path}/**/*.parquet"
+        (recent,) = duckdb.sql(
+            f"SELECT count(*) FROM read_parquet('{glob}') WHERE year > 2000"
+        ).fetchone()
+        assert recent == sum(int(year) > 2000 for year in expected["year"].to_pylist())
+        expected = expected.set_column(
+            expected.schema.get_field_index("year"),
+            "year",
+            expected["year"].cast(pa.int64()),
+        )
+        sort_keys = [
+            ("year", "ascending"),
+            ("COORDINATE", "ascending"),
+            ("REF_DATE", "ascending"),
+        ]
+        assert actual.sort_by(sort_keys).equals(
+            expected.select(actual.column_names).sort_by(sort_keys)
+        )
+
+        # Compacting again does nothing
+        report = compact_cube(cube_path)
+        assert report.files_before == report.files_after == 1
+
+
+def test_compaction_rewrites_the_series_index(fixtures_path: Path):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        tmpdir = Path(tmpdir)
+        process_cube(fixtures_path / "10100001-eng.zip", tmpdir / "flat.parquet")
+        cube_path = tmpdir / "10100001.parquet"
+        ds.write_dataset(
+            ds.dataset(tmpdir / "flat.parquet").to_table(),
+            cube_path,
+            format="parquet",
+            partitioning=["year"],
+            partitioning_flavor="hive",
+        )
+        write_series_index(cube_path)
+
+        compact_cube(cube_path)
+        paths = set(pq.read_table(series_index_path_for(cube_path))["path"].to_pylist())
+        assert paths == {"10100001.parquet/part-0.parquet"}
@@ -0,0 +1,43 @@
+import duckdb
+import pyarrow as pa
+
+from statcandb.config import (
+    ResourceGovernor,
+    ResourceShare,
+    get_governor,
+    run_with_share,
+    set_governor,
+)
+
+
+def test_resource_governor():
+    governor = ResourceGovernor(cpus=8, memory_bytes=8 * 1_024**3)
+    assert governor.share() == ResourceShare(8, 8 * 1_024**3)
+    assert governor.share(workers=3) == ResourceShare(2, 8 * 1_024**3 // 3)
+    assert governor.share(workers=100).threads == 1
+
+    # Shares shrink as workers start and grow as they finish
+    with governor.worker() as first:
+        assert first.threads == 8
+        with governor.worker() as second:
+            assert second.threads == 4
+            assert governor.share().threads == 4
+        assert governor.active == 1
+        assert governor.share().threads == 8
+    assert governor.active == 0
+
+
+def test_duckdb_config():
+    settings = ResourceShare(2, 512 * 1_024 * 1_024).duckdb_config()
+    assert settings == {"threads": "2", "memory_limit": "512MB"}
+    with duckdb.connect(":memory:", config=settings) as con:
+        assert con.execute("SELECT current_setting('threads')").fetchone()[0] == 2
+
+
+def test_run_with_share():
+    original = get_governor()
+    try:
+        assert run_with_share(ResourceShare(3), pa.cpu_count) == 3
+        assert get_governor().cpus == 3
+    finally:
+        set_governor(original)
@@ -7,7 +7,7 @@ from typing import Any
 import pytest
 from pytest_httpserver import HTTPServer
 
-from statcandb.cubes import ProductMetadata, get_pid_list, pull_cube
+from statcandb.cubes import ProductMetadata, get_cube_size, get_pid_list, pull_cube
 
 
 @pytest.fixture(scope="module")
@@ -67,3 +67,26 @@ def test_pull_cube(httpserver: HTTPServer, fixtures_path: Path):
 
         with open(Path(tmpdir) / f"{product_id}-eng.zip", "rb") as infile:
             assert infile.read() == product_data
+
+
+def test_get_cube_size(httpserver: HTTPServer):
+    product_id = 10100001
+    httpserver.expect_request(
+        f"/t1/wds/rest/getFullTableDownloadCSV/{product_id}/en"
+    ).respond_with_json(
+        {
+            "status": "SUCCESS",
+            "object": httpserver.url_for(f"n1/tbl/csv/{product_id}-eng.zip"),
+        }
+    )
+    httpserver.expect_request(
+        f"/n1/tbl/csv/{product_id}-eng.zip", method="HEAD"
+    ).respond_with_data(b"0" * 3950)
+
+    size = get_cube_size(
+        product_id,
+        base_url=httpserver.url_for(
+            "/t1/wds/rest/getFullTableDownloadCSV/" + r"{product_id}/en"
+        ),
+    )
+    assert size == 3950
@@ -1,13 +1,22 @@
 import tempfile
 from collections import Counter
 from datetime import datetime
+from decimal import Decimal
 from pathlib import Path
 
 import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
 import pytest
 import pytest_httpserver
 
-from statcandb.delta_files import pull_delta_file, split_delta_file
+from statcandb.cubes import process_cube
+from statcandb.delta_files import (
+    SCALED_VALUE_TYPE,
+    pull_delta_file,
+    scaled_value,
+    split_delta_file,
+)
 
 
 @pytest.fixture(scope="module")
@@ -52,3 +61,38 @@ def test_split_delta_files(fixtures_path: Path):
         assert Counter(left_df["value"].fillna(-1)) == Counter(
             right_df["value"].fillna(-1)
         )
+
+
+def test_scaled_value():
+    values = pa.array(["0.1", "", None, "123.456", "-7.1", "0.12345678901"])
+    factors = pa.array([3, 0, 0, 6, 0, 0], pa.uint8())
+    scaled = scaled_value(values, factors)
+    assert scaled.type == SCALED_VALUE_TYPE
+    assert scaled.to_pylist() == [
+        Decimal("100"),
+        None,
+        None,
+        Decimal("123456000"),
+        Decimal("-7.1"),
+        Decimal("0.123456789"),
+    ]
+
+
+def test_scaled_value_contract(fixtures_path: Path):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        tmpdir = Path(tmpdir)
+        split_delta_file(fixtures_path / "20230715.csv", tmpdir / "delta", "parquet")
+        process_cube(fixtures_path / "23100309.csv", tmpdir / "cube")
+
+        delta = ds.dataset(tmpdir / "delta", partitioning="hive").to_table()
+        cube = ds.dataset(tmpdir / "cube").to_table()
+        assert delta.schema.field("scaledValue").type == SCALED_VALUE_TYPE
+        assert cube.schema.field("SCALED_VALUE").type == SCALED_VALUE_TYPE
+
+        # The scaled values are exactly the values in the CSVs
+        for tab, value, scaled in [
+            (delta, "value", "scaledValue"),
+            (cube, "VALUE", "SCALED_VALUE"),
+        ]:
+            for raw, exact in zip(tab[value].to_pylist(), tab[scaled].to_pylist()):
+                assert (raw is None and exact is None) or Decimal(str(raw)) == exact
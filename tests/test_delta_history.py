@@ -0,0 +1,88 @@
+import tempfile
+from pathlib import Path
+
+import pandas as pd
+import pytest
+
+from statcandb.delta_history import (
+    as_of,
+    compact_delta_history,
+    ingest_delta_file,
+    ingested_dates,
+)
+
+
+def test_delta_history(fixtures_path: Path):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        tmpdir = Path(tmpdir)
+        store = tmpdir / "store"
+
+        # A second day where every value has been revised
+        delta_df = pd.read_csv(fixtures_path / "20230715.csv")
+        revised_df = delta_df.copy()
+        revised_df["value"] = revised_df["value"] + 1
+        revised_df["releaseTime"] = "2023-07-15T08:30"
+        revised_csv = tmpdir / "20230716.csv"
+        revised_df.to_csv(revised_csv, index=False)
+
+        assert ingest_delta_file(store, fixtures_path / "20230715.csv", "20230715")
+        assert ingest_delta_file(store, revised_csv, "20230716")
+        assert not ingest_delta_file(store, revised_csv, "20230716")
+        assert ingested_dates(store) == {"20230715", "20230716"}
+
+        product_dir = store / "productId=23100309"
+        assert sorted(p.name for p in product_dir.iterdir()) == [
+            "20230715.parquet",
+            "20230716.parquet",
+        ]
+
+        vector_id = int(delta_df["vectorId"].iloc[1])
+        original = delta_df[delta_df["vectorId"] == vector_id]["value"].iloc[0]
+
+        def value_as_of(as_of_date: str) -> float:
+            tab = as_of(store, as_of_date, vector_id=vector_id)
+            assert tab.num_rows == 1
+            return tab["value"][0].as_py()
+
+        assert value_as_of("20230714") == original
+        assert value_as_of("20230715") == original + 1
+
+        tab = as_of(store, "20230715", product_id=23100309)
+        assert tab.num_rows == len(delta_df)
+
+        before, after = compact_delta_history(store, target_bytes=1_024 * 1_024)
+        assert (before, after) == (2, 1)
+        assert [p.name for p in product_dir.iterdir()] == ["20230715-20230716.parquet"]
+        assert value_as_of("20230714") == original
+        assert value_as_of("20230715") == original + 1
+
+
+def test_interrupted_compaction_loses_nothing(fixtures_path: Path, monkeypatch):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        tmpdir = Path(tmpdir)
+        store = tmpdir / "store"
+        delta_df = pd.read_csv(fixtures_path / "20230715.csv")
+        revised_df = delta_df.copy()
+        revised_df["releaseTime"] = "2023-07-15T08:30"
+        revised_csv = tmpdir / "20230716.csv"
+        revised_df.to_csv(revised_csv, index=False)
+        ingest_delta_file(store, fixtures_path / "20230715.csv", "20230715")
+        ingest_delta_file(store, revised_csv, "20230716")
+
+        def crash(self, *args, **kwargs):
+            raise OSError("Interrupted")
+
+        # Crash right after the merged file is swapped in
+        monkeypatch.setattr(Path, "unlink", crash)
+        with pytest.raises(OSError):
+            compact_delta_history(store, target_bytes=1_024 * 1_024)
+        monkeypatch.undo()
+
+        product_dir = store / "productId=23100309"
+        assert sorted(p.name for p in product_dir.iterdir()) == [
+            "20230715-20230716.parquet",
+            "20230715.parquet",
+            "20230716.parquet",
+        ]
+        tab = as_of(store, "20230715", product_id=23100309)
+        assert tab.num_rows == len(delta_df)
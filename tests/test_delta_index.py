@@ -0,0 +1,70 @@
+import shutil
+import tempfile
+import zipfile
+from pathlib import Path
+
+import pyarrow.dataset as ds
+
+from statcandb.delta_files import open_delta_file, split_delta_file
+from statcandb.delta_index import (
+    delta_index_path_for,
+    index_delta_file,
+    load_delta_index,
+    read_delta_product,
+    split_delta_products,
+)
+
+
+def test_index_delta_file(fixtures_path: Path):
+    zip_path = fixtures_path / "20230803.zip"
+    with tempfile.TemporaryDirectory() as tmpdir:
+        tmpdir = Path(tmpdir)
+        with zipfile.ZipFile(zip_path) as zf:
+            zf.extract("20230803.csv", tmpdir)
+        csv_path = tmpdir / "20230803.csv"
+
+        index = index_delta_file(csv_path)
+        assert index.equals(index_delta_file(zip_path))
+        # Blocks cover the file after the header
+        offsets = index["offset"].to_pylist()
+        lengths = index["length"].to_pylist()
+        for offset, length, next_offset in zip(offsets, lengths, offsets[1:]):
+            assert offset + length == next_offset
+        assert offsets[-1] + lengths[-1] == csv_path.stat().st_size
+
+        split_delta_file(csv_path, tmpdir / "split", format="parquet")
+        split = ds.dataset(tmpdir / "split", partitioning="hive")
+        assert sum(index["rowCount"].to_pylist()) == split.count_rows()
+
+        # Reading a single product gives what split_delta_file does
+        index = load_delta_index(csv_path)
+        assert delta_index_path_for(csv_path).exists()
+        product_id = index["productId"][len(index) // 2].as_py()
+        tab = read_delta_product(csv_path, index, product_id)
+        expected = split.to_table(filter=ds.field("productId") == product_id)
+        assert (
+            tab.drop_columns(["productId"])
+            .sort_by("vectorId")
+            .equals(expected.drop_columns(["productId"]).sort_by("vectorId"))
+        )
+
+
+def test_split_delta_products(fixtures_path: Path):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        tmpdir = Path(tmpdir)
+        # The index is written next to the delta file
+        zip_path = Path(shutil.copy(fixtures_path / "20230803.zip", tmpdir))
+        with open_delta_file(zip_path) as delta_file:
+            split_delta_file(delta_file, tmpdir / "all", format="parquet")
+        product_ids = sorted(
+            int(p.name.split("=")[1]) for p in (tmpdir / "all").iterdir()
+        )
+
+        written = split_delta_products(
+            zip_path, tmpdir / "some", product_ids[:3] + [1], format="parquet"
+        )
+        assert written == product_ids[:3]
+        assert (tmpdir / "20230803.index.parquet").exists()
+        assert sorted(p.name for p in (tmpdir / "some").iterdir()) == [
+            f"productId={product_id}" for product_id in product_ids[:3]
+        ]
@@ -0,0 +1,48 @@
+import tempfile
+from pathlib import Path
+
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+from statcandb.cubes import process_cube
+from statcandb.dimensions import decode_dimensions, dimensions_path_for
+
+
+def test_process_cube_dictionary_dimensions(fixtures_path: Path):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        tmpdir = Path(tmpdir)
+        process_cube(fixtures_path / "23100309.csv", tmpdir / "flat", dimensions="flat")
+        process_cube(fixtures_path / "23100309.csv", tmpdir / "dictionary")
+
+        flat = ds.dataset(tmpdir / "flat").to_table()
+        encoded = ds.dataset(tmpdir / "dictionary").to_table()
+        assert pa.types.is_string(flat.schema.field("GEO").type)
+        assert encoded.schema.field("GEO").type == pa.dictionary(
+            pa.int32(), pa.string()
+        )
+        # Measures and per-observation columns are left alone
+        assert encoded.schema.field("VALUE").type == flat.schema.field("VALUE").type
+        assert encoded.schema.field("COORDINATE").type == pa.string()
+
+        assert encoded.nbytes < flat.nbytes
+        assert encoded.cast(flat.schema).equals(flat)
+
+
+def test_process_cube_dimension_table(fixtures_path: Path):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        tmpdir = Path(tmpdir)
+        cube_path = tmpdir / "23100309.parquet"
+        process_cube(fixtures_path / "23100309.csv", tmpdir / "flat", dimensions="flat")
+        process_cube(fixtures_path / "23100309.csv", cube_path, dimensions="table")
+
+        coded = ds.dataset(cube_path).to_table()
+        assert coded.schema.field("GEO").type == pa.int32()
+
+        dimension_tab = pq.read_table(dimensions_path_for(cube_path))
+        assert dimensions_path_for(cube_path).name == "23100309.dimensions.parquet"
+        assert "GEO" in dimension_tab["DIMENSION"].to_pylist()
+
+        flat = ds.dataset(tmpdir / "flat").to_table()
+        decoded = decode_dimensions(coded, dimension_tab)
+        assert decoded.cast(flat.schema).equals(flat)
@@ -2,9 +2,13 @@ import csv
 import tempfile
 from pathlib import Path
 
+import pytest
+import requests
 from pytest_httpserver import HTTPServer
+from werkzeug import Response
 
 from statcandb.file_utils import download_file, unzip_file
+from statcandb.throttling import AdaptiveLimiter, RetryPolicy
 
 
 def test_download_file(httpserver: HTTPServer):
@@ -28,6 +32,48 @@ def test_download_file(httpserver: HTTPServer):
             assert infile.read() == b"foobar"
 
 
+def truncated_response(body: bytes) -> Response:
+    # Promises more than it sends, so the connection drops mid-body
+    return Response(
+        iter([body]),
+        headers={"Content-Length": str(len(body) + 10)},
+        direct_passthrough=True,
+    )
+
+
+def test_download_file_interrupted(httpserver: HTTPServer):
+    limiter = AdaptiveLimiter(sleep=lambda seconds: None)
+    policy = RetryPolicy(max_attempts=2)
+    httpserver.expect_oneshot_request("/foo.csv").respond_with_response(
+        truncated_response(b"foo")
+    )
+    httpserver.expect_request("/foo.csv").respond_with_data(b"foobar")
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        download_path = download_file(
+            httpserver.url_for("/foo.csv"),
+            download_dir=tmpdir,
+            limiter=limiter,
+            policy=policy,
+        )
+        with open(download_path, "rb") as infile:
+            assert infile.read() == b"foobar"
+    assert limiter.errors == 1
+
+    httpserver.clear()
+    httpserver.expect_request("/foo.csv").respond_with_response(
+        truncated_response(b"foo")
+    )
+    with tempfile.TemporaryDirectory() as tmpdir:
+        with pytest.raises(requests.exceptions.ChunkedEncodingError):
+            download_file(
+                httpserver.url_for("/foo.csv"),
+                download_dir=tmpdir,
+                limiter=limiter,
+                policy=policy,
+            )
+
+
 def test_unzip_file(fixtures_path: Path):
     with unzip_file(fixtures_path / "20230803.zip") as csv_path:
         assert csv_path.name == "20230803.csv"
@@ -0,0 +1,70 @@
+from pathlib import Path
+
+import pytest
+from pytest_httpserver import HTTPServer
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session
+from werkzeug import Request, Response
+
+from statcandb.fingerprints import (
+    HttpRangeFile,
+    get_local_fingerprint,
+    get_remote_fingerprint,
+    get_stored_fingerprint,
+)
+from statcandb.models import Base, CubeFingerprint
+
+
+@pytest.fixture
+def session():
+    engine = create_engine("sqlite://")
+    Base.metadata.create_all(engine)
+    with Session(engine) as session:
+        yield session
+
+
+def test_get_remote_fingerprint(httpserver: HTTPServer, fixtures_path: Path):
+    zip_path = fixtures_path / "10100001-eng.zip"
+    data = zip_path.read_bytes()
+
+    def respond_with_range(request: Request) -> Response:
+        response = Response(data, mimetype="application/zip")
+        return response.make_conditional(
+            request, accept_ranges=True, complete_length=len(data)
+        )
+
+    httpserver.expect_request("/10100001-eng.zip").respond_with_handler(
+        respond_with_range
+    )
+    url = httpserver.url_for("/10100001-eng.zip")
+
+    expected = get_local_fingerprint(zip_path, 10100001)
+    assert expected is not None
+    assert get_remote_fingerprint(url, 10100001) == expected
+    assert get_remote_fingerprint(url, 10100002) is None
+
+    # Only the tail and, if it wasn't already fetched, the central directory
+    range_file = HttpRangeFile(url, tail_bytes=1_024)
+    assert range_file.size == len(data)
+    range_file.seek(0)
+    assert range_file.read(4) == data[:4]
+    assert range_file.request_count == 2
+
+
+def test_get_remote_fingerprint_without_range(
+    httpserver: HTTPServer, fixtures_path: Path
+):
+    httpserver.expect_request("/10100001-eng.zip").respond_with_data(
+        (fixtures_path / "10100001-eng.zip").read_bytes()
+    )
+    url = httpserver.url_for("/10100001-eng.zip")
+    assert get_remote_fingerprint(url, 10100001) is None
+
+
+def test_get_stored_fingerprint(session: Session):
+    assert get_stored_fingerprint(session, 10100001) is None
+    session.add(CubeFingerprint(10100001, "aaaa-1"))
+    session.add(CubeFingerprint(10100001, "bbbb-2"))
+    session.add(CubeFingerprint(10100002, "cccc-3"))
+    session.commit()
+    assert get_stored_fingerprint(session, 10100001) == "bbbb-2"
@@ -0,0 +1,149 @@
+import json
+import shutil
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import pyarrow as pa
+import pyarrow.flight as fl
+import pytest
+
+from statcandb.cubes import process_cube
+from statcandb.flight import (
+    CubeCache,
+    CubeFlightServer,
+    _project,
+    cube_ticket,
+    disk_cached_cube_source,
+    estimated_nbytes,
+    open_cube_dataset,
+)
+from statcandb.materialize import local_cube_source
+
+
+@pytest.fixture
+def cube_root(fixtures_path: Path):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        process_cube(
+            fixtures_path / "10100001-eng.zip", Path(tmpdir) / "10100001.parquet"
+        )
+        yield Path(tmpdir)
+
+
+def _serve(cube_root: Path, cache: CubeCache) -> CubeFlightServer:
+    return CubeFlightServer(
+        "grpc://127.0.0.1:0", local_cube_source(cube_root), cache=cache
+    )
+
+
+def test_do_get(cube_root: Path):
+    with _serve(cube_root, CubeCache()) as server:
+        client = fl.connect(f"grpc://127.0.0.1:{server.port}")
+        whole = client.do_get(cube_ticket(10100001)).read_all()
+        assert whole.num_rows > 0
+        assert "1999" in whole["year"].to_pylist()
+
+        projected = client.do_get(
+            cube_ticket(10100001, columns=["REF_DATE", "VALUE"], years=[1999])
+        ).read_all()
+        assert projected.column_names == ["REF_DATE", "VALUE"]
+        assert 0 < projected.num_rows < whole.num_rows
+        assert set(projected["REF_DATE"].to_pylist()) == {1999}
+
+        # Concurrent streams share the one cached copy
+        with ThreadPoolExecutor(4) as pool:
+            tables = list(
+                pool.map(
+                    lambda _: client.do_get(cube_ticket(10100001)).read_all(),
+                    range(8),
+                )
+            )
+        assert all(table.num_rows == whole.num_rows for table in tables)
+
+        (result,) = client.do_action(fl.Action("cache-stats", b""))
+        stats = json.loads(result.body.to_pybytes())
+        assert stats["products"] == [10100001]
+        assert stats["misses"] == 2 and stats["hits"] == 9
+
+        info = client.get_flight_info(fl.FlightDescriptor.for_path("10100001"))
+        assert info.total_records == whole.num_rows
+        assert [f.descriptor.path for f in client.list_flights()] == [[b"10100001"]]
+
+        with pytest.raises(fl.FlightServerError, match="No cube"):
+            client.do_get(cube_ticket(1)).read_all()
+        with pytest.raises(fl.FlightServerError, match="No such columns"):
+            client.do_get(cube_ticket(10100001, columns=["NOPE"])).read_all()
+
+    # Asking for years of a cube without a year column is an error
+    table = pa.table({"REF_DATE": ["2023-01"], "VALUE": [1.0]})
+    with pytest.raises(fl.FlightServerError, match="no year column"):
+        _project(table, None, ["2023"])
+
+
+@pytest.mark.parametrize("fraction", [0, 0.5])
+def test_uncached_cubes_stream_from_disk(cube_root: Path, fraction: float):
+    dataset = open_cube_dataset(cube_root / "10100001.parquet")
+    decoded = dataset.to_table().nbytes
+    # Too large by its metadata, or only once it's read
+    max_bytes = max(int(decoded * fraction), 1)
+    if fraction:
+        assert estimated_nbytes(dataset) <= max_bytes
+    with _serve(cube_root, CubeCache(max_bytes=max_bytes)) as server:
+        client = fl.connect(f"grpc://127.0.0.1:{server.port}")
+        table = client.do_get(cube_ticket(10100001, columns=["VALUE"])).read_all()
+        assert table.column_names == ["VALUE"] and table.num_rows > 0
+        assert server.cache.product_ids() == []
+
+
+def test_republished_cubes_are_reloaded(cube_root: Path):
+    versions = {10100001: "1"}
+    clock = [0.0]
+    with tempfile.TemporaryDirectory() as cache_dir:
+        cache_dir = Path(cache_dir)
+        downloads = []
+
+        def download(product_id: int, tmpdir: Path):
+            downloads.append(product_id)
+            path = tmpdir / f"{product_id}.parquet"
+            shutil.copytree(cube_root / f"{product_id}.parquet", path)
+            return path
+
+        get_cube = disk_cached_cube_source(download, versions.get)
+        with CubeFlightServer(
+            "grpc://127.0.0.1:0",
+            get_cube,
+            cache_dir=cache_dir,
+            get_version=versions.get,
+            revalidate_seconds=10,
+            clock=lambda: clock[0],
+        ) as server:
+            client = fl.connect(f"grpc://127.0.0.1:{server.port}")
+            client.do_get(cube_ticket(10100001)).read_all()
+            versions[10100001] = "2"
+            # Not checked again until revalidate_seconds have passed
+            client.do_get(cube_ticket(10100001)).read_all()
+            assert downloads == [10100001]
+            clock[0] = 10
+            client.do_get(cube_ticket(10100001)).read_all()
+            assert downloads == [10100001, 10100001]
+            assert (cache_dir / "10100001.version").read_text() == "2"
+
+            # Evicting drops the copy on disk too
+            list(client.do_action(fl.Action("evict", b"10100001")))
+            assert not (cache_dir / "10100001.parquet").exists()
+            assert server.cache.product_ids() == []
+
+
+def test_cube_cache_evicts_least_recently_used():
+    table = pa.table({"x": list(range(100))})
+    cache = CubeCache(max_bytes=2 * table.nbytes)
+    assert cache.put(1, table) and cache.put(2, table)
+    assert cache.get(1) is table
+    assert cache.put(3, table)
+    assert cache.product_ids() == [1, 3]
+    assert cache.get(2) is None
+    assert not cache.put(4, pa.concat_tables([table] * 3))
+    assert cache.stats()["hits"] == 1 and cache.stats()["misses"] == 1
+    # A cube of another version is a miss
+    assert cache.put(5, table, version="1") and cache.get(5, "1") is table
+    assert cache.get(5, "2") is None and 5 not in cache.product_ids()
@@ -0,0 +1,54 @@
+import time
+import zipfile
+
+import pytest
+
+from statcandb.isolation import CubeWorker, LimitExceeded, WorkerLimits
+
+
+def add(x: int, y: int) -> int:
+    return x + y
+
+
+def sleep(seconds: float):
+    time.sleep(seconds)
+
+
+def hog_memory(megabytes: int):
+    data = b"x" * (megabytes * 1_024 * 1_024)
+    time.sleep(10)
+    return len(data)
+
+
+def bad_zip():
+    raise zipfile.BadZipFile("not a zip")
+
+
+def test_cube_worker():
+    with CubeWorker(WorkerLimits(max_tasks=2), poll_seconds=0.05) as worker:
+        assert worker.run(add, 1, y=2) == 3
+        pid = worker.pid
+
+        # Exceptions come through as themselves
+        with pytest.raises(zipfile.BadZipFile):
+            worker.run(bad_zip)
+
+        # Recycled after two calls
+        assert worker.pid is None
+        assert worker.run(add, 2, 2) == 4
+        assert worker.pid != pid
+
+
+def test_cube_worker_limits():
+    limits = WorkerLimits(seconds=1, max_rss_bytes=200 * 1_024 * 1_024)
+    with CubeWorker(limits, poll_seconds=0.05) as worker:
+        with pytest.raises(LimitExceeded) as e:
+            worker.run(sleep, 30)
+        assert e.value.reason == "timeout"
+
+        with pytest.raises(LimitExceeded) as e:
+            worker.run(hog_memory, 400)
+        assert e.value.reason == "memory"
+
+        # The worker is replaced
+        assert worker.run(add, 1, 1) == 2
@@ -0,0 +1,76 @@
+import tempfile
+from datetime import datetime
+from pathlib import Path
+
+import pandas as pd
+import pyarrow.parquet as pq
+
+from statcandb.cubes import process_cube
+from statcandb.delta_files import split_delta_file
+from statcandb.latest import latest_path_for, update_latest
+
+
+def test_process_cube_writes_latest(fixtures_path: Path):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        cube_path = Path(tmpdir) / "23100309.parquet"
+        latest_path = latest_path_for(cube_path)
+        assert latest_path == Path(tmpdir) / "23100309.latest.parquet"
+
+        process_cube(
+            fixtures_path / "23100309.csv",
+            cube_path,
+            latest_outfile=latest_path,
+            release_time=datetime(2023, 7, 1, 8, 30),
+        )
+
+        df = pd.read_csv(fixtures_path / "23100309.csv", dtype={"COORDINATE": str})
+        latest = pq.read_table(latest_path).to_pandas()
+        assert len(latest) == df["COORDINATE"].nunique()
+        assert "year" not in latest.columns
+        assert (latest["RELEASE_TIME"] == datetime(2023, 7, 1, 8, 30)).all()
+
+        expected = df.sort_values("REF_DATE").groupby("COORDINATE").last()
+        merged = latest.merge(expected, left_on="COORDINATE", right_index=True)
+        assert (merged["VALUE_x"].fillna(-1) == merged["VALUE_y"].fillna(-1)).all()
+
+
+def test_update_latest(fixtures_path: Path):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        tmpdir = Path(tmpdir)
+        cube_path = tmpdir / "23100309.parquet"
+        latest_path = latest_path_for(cube_path)
+        process_cube(
+            fixtures_path / "23100309.csv",
+            cube_path,
+            latest_outfile=latest_path,
+            release_time=datetime(2023, 7, 1, 8, 30),
+        )
+
+        # Pretend every value in the delta file has been revised
+        delta_df = pd.read_csv(fixtures_path / "20230715.csv")
+        delta_df["value"] = delta_df["value"] + 1
+        # And that a new series was added, dated as delta files date things
+        new_row = delta_df.iloc[[1]].assign(
+            coordinate="999.1.0.0.0.0.0.0.0.0", vectorId=1, refPer="2023-01-01"
+        )
+        delta_df = pd.concat([delta_df, new_row])
+        delta_csv = tmpdir / "20230715.csv"
+        delta_df.to_csv(delta_csv, index=False)
+        split_delta_file(delta_csv, tmpdir / "delta", format="parquet")
+
+        new_path = tmpdir / "new.latest.parquet"
+        update_latest(latest_path, tmpdir / "delta" / "productId=23100309", new_path)
+
+        old = pq.read_table(latest_path).to_pandas()
+        new = pq.read_table(new_path).to_pandas()
+        assert len(new) == len(old) + 1
+        assert new[new["COORDINATE"] == "999.1"]["REF_DATE"].tolist() == ["2023"]
+
+        merged = old.merge(new, on="COORDINATE")
+        assert (
+            merged["VALUE_x"].fillna(-1) + merged["VALUE_x"].notna()
+            == merged["VALUE_y"].fillna(-1)
+        ).all()
+        assert (merged["STATUS_x"] == merged["STATUS_y"]).all()
+        assert (merged["GEO_x"] == merged["GEO_y"]).all()
+        assert (merged["RELEASE_TIME_y"] == datetime(2023, 7, 14, 10, 0)).all()
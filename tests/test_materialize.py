@@ -0,0 +1,50 @@
+import tempfile
+from datetime import datetime
+from pathlib import Path
+
+import duckdb
+
+from statcandb.cubes import process_cube
+from statcandb.materialize import local_cube_source, materialize
+
+
+def test_materialize(fixtures_path: Path):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        tmpdir = Path(tmpdir)
+        process_cube(fixtures_path / "23100309.csv", tmpdir / "23100309.parquet")
+        database = tmpdir / "stats.duckdb"
+        source = local_cube_source(tmpdir)
+        release_times = {23100309: datetime(2023, 1, 1)}
+
+        result = materialize(database, [23100309, 10100001], source, release_times)
+        assert result.loaded == [23100309]
+        assert result.missing == [10100001]
+
+        with duckdb.connect(str(database)) as con:
+            rows = con.execute("SELECT count(*) FROM cube_23100309").fetchone()[0]
+            latest = con.execute(
+                "SELECT count(*), count(DISTINCT COORDINATE) FROM latest_23100309"
+            ).fetchone()
+            assert latest[0] == latest[1] <= rows
+            value = con.execute(
+                "SELECT VALUE FROM cube_23100309 WHERE vectorId = 1545975192 "
+                "AND REF_DATE = 2019"
+            ).fetchone()[0]
+            assert value == 27693387
+            indexes = {
+                name
+                for (name,) in con.execute(
+                    "SELECT index_name FROM duckdb_indexes()"
+                ).fetchall()
+            }
+            assert indexes == {
+                "cube_23100309_coordinate",
+                "cube_23100309_vector_id",
+            }
+
+        # Only reloaded once it's released again
+        result = materialize(database, [23100309], source, release_times)
+        assert result.unchanged == [23100309]
+        release_times = {23100309: datetime(2023, 2, 1)}
+        result = materialize(database, [23100309], source, release_times)
+        assert result.loaded == [23100309]
@@ -0,0 +1,40 @@
+import tempfile
+from pathlib import Path
+
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+from statcandb.cubes import process_cube
+from statcandb.observations import (
+    OBSERVATIONS_SCHEMA,
+    observations_key,
+    write_observations,
+)
+
+
+def test_write_observations(fixtures_path: Path):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        tmpdir = Path(tmpdir)
+        for product_id, fixture in [
+            (23100309, "23100309.csv"),
+            (10100001, "10100001-eng.zip"),
+        ]:
+            cube_path = tmpdir / f"{product_id}.parquet"
+            process_cube(fixtures_path / fixture, cube_path)
+            assert write_observations(cube_path, tmpdir / observations_key(product_id))
+
+        observations = ds.dataset(
+            tmpdir / "observations", format="parquet", partitioning="hive"
+        )
+        assert (
+            observations.schema.remove(observations.schema.get_field_index("productId"))
+            == OBSERVATIONS_SCHEMA
+        )
+        for product_id in [23100309, 10100001]:
+            cube = ds.dataset(tmpdir / f"{product_id}.parquet", partitioning="hive")
+            rows = observations.count_rows(filter=ds.field("productId") == product_id)
+            assert rows == cube.count_rows()
+
+        # Clustered by vector
+        tab = pq.read_table(tmpdir / observations_key(23100309))
+        assert tab["vectorId"].to_pylist() == sorted(tab["vectorId"].to_pylist())
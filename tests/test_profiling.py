@@ -0,0 +1,83 @@
+import os
+import pstats
+import tempfile
+import tracemalloc
+from pathlib import Path
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from statcandb.cubes import process_cube
+from statcandb.delta_files import merge_delta_file
+from statcandb.profiling import (
+    PROFILE_ENV_VAR,
+    get_profile_dir,
+    profile_stage,
+    profiled,
+    set_profile_dir,
+)
+
+
+def test_profile_stage_is_off_by_default():
+    assert get_profile_dir() is None
+    with profile_stage("process", 1):
+        assert not tracemalloc.is_tracing()
+
+
+def test_profile_stage(fixtures_path: Path):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        tmpdir = Path(tmpdir)
+        set_profile_dir(tmpdir / "profiles")
+        try:
+            assert os.environ[PROFILE_ENV_VAR] == str(tmpdir / "profiles")
+            with profile_stage("process", 10100001):
+                # Nested stages are part of the outer one
+                with profile_stage("inner", 10100001):
+                    process_cube(
+                        fixtures_path / "10100001-eng.zip",
+                        tmpdir / "10100001.parquet",
+                    )
+            assert profiled("sum", "numbers", sum, [1, 2, 3]) == 6
+        finally:
+            set_profile_dir(None)
+        assert PROFILE_ENV_VAR not in os.environ
+
+        outdir = tmpdir / "profiles" / "10100001"
+        assert sorted(path.name for path in outdir.iterdir()) == [
+            "process.allocations.txt",
+            "process.collapsed",
+            "process.pstats",
+        ]
+        stats = pstats.Stats(str(outdir / "process.pstats"))
+        assert any(name == "process_cube" for _, _, name in stats.stats)
+        summary = (outdir / "process.allocations.txt").read_text()
+        assert "Peak traced Python memory" in summary
+        for line in (outdir / "process.collapsed").read_text().splitlines():
+            stack, count = line.rsplit(" ", 1)
+            assert int(count) > 0 and stack
+
+        assert (tmpdir / "profiles" / "numbers" / "sum.pstats").exists()
+
+
+def test_merge_is_profiled_by_product():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        tmpdir = Path(tmpdir)
+        pq.write_table(
+            pa.table({"vectorId": [1, 2], "value": [1.0, 2.0]}),
+            tmpdir / "original.parquet",
+        )
+        pq.write_table(
+            pa.table({"vectorId": [2], "value": [3.0]}), tmpdir / "delta.parquet"
+        )
+        set_profile_dir(tmpdir / "profiles")
+        try:
+            merge_delta_file(
+                tmpdir / "original.parquet",
+                tmpdir / "delta.parquet",
+                tmpdir / "new.parquet",
+                product_id=10100001,
+            )
+        finally:
+            set_profile_dir(None)
+        assert pq.read_table(tmpdir / "new.parquet")["value"].to_pylist() == [1.0, 3.0]
+        assert (tmpdir / "profiles" / "10100001" / "merge.pstats").exists()
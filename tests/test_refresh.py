@@ -0,0 +1,198 @@
+import json
+import urllib.request
+from datetime import date, datetime, timedelta, timezone
+
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session
+
+from statcandb.cubes import ProductMetadata
+from statcandb.models import Base, Product
+from statcandb.refresh import (
+    RELEASE_TIMEZONE,
+    RefreshWindow,
+    freshness,
+    new_releases,
+    poll_window,
+    serve_freshness,
+    serve_refresh,
+)
+
+
+@pytest.fixture
+def session():
+    engine = create_engine("sqlite://")
+    Base.metadata.create_all(engine)
+    with Session(engine) as session:
+        yield session
+
+
+class FakeClock:
+    def __init__(self, start: datetime):
+        self.current = start
+        self.sleeps = []
+
+    def now(self) -> datetime:
+        return self.current
+
+    def sleep(self, seconds: float):
+        self.sleeps.append(seconds)
+        self.current += timedelta(seconds=seconds)
+
+
+def _eastern(*args) -> datetime:
+    return datetime(*args, tzinfo=RELEASE_TIMEZONE)
+
+
+def test_next_release_day():
+    window = RefreshWindow(duration_seconds=30 * 60)
+    # Thursday 2023-08-03, before, during, and after the window
+    assert window.next_release_day(_eastern(2023, 8, 3, 6)) == date(2023, 8, 3)
+    assert window.next_release_day(_eastern(2023, 8, 3, 8, 45)) == date(2023, 8, 3)
+    assert window.next_release_day(_eastern(2023, 8, 3, 9, 1)) == date(2023, 8, 4)
+    # Friday after the window skips the weekend
+    assert window.next_release_day(_eastern(2023, 8, 4, 12)) == date(2023, 8, 7)
+    assert window.start_on(date(2023, 8, 7)) == _eastern(2023, 8, 7, 8, 29)
+
+
+def test_new_releases():
+    changed = [
+        ProductMetadata(1, datetime(2023, 8, 3, 8, 30)),
+        ProductMetadata(2, datetime(2023, 8, 2, 8, 30)),
+        ProductMetadata(2, datetime(2023, 8, 3, 8, 30)),
+        ProductMetadata(3, datetime(2023, 8, 3, 8, 30)),
+    ]
+    known = {1: datetime(2023, 8, 3, 8, 30), 2: datetime(2023, 8, 1, 8, 30)}
+    assert new_releases(changed, known) == [
+        ProductMetadata(2, datetime(2023, 8, 3, 8, 30)),
+        ProductMetadata(3, datetime(2023, 8, 3, 8, 30)),
+    ]
+
+
+def test_poll_window():
+    day = date(2023, 8, 3)
+    window = RefreshWindow(
+        lead_seconds=0, duration_seconds=600, poll_seconds=10, max_poll_seconds=40
+    )
+    clock = FakeClock(window.start_on(day))
+    release = datetime(2023, 8, 3, 8, 30)
+
+    def get_changed(the_day: date) -> list[ProductMetadata]:
+        assert the_day == day
+        if clock.now() < window.release_on(day) + timedelta(seconds=30):
+            raise ConnectionError("Not yet")
+        # Product 2 shows up a little later than product 1
+        elapsed = clock.now() - window.release_on(day)
+        return [ProductMetadata(1, release)] + (
+            [ProductMetadata(2, release)] if elapsed > timedelta(seconds=200) else []
+        )
+
+    batches = []
+    dispatched = poll_window(
+        window,
+        day,
+        get_changed,
+        lambda product_ids: {},
+        batches.append,
+        now=clock.now,
+        sleep=clock.sleep,
+        log=lambda message: None,
+    )
+    assert batches == [[ProductMetadata(1, release)], [ProductMetadata(2, release)]]
+    assert sorted(dispatched) == [
+        ProductMetadata(1, release),
+        ProductMetadata(2, release),
+    ]
+    assert clock.now() == window.end_on(day)
+    # Backs off while nothing is new, and polls quickly again after a release
+    assert clock.sleeps[:4] == [20, 40, 10, 20]
+    assert max(clock.sleeps) == 40
+
+
+def test_serve_refresh_sleeps_until_the_window():
+    window = RefreshWindow(lead_seconds=60, duration_seconds=60, poll_seconds=30)
+    clock = FakeClock(_eastern(2023, 8, 5, 12))  # A Saturday
+    days = []
+    serve_refresh(
+        window,
+        lambda day: days.append(day) or [],
+        lambda product_ids: {},
+        lambda products: None,
+        now=clock.now,
+        sleep=clock.sleep,
+        log=lambda message: None,
+        max_windows=1,
+    )
+    assert days and set(days) == {date(2023, 8, 7)}
+    assert clock.now() == window.end_on(date(2023, 8, 7))
+
+
+def test_freshness(session: Session):
+    session.add(Product(1, datetime(2023, 8, 2, 8, 30), is_uploaded=True))
+    # 08:30 EDT is 12:30 UTC, so uploaded 10 minutes after release
+    session.add(
+        Product(
+            1,
+            datetime(2023, 8, 3, 8, 30),
+            is_uploaded=True,
+            created_at=datetime(2023, 8, 3, 12, 40),
+        )
+    )
+    session.add(Product(2, datetime(2023, 8, 3, 8, 30), is_uploaded=False))
+    session.commit()
+
+    now = datetime(2023, 8, 3, 13, 30, tzinfo=timezone.utc)
+    pending = [ProductMetadata(2, datetime(2023, 8, 3, 8, 30))]
+    entries = freshness(session, pending, now=now)
+    assert [(e.product_id, e.lag_seconds) for e in entries] == [(1, 600), (2, 3600)]
+    assert entries[0].available_at == datetime(2023, 8, 3, 12, 40, tzinfo=timezone.utc)
+    assert entries[1].available_at is None
+
+    assert [e.product_id for e in freshness(session, product_ids=[2])] == []
+
+    server = serve_freshness(0, lambda: entries, host="127.0.0.1")
+    try:
+        url = f"http://127.0.0.1:{server.server_address[1]}/freshness"
+        with urllib.request.urlopen(url) as response:
+            served = json.loads(response.read())
+    finally:
+        server.shutdown()
+    assert [entry["lag_seconds"] for entry in served] == [600, 3600]
+
+
+def test_poll_window_retries_failures():
+    day = date(2023, 8, 3)
+    window = RefreshWindow(
+        lead_seconds=0, duration_seconds=120, poll_seconds=10, max_poll_seconds=10
+    )
+    clock = FakeClock(window.start_on(day))
+    release = ProductMetadata(1, datetime(2023, 8, 3, 8, 30))
+    failed = set()
+    batches = []
+    known_calls = []
+
+    def get_known(product_ids: list[int]) -> dict[int, datetime]:
+        known_calls.append(product_ids)
+        if len(known_calls) == 1:
+            raise OSError("database is locked")
+        return {}
+
+    def dispatch(products: list[ProductMetadata]):
+        failed.difference_update(products)
+        batches.append(products)
+        # The first attempt fails, and the release leaves the changed list
+        if len(batches) == 1:
+            failed.update(products)
+
+    poll_window(
+        window,
+        day,
+        lambda the_day: [release] if len(batches) == 0 else [],
+        get_known,
+        dispatch,
+        now=clock.now,
+        sleep=clock.sleep,
+        log=lambda message: None,
+        get_failed=lambda: list(failed),
+    )
+    assert batches == [[release], [release]]
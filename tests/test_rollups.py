@@ -0,0 +1,162 @@
+import csv
+import tempfile
+from decimal import Decimal
+from pathlib import Path
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from statcandb.cubes import process_cube
+from statcandb.delta_files import SPLIT_DELTA_FILE_SCHEMA
+from statcandb.rollups import (
+    detect_frequency,
+    rollup_path_for,
+    table_for,
+    update_rollup,
+    write_rollups,
+)
+
+HEADER = [
+    "REF_DATE",
+    "GEO",
+    "DGUID",
+    "UOM",
+    "UOM_ID",
+    "SCALAR_FACTOR",
+    "SCALAR_ID",
+    "VECTOR",
+    "COORDINATE",
+    "VALUE",
+    "STATUS",
+    "SYMBOL",
+    "TERMINATED",
+    "DECIMALS",
+]
+
+
+def write_monthly_cube(csv_path: Path):
+    """
+    Two series over 2019 and 2020: 1.1 in units with value = month, and 1.2 in
+    thousands with value = 1.5, suppressed in March 2019
+    """
+    with open(csv_path, "w", newline="") as outfile:
+        writer = csv.writer(outfile, quoting=csv.QUOTE_ALL)
+        writer.writerow(HEADER)
+        for year in [2019, 2020]:
+            for month in range(1, 13):
+                ref_date = f"{year}-{month:02d}"
+                writer.writerow(
+                    [ref_date, "Canada", "", "Units", "1", "units", "0"]
+                    + ["v1", "1.1", str(month), "", "", "", "0"]
+                )
+                suppressed = (year, month) == (2019, 3)
+                writer.writerow(
+                    [ref_date, "Canada", "", "Units", "1", "thousands", "3"]
+                    + ["v2", "1.2", "" if suppressed else "1.5"]
+                    + ["x" if suppressed else "", "", "", "1"]
+                )
+
+
+def test_detect_frequency():
+    assert detect_frequency(["2019-01", "2019-02"]) == "monthly"
+    assert detect_frequency(["2019-01", "2019-04", "2019-07"]) == "quarterly"
+    assert detect_frequency(["2019-01"]) == "monthly"
+    assert detect_frequency(["2019", "2020"]) is None
+    assert detect_frequency(["2019-01-01"]) is None
+
+
+def test_write_rollups():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        tmpdir = Path(tmpdir)
+        csv_path = tmpdir / "99990001.csv"
+        write_monthly_cube(csv_path)
+        cube_path = tmpdir / "99990001.parquet"
+        process_cube(csv_path, cube_path)
+
+        assert table_for(cube_path, "annual") == cube_path
+        paths = write_rollups(cube_path)
+        assert paths == {
+            "quarterly": tmpdir / "99990001.rollup-quarterly.parquet",
+            "annual": tmpdir / "99990001.rollup-annual.parquet",
+        }
+        assert table_for(cube_path, "annual") == paths["annual"]
+        assert table_for(cube_path, "monthly") == cube_path
+
+        annual = {
+            (row["COORDINATE"], row["PERIOD"]): row
+            for row in pq.read_table(paths["annual"]).to_pylist()
+        }
+        assert len(annual) == 4
+        units = annual[("1.1", "2019")]
+        assert units["SUM"] == Decimal(78)
+        assert units["AVG"] == Decimal("6.5")
+        assert units["COMPLETE"] and units["STATUS"] == ""
+
+        # Scaled by the scalar factor, and without the suppressed month
+        thousands = annual[("1.2", "2019")]
+        assert thousands["N_PERIODS"] == 12
+        assert thousands["N_OBSERVATIONS"] == 11
+        assert not thousands["COMPLETE"]
+        assert thousands["SUM"] == Decimal(16_500)
+        assert thousands["MAX"] == Decimal(1_500)
+        assert thousands["STATUS"] == "x"
+        assert annual[("1.2", "2020")]["COMPLETE"]
+
+        quarterly = pq.read_table(paths["quarterly"]).to_pylist()
+        assert len(quarterly) == 16
+        first = [
+            row
+            for row in quarterly
+            if row["COORDINATE"] == "1.1" and row["PERIOD"] == "2019-Q1"
+        ][0]
+        assert first["N_PERIODS"] == 3 and first["SUM"] == Decimal(6)
+
+
+def test_write_rollups_skips_annual_cubes(fixtures_path: Path):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        cube_path = Path(tmpdir) / "23100309.parquet"
+        process_cube(fixtures_path / "23100309.csv", cube_path)
+        assert write_rollups(cube_path) == {}
+        assert not rollup_path_for(cube_path, "annual").exists()
+
+
+def test_update_rollup():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        tmpdir = Path(tmpdir)
+        csv_path = tmpdir / "99990001.csv"
+        write_monthly_cube(csv_path)
+        cube_path = tmpdir / "99990001.parquet"
+        process_cube(csv_path, cube_path)
+        rollup_path = write_rollups(cube_path)["annual"]
+
+        # As in the productId=... directory of a split delta file
+        schema = SPLIT_DELTA_FILE_SCHEMA.remove(0)
+        delta = {name: [None] for name in schema.names}
+        # The suppressed month is released as a preliminary 2.5 thousand
+        delta.update(
+            coordinate=["1.2.0.0.0.0.0.0.0.0"],
+            vectorId=[2],
+            refPer=["2019-03-01"],
+            symbolCode=[1],
+            statusCode=[0],
+            securityLevelCode=[0],
+            value=[2.5],
+            releaseTime=["2023-08-03T08:30"],
+            scalarFactorCode=[3],
+            scaledValue=[Decimal(2_500)],
+        )
+        delta_path = tmpdir / "delta.parquet"
+        pq.write_table(pa.table(delta, schema=schema), delta_path)
+
+        new_path = tmpdir / "new.rollup-annual.parquet"
+        update_rollup(rollup_path, cube_path, delta_path, new_path, "annual")
+
+        old = pq.read_table(rollup_path).to_pylist()
+        new = pq.read_table(new_path).to_pylist()
+        assert len(new) == len(old)
+        changed = [row for row in new if row not in old]
+        assert len(changed) == 1
+        assert changed[0]["COORDINATE"] == "1.2" and changed[0]["PERIOD"] == "2019"
+        assert changed[0]["COMPLETE"]
+        assert changed[0]["SUM"] == Decimal(19_000)
+        assert changed[0]["STATUS"] == "" and changed[0]["SYMBOL"] == "p"
@@ -0,0 +1,49 @@
+from datetime import datetime
+
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session
+
+from statcandb.cubes import ProductMetadata
+from statcandb.models import Base, CubeStat
+from statcandb.scheduling import estimate_costs, schedule
+
+
+@pytest.fixture
+def session():
+    engine = create_engine("sqlite://")
+    Base.metadata.create_all(engine)
+    with Session(engine) as session:
+        yield session
+
+
+def _products(*product_ids: int) -> list[ProductMetadata]:
+    return [ProductMetadata(pid, datetime(2023, 1, 1)) for pid in product_ids]
+
+
+def test_estimate_costs(session: Session):
+    session.add(CubeStat(1, zip_bytes=100, row_count=10, seconds=1.0))
+    session.add(CubeStat(1, zip_bytes=300, row_count=30, seconds=3.0))
+    session.add(CubeStat(2, zip_bytes=500, row_count=50, seconds=5.0))
+    session.commit()
+
+    # The most recent pull wins, and unknown products get the median
+    costs = estimate_costs(_products(1, 2, 3), session)
+    assert costs == {1: 300.0, 2: 500.0, 3: 400.0}
+
+    costs = estimate_costs(_products(1, 3), session, get_size=lambda pid: 7)
+    assert costs == {1: 300.0, 3: 7.0}
+
+
+def test_schedule_largest_first():
+    products = _products(1, 2, 3, 4, 5, 6)
+    costs = {1: 10.0, 2: 60.0, 3: 30.0, 4: 40.0, 5: 50.0, 6: 20.0}
+    ordered = schedule(products, costs, small_lane_every=0)
+    assert [p.product_id for p in ordered] == [2, 5, 4, 3, 6, 1]
+
+
+def test_schedule_small_lane_and_priority():
+    products = _products(1, 2, 3, 4, 5, 6)
+    costs = {1: 10.0, 2: 60.0, 3: 30.0, 4: 40.0, 5: 50.0, 6: 20.0}
+    ordered = schedule(products, costs, priority=[3], small_lane_every=2)
+    assert [p.product_id for p in ordered] == [3, 2, 1, 5, 6, 4]
@@ -0,0 +1,76 @@
+import tempfile
+from pathlib import Path
+
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+from statcandb.cubes import process_cube
+from statcandb.series_index import (
+    bloom_filter_columns,
+    lookup_series,
+    read_series,
+    series_index_path_for,
+    write_series_index,
+)
+
+
+def test_process_cube_writes_bloom_filters(fixtures_path: Path):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        cube_path = Path(tmpdir) / "10100001.parquet"
+        process_cube(fixtures_path / "10100001-eng.zip", cube_path, bloom_filters=True)
+        (filepath,) = cube_path.rglob("*.parquet")
+        assert set(bloom_filter_columns(filepath)) == {"COORDINATE", "GEO"}
+
+        other_path = Path(tmpdir) / "other.parquet"
+        process_cube(fixtures_path / "10100001-eng.zip", other_path)
+        (filepath,) = other_path.rglob("*.parquet")
+        assert bloom_filter_columns(filepath) == []
+
+
+def test_read_series(fixtures_path: Path):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        tmpdir = Path(tmpdir)
+        processed_path = tmpdir / "processed.parquet"
+        process_cube(
+            fixtures_path / "10100001-eng.zip", processed_path, bloom_filters=True
+        )
+        cube = ds.dataset(processed_path).to_table()
+        # process_cube clusters each series, rather than keeping StatCan's
+        # order by REF_DATE
+        assert cube["COORDINATE"].to_pylist() == sorted(cube["COORDINATE"].to_pylist())
+
+        # The fixture fits in one row group, so split it up in the same order
+        cube_path = tmpdir / "10100001.parquet"
+        cube_path.mkdir()
+        pq.write_table(cube, cube_path / "part-0.parquet", row_group_size=20)
+
+        index = write_series_index(cube_path)
+        assert series_index_path_for(cube_path).exists()
+        assert set(index["column"].to_pylist()) == {"COORDINATE", "GEO"}
+        assert set(index["path"].to_pylist()) == {"10100001.parquet/part-0.parquet"}
+
+        coordinate = cube["COORDINATE"][0].as_py()
+        hits = lookup_series(str(series_index_path_for(cube_path)), coordinate)
+        assert hits["row_group"].to_pylist() == [0]
+        # Every row group has GEO = Canada
+        hits = lookup_series(
+            str(series_index_path_for(cube_path)), "Canada", column="GEO"
+        )
+        assert len(hits) == pq.ParquetFile(cube_path / "part-0.parquet").num_row_groups
+
+        series = read_series("10100001.parquet", coordinate, root=str(tmpdir))
+        expected = cube.filter(pc.equal(cube["COORDINATE"], coordinate))
+        assert series.num_rows == expected.num_rows > 0
+        assert series["VALUE"].to_pylist() == expected["VALUE"].to_pylist()
+
+        filtered = read_series(
+            "10100001.parquet",
+            "Canada",
+            column="GEO",
+            root=str(tmpdir),
+            filter=pc.field("REF_DATE") == 2011,
+        )
+        assert filtered.num_rows == cube.filter(pc.field("REF_DATE") == 2011).num_rows
+
+        assert read_series("10100001.parquet", "9.9", root=str(tmpdir)).num_rows == 0
@@ -0,0 +1,121 @@
+import tempfile
+from datetime import datetime
+from types import SimpleNamespace
+
+import pytest
+from sqlalchemy import create_engine, update
+from sqlalchemy.orm import Session
+
+from statcandb.cli import full
+from statcandb.cubes import ProductMetadata
+from statcandb.models import Base, Lease
+from statcandb.sharding import (
+    LeaseHeartbeat,
+    claim_lease,
+    filter_shard,
+    finish_lease,
+    parse_shard,
+    release_lease,
+    renew_lease,
+    unfinished_products,
+)
+
+
+@pytest.fixture
+def session():
+    engine = create_engine("sqlite://")
+    Base.metadata.create_all(engine)
+    with Session(engine) as session:
+        yield session
+
+
+def test_parse_shard():
+    assert parse_shard("3/8") == (3, 8)
+    for bad in ["8/8", "-1/8", "3", "a/b", "0/0"]:
+        with pytest.raises(ValueError):
+            parse_shard(bad)
+
+
+def test_filter_shard_partitions():
+    products = [
+        ProductMetadata(product_id, datetime(2023, 1, 1))
+        for product_id in range(10100001, 10100201)
+    ]
+    shards = [filter_shard(products, i, 8) for i in range(8)]
+    assert sorted(p for shard in shards for p in shard) == products
+    assert all(shard for shard in shards)
+
+
+def test_claim_lease(session: Session):
+    product = ProductMetadata(10100001, datetime(2023, 1, 1))
+
+    assert claim_lease(session, product, "a")
+    assert not claim_lease(session, product, "b")
+    assert renew_lease(session, product.product_id, "a")
+    assert not renew_lease(session, product.product_id, "b")
+
+    # Once finished, no one should pick up the same release again
+    finish_lease(session, product.product_id, "a")
+    assert not claim_lease(session, product, "b")
+    assert unfinished_products(session, [product]) == []
+
+    # But a new release is fair game
+    new_product = ProductMetadata(10100001, datetime(2023, 2, 1))
+    assert unfinished_products(session, [new_product]) == [new_product]
+    assert claim_lease(session, new_product, "b")
+
+
+def test_expired_lease_is_reclaimed(session: Session):
+    product = ProductMetadata(10100001, datetime(2023, 1, 1))
+    assert claim_lease(session, product, "a")
+
+    session.execute(update(Lease).values(expires_at=datetime(2000, 1, 1)))
+    session.commit()
+
+    assert claim_lease(session, product, "b")
+    assert not renew_lease(session, product.product_id, "a")
+
+
+def test_release_lease(session: Session):
+    product = ProductMetadata(10100001, datetime(2023, 1, 1))
+    assert claim_lease(session, product, "a")
+    release_lease(session, product.product_id, "a")
+    assert claim_lease(session, product, "b")
+
+
+def test_heartbeat_flags_a_lost_lease():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        # The heartbeat's thread needs to see the same database
+        engine = create_engine(f"sqlite:///{tmpdir}/leases.db")
+        Base.metadata.create_all(engine)
+        product = ProductMetadata(10100001, datetime(2023, 1, 1))
+        with Session(engine) as session:
+            assert claim_lease(session, product, "a")
+            session.execute(update(Lease).values(expires_at=datetime(2000, 1, 1)))
+            session.commit()
+            assert claim_lease(session, product, "b")
+
+        with LeaseHeartbeat(engine, product.product_id, "a", 0) as heartbeat:
+            assert heartbeat.lost.wait(5)
+        engine.dispose()
+
+
+def test_failed_pull_releases_its_lease(session: Session, monkeypatch):
+    product = ProductMetadata(10100001, datetime(2023, 1, 1))
+    pulled = []
+
+    def pull_process_upload_cube(product, *args):
+        pulled.append(product)
+        return False
+
+    monkeypatch.setattr(full, "get_config", lambda: SimpleNamespace(r2_bucket="b"))
+    monkeypatch.setattr(full, "get_s3", lambda config: None)
+    monkeypatch.setattr(full, "_pull_process_upload_cube", pull_process_upload_cube)
+    success_count = full._pull_process_upload_cube_list_with_leases(
+        [product], "a", 600, 0, session=session, options=full.PipelineOptions()
+    )
+    assert success_count == 0
+    # Tried once, and left for the next run to retry
+    assert pulled == [product]
+    assert unfinished_products(session, [product]) == [product]
+    assert claim_lease(session, product, "b")
@@ -0,0 +1,203 @@
+import io
+import random
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from email.utils import format_datetime
+
+import pytest
+import requests
+from pytest_httpserver import HTTPServer
+
+from statcandb.cubes import get_pid_list
+from statcandb.throttling import (
+    AdaptiveLimiter,
+    RetryPolicy,
+    TokenBucket,
+    get_limiter,
+    retry_after_seconds,
+    set_limiter,
+    throttled_request,
+    throttled_stream,
+)
+
+
+class FakeClock:
+    def __init__(self):
+        self.current = 0.0
+        self.sleeps = []
+
+    def now(self) -> float:
+        return self.current
+
+    def sleep(self, seconds: float):
+        self.sleeps.append(seconds)
+        self.current += seconds
+
+
+def _response(status: int, headers: dict = {}) -> requests.Response:
+    response = requests.Response()
+    response.status_code = status
+    response.headers.update(headers)
+    response.raw = io.BytesIO(b"")
+    return response
+
+
+class FakeSession:
+    """Answers with the given responses (or raises the given errors) in order"""
+
+    def __init__(self, outcomes: list):
+        self.outcomes = list(outcomes)
+        self.calls = 0
+
+    def request(self, method: str, url: str, **kwargs) -> requests.Response:
+        self.calls += 1
+        outcome = self.outcomes.pop(0)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+
+def test_retry_after_seconds():
+    assert retry_after_seconds(_response(429, {"Retry-After": "7"})) == 7
+    assert retry_after_seconds(_response(429)) is None
+    assert retry_after_seconds(_response(429, {"Retry-After": "soon"})) is None
+    now = datetime(2023, 8, 3, 12, 30, tzinfo=timezone.utc)
+    later = format_datetime(now + timedelta(seconds=90), usegmt=True)
+    assert retry_after_seconds(_response(503, {"Retry-After": later}), now) == 90
+
+
+def test_token_bucket():
+    clock = FakeClock()
+    bucket = TokenBucket(rate=2, burst=2, clock=clock.now, sleep=clock.sleep)
+    for _ in range(6):
+        bucket.acquire()
+    # The burst goes at once, then one request every half second
+    assert clock.sleeps == [0.5, 0.5, 0.5, 0.5]
+
+
+def test_adaptive_limiter():
+    clock = FakeClock()
+    limiter = AdaptiveLimiter(
+        rate=4,
+        concurrency=4,
+        increase_after=3,
+        rate_step=1,
+        cooldown_seconds=10,
+        clock=clock.now,
+        sleep=clock.sleep,
+    )
+    limiter.record_error(retry_after=30)
+    # Errors in the cooldown don't decrease again
+    limiter.record_error()
+    assert (limiter.rate, limiter.concurrency) == (2, 2)
+
+    # Everyone waits out the Retry-After
+    with limiter.slot():
+        assert limiter.in_flight == 1
+    assert clock.now() >= 30 and limiter.in_flight == 0
+
+    for _ in range(3):
+        limiter.record_success()
+    assert (limiter.rate, limiter.concurrency) == (3, 3)
+
+    limiter.record_error()
+    assert (limiter.rate, limiter.concurrency) == (1.5, 1)
+
+
+def test_throttled_request():
+    clock = FakeClock()
+    limiter = AdaptiveLimiter(clock=clock.now, sleep=clock.sleep)
+    session = FakeSession(
+        [
+            _response(429, {"Retry-After": "20"}),
+            requests.ConnectionError("reset"),
+            _response(409),
+            _response(200),
+        ]
+    )
+    policy = RetryPolicy(base_seconds=1, max_seconds=8)
+    response = throttled_request(
+        "GET",
+        "https://example.com",
+        session=session,
+        limiter=limiter,
+        policy=policy,
+        rng=random.Random(0),
+    )
+    assert response.status_code == 200
+    assert session.calls == 4
+    assert (limiter.errors, limiter.successes) == (3, 1)
+    # Waited at least as long as asked, with jittered backoff after
+    assert clock.sleeps[0] >= 20
+    assert all(0 <= seconds <= 8 for seconds in clock.sleeps[1:])
+
+    # Not retried
+    session = FakeSession([_response(404)])
+    response = throttled_request("GET", "x", session=session, limiter=limiter)
+    assert response.status_code == 404 and session.calls == 1
+
+    # Gives up after the last attempt
+    session = FakeSession([_response(503)] * 2)
+    policy = RetryPolicy(max_attempts=2)
+    response = throttled_request(
+        "GET", "x", session=session, limiter=limiter, policy=policy
+    )
+    assert response.status_code == 503 and session.calls == 2
+    session = FakeSession([requests.Timeout()] * 2)
+    with pytest.raises(requests.Timeout):
+        throttled_request("GET", "x", session=session, limiter=limiter, policy=policy)
+
+
+def test_throttled_stream_holds_its_slot():
+    clock = FakeClock()
+    limiter = AdaptiveLimiter(concurrency=2, clock=clock.now, sleep=clock.sleep)
+    session = FakeSession([_response(429), _response(200)])
+    with throttled_stream("GET", "x", session=session, limiter=limiter) as response:
+        assert response.status_code == 200
+        # Counted until the body has been read
+        assert limiter.in_flight == 1
+    assert limiter.in_flight == 0
+
+
+def test_waiters_respect_a_pause_set_while_they_wait():
+    clock = FakeClock()
+    limiter = AdaptiveLimiter(concurrency=1, clock=clock.now, sleep=clock.sleep)
+    limiter.acquire()
+    started = threading.Event()
+    acquired_at = []
+
+    def wait_for_slot():
+        started.set()
+        with limiter.slot():
+            acquired_at.append(clock.now())
+
+    waiter = threading.Thread(target=wait_for_slot)
+    waiter.start()
+    started.wait()
+    # Let the waiter block on the slot before pausing
+    time.sleep(0.05)
+    limiter.record_error(retry_after=30)
+    limiter.release()
+    waiter.join(timeout=5)
+    assert acquired_at and acquired_at[0] >= 30
+
+
+def test_wds_calls_are_retried(httpserver: HTTPServer):
+    clock = FakeClock()
+    original = get_limiter()
+    set_limiter(AdaptiveLimiter(clock=clock.now, sleep=clock.sleep))
+    try:
+        url = "/t1/wds/rest/getAllCubesListLite"
+        httpserver.expect_ordered_request(url).respond_with_data(
+            "Too many requests", status=409
+        )
+        httpserver.expect_ordered_request(url).respond_with_json(
+            [{"productId": "10100001", "releaseTime": "2012-08-01T12:30"}]
+        )
+        assert [p.product_id for p in get_pid_list(httpserver.url_for(url))] == [
+            10100001
+        ]
+        assert get_limiter().errors == 1
+    finally:
+        set_limiter(original)
@@ -0,0 +1,106 @@
+import tempfile
+from pathlib import Path
+
+import pandas as pd
+import pyarrow.parquet as pq
+
+from statcandb import vector_index
+from statcandb.cubes import process_cube
+from statcandb.delta_files import split_delta_file
+from statcandb.vector_index import (
+    add_to_vector_index,
+    compact_vector_index,
+    index_cube,
+    index_delta_split,
+    lookup_vector,
+    read_vector,
+)
+
+
+def test_index_cube(fixtures_path: Path):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        tmpdir = Path(tmpdir)
+        cube_path = tmpdir / "output" / "10100001.parquet"
+        process_cube(fixtures_path / "10100001-eng.zip", cube_path)
+
+        entries = index_cube(10100001, cube_path)
+        df = pd.read_parquet(cube_path)
+        assert entries.num_rows == df["VECTOR"].nunique()
+        assert entries["vectorId"].to_pylist() == sorted(
+            entries["vectorId"].to_pylist()
+        )
+
+        index_dir = tmpdir / "index"
+        add_to_vector_index(index_dir, entries, replace_product=10100001)
+
+        hits = lookup_vector(index_dir, 30411572)
+        assert hits.num_rows == 1
+        assert hits["productId"][0].as_py() == 10100001
+        assert hits["coordinate"][0].as_py() == "1.1"
+        assert hits["path"][0].as_py().startswith("10100001.parquet/")
+
+        rows = read_vector(index_dir, 30411572, str(tmpdir / "output"))
+        expected = df[df["VECTOR"] == "v30411572"]
+        assert rows.num_rows == len(expected)
+        assert sorted(rows["VALUE"].to_pylist()) == sorted(expected["VALUE"])
+
+
+def test_index_delta_and_replace(fixtures_path: Path):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        tmpdir = Path(tmpdir)
+        split_path = tmpdir / "deltas" / "20230715"
+        split_delta_file(fixtures_path / "20230715.csv", split_path, format="parquet")
+
+        entries = index_delta_split(split_path)
+        delta_df = pd.read_csv(fixtures_path / "20230715.csv")
+        assert entries.num_rows == delta_df["vectorId"].nunique()
+
+        index_dir = tmpdir / "index"
+        add_to_vector_index(index_dir, entries, replace_product=None)
+
+        vector_id = int(delta_df["vectorId"].iloc[0])
+        hits = lookup_vector(index_dir, vector_id)
+        assert hits["source"].to_pylist() == ["delta"]
+        assert hits["path"][0].as_py().startswith("20230715/productId=23100309/")
+
+        rows = read_vector(index_dir, vector_id, str(tmpdir / "deltas"), source="delta")
+        assert rows.num_rows == (delta_df["vectorId"] == vector_id).sum()
+
+        # Compacting keeps everything, and in sorted order
+        assert compact_vector_index(index_dir) == entries.num_rows
+        assert not list((index_dir / "pending").iterdir())
+        compacted = pq.read_table(index_dir / "index.parquet")
+        assert compacted["vectorId"].to_pylist() == sorted(
+            compacted["vectorId"].to_pylist()
+        )
+
+        # Re-indexing the cube drops the product's old entries
+        add_to_vector_index(index_dir, entries.slice(0, 0), replace_product=23100309)
+        assert lookup_vector(index_dir, vector_id).num_rows == 0
+
+
+def test_compaction_keeps_fragments_added_meanwhile(fixtures_path: Path, monkeypatch):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        tmpdir = Path(tmpdir)
+        split_path = tmpdir / "deltas" / "20230715"
+        split_delta_file(fixtures_path / "20230715.csv", split_path, format="parquet")
+        entries = index_delta_split(split_path)
+        index_dir = tmpdir / "index"
+        add_to_vector_index(index_dir, entries.slice(0, 1), replace_product=None)
+
+        read_index = vector_index._read_index
+        added = []
+
+        def read_then_add(*args, **kwargs):
+            tab = read_index(*args, **kwargs)
+            # Another process adds a fragment while this one compacts
+            added.append(add_to_vector_index(index_dir, entries.slice(1, 1), None))
+            return tab
+
+        monkeypatch.setattr(vector_index, "_read_index", read_then_add)
+        assert compact_vector_index(index_dir) == 1
+        monkeypatch.undo()
+
+        assert [p.name for p in (index_dir / "pending").iterdir()] == [added[0].name]
+        vector_id = entries["vectorId"][1].as_py()
+        assert lookup_vector(index_dir, vector_id).num_rows == 1